@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+"""
+Benchmark of logging many inputs and outputs into a RunRecord.
+
+Appends synthetic (path, hash) inputs, output paths and library names to a
+`recipy.runrecord.RunRecord`, and compares it with the list scans that
+`RunRecord.append` used before (`value not in list`), which take quadratic
+time. The legacy strategy is only run up to --legacy-max events.
+
+Usage:
+  python benchmarks/bench_runrecord.py [--events N [N ...]]
+                                       [--legacy-max N]
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+# Importing recipy logs a run; keep it out of the real database
+os.environ['HOME'] = tempfile.mkdtemp()
+os.environ['RECIPY_GENERAL_QUIET'] = '1'
+
+from recipy.runrecord import RunRecord  # noqa: E402
+
+
+def events(n):
+    for i in range(n):
+        yield 'inputs', ('/data/in/file%d.csv' % i, '%040x' % i)
+        yield 'outputs', '/data/out/file%d.csv' % (i // 2)
+        yield 'libraries', 'numpy v1.%d' % (i % 10)
+
+
+def legacy_append(run, field, value):
+    values = run.setdefault(field, [])
+    if value not in values:
+        values.append(value)
+
+
+def bench_record(n):
+    record = RunRecord({'inputs': [], 'outputs': [], 'libraries': []}, 1)
+    start = time.time()
+    for field, value in events(n):
+        record.append(field, value)
+    return time.time() - start, record.run
+
+
+def bench_legacy(n):
+    run = {'inputs': [], 'outputs': [], 'libraries': []}
+    start = time.time()
+    for field, value in events(n):
+        legacy_append(run, field, value)
+    return time.time() - start, run
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--events', type=int, nargs='+',
+                        default=[10 ** 5, 10 ** 6],
+                        help='numbers of inputs to log (each comes with an '
+                             'output and a library)')
+    parser.add_argument('--legacy-max', type=int, default=2 * 10 ** 4)
+    args = parser.parse_args()
+
+    for n in args.events:
+        elapsed, run = bench_record(n)
+        print('%8d events  RunRecord  %8.2f s  %6.2f us/event' %
+              (n, elapsed, elapsed / (3 * n) * 1e6))
+        if n <= args.legacy_max:
+            legacy, legacy_run = bench_legacy(n)
+            print('%8d events  legacy     %8.2f s  %6.2f us/event' %
+                  (n, legacy, legacy / (3 * n) * 1e6))
+            if legacy_run != run:
+                print('ERROR: the runs are different')
+                return 1
+        else:
+            print('%8d events  legacy     (skipped, quadratic)' % n)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+"""
+Benchmark of tree hashing of single large files in recipyCommon/hashing.py.
+
+Compares the throughput of the sequential engine (one thread, readinto), of
+memory-mapped hashing and of tree hashing with an increasing number of
+threads, and of fingerprinting, on synthetic files of 1 to 50 GB.
+
+Usage:
+  python benchmarks/bench_treehash.py [--sizes GB,...] [--leaf-size SIZE]
+                                      [--threads N,...] [--algorithm NAME]
+                                      [--dir DIR] [--sparse] [FILE]
+
+Without FILE, temporary files of the given sizes are written in --dir (make
+sure there is enough space). With --sparse, the files are sparse (all zeros),
+so they take no space and are read at memory speed: this measures the CPU
+side only. Files that fit in the page cache are read from memory after the
+first pass; use files larger than memory (or drop the caches) to include the
+disk.
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from recipyCommon import hashing  # noqa: E402
+from recipyCommon.config import parse_size  # noqa: E402
+
+GB = 1 << 30
+
+
+def make_file(size, directory, sparse):
+    f = tempfile.NamedTemporaryFile(delete=False, suffix='.bin',
+                                    dir=directory)
+    if sparse:
+        f.truncate(size)
+    else:
+        chunk = os.urandom(64 * 1024 * 1024)
+        written = 0
+        while written < size:
+            n = f.write(chunk[:size - written])
+            written += n
+    f.close()
+    return f.name
+
+
+def sequential(path, algorithm, leaf_size, threads):
+    hasher = hashing.new_hasher(algorithm)
+    hashing._read_into(path, [hasher], use_mmap=False)
+    return hasher.hexdigest()
+
+
+def mapped(path, algorithm, leaf_size, threads):
+    hashing.MMAP_THRESHOLD = 1
+    hasher = hashing.new_hasher(algorithm)
+    hashing._read_into(path, [hasher], use_mmap=True)
+    return hasher.hexdigest()
+
+
+def tree(path, algorithm, leaf_size, threads):
+    return hashing._tree_into(path, [algorithm], leaf_size,
+                              threads)[algorithm]
+
+
+def sampled(path, algorithm, leaf_size, threads):
+    hasher = hashing.new_hasher(algorithm)
+    hashing._sample_into(path, [hasher], 16)
+    return hasher.hexdigest()
+
+
+def timed(func, *args):
+    start = time.time()
+    digest = func(*args)
+    return time.time() - start, digest
+
+
+def bench(path, algorithm, leaf_size, thread_counts):
+    size = os.path.getsize(path)
+    print('File: %s (%.1f GB), algorithm: %s, leaf size: %d' %
+          (path, size / float(GB), algorithm, leaf_size))
+    runs = [('sequential', sequential, 1), ('mmap', mapped, 1)]
+    runs += [('tree, %d threads' % n, tree, n) for n in thread_counts]
+    runs += [('fingerprint', sampled, 1)]
+    tree_digests = set()
+    for name, func, threads in runs:
+        elapsed, digest = timed(func, path, algorithm, leaf_size, threads)
+        if func is tree:
+            tree_digests.add(digest)
+        print('%-20s %8.1f MB/s %8.2f s' %
+              (name, size / 1e6 / elapsed, elapsed))
+    if len(tree_digests) != 1:
+        print('ERROR: the number of threads changed the tree digest')
+        return 1
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('file', nargs='?')
+    parser.add_argument('--sizes', default='1,10,50',
+                        help='sizes of the temporary files in GB')
+    parser.add_argument('--leaf-size', default='4M')
+    parser.add_argument('--threads', default='1,2,4,8',
+                        help='numbers of threads to tree-hash with')
+    parser.add_argument('--algorithm', default='blake2b',
+                        choices=hashing.available_algorithms())
+    parser.add_argument('--dir', default=None,
+                        help='directory for the temporary files')
+    parser.add_argument('--sparse', action='store_true')
+    args = parser.parse_args()
+
+    leaf_size = parse_size(args.leaf_size)
+    thread_counts = [int(n) for n in args.threads.split(',')]
+    if args.file:
+        return bench(args.file, args.algorithm, leaf_size, thread_counts)
+
+    status = 0
+    for size in args.sizes.split(','):
+        path = make_file(int(float(size) * GB), args.dir, args.sparse)
+        try:
+            status |= bench(path, args.algorithm, leaf_size, thread_counts)
+        finally:
+            os.remove(path)
+        print('')
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+"""
+Benchmark of the per-call overhead of recipy's patched functions.
+
+Measures how long it takes to look up a configuration option through
+ConfigParser (how `option_set` used to work), through `option_set` and
+through the precomputed attributes of `recipyCommon.config.SETTINGS`, and the
+overhead of a function wrapped with `create_wrapper(log_input, ...)`
+compared to calling it directly.
+
+Usage:
+  python benchmarks/bench_wrappers.py [--calls N]
+
+recipy is imported with a temporary home directory (so the run is logged to
+a throwaway database) and input hashes disabled through the environment, so
+the wrapper overhead doesn't include hashing.
+"""
+import os
+import sys
+import timeit
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+
+def report(name, seconds, calls):
+    print('%-35s %8.3f us/call' % (name, seconds / calls * 1e6))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--calls', type=int, default=100000)
+    args = parser.parse_args()
+    n = args.calls
+
+    os.environ['HOME'] = tempfile.mkdtemp()
+    os.environ['RECIPY_GENERAL_QUIET'] = '1'
+    os.environ['RECIPY_IGNORED_METADATA_INPUT_HASHES'] = '1'
+
+    import recipy  # noqa: F401
+    from recipy import log
+    from recipyCommon import config
+    from recipyCommon.utils import create_wrapper
+
+    conf = config.conf
+    report('ConfigParser.has_option',
+           timeit.timeit(lambda: conf.has_option('general', 'debug'),
+                         number=n), n)
+    report('option_set',
+           timeit.timeit(lambda: config.option_set('general', 'debug'),
+                         number=n), n)
+    # SETTINGS doesn't exist in older versions (run this script against an
+    # older checkout to compare the wrapper overhead)
+    settings = getattr(config, 'SETTINGS', None)
+    if settings is not None:
+        report('SETTINGS.debug',
+               timeit.timeit(lambda: settings.debug, number=n), n)
+
+    class Patch(object):
+        wrapper = create_wrapper(log.log_input, 0, 'recipy')
+
+    def load(path):
+        return path
+
+    wrapped = Patch().wrapper(load)
+    path = os.path.join(os.environ['HOME'], 'data.csv')
+    direct = timeit.timeit(lambda: load(path), number=n)
+    patched = timeit.timeit(lambda: wrapped(path), number=n)
+    report('unpatched call', direct, n)
+    report('patched call (log_input)', patched, n)
+    report('overhead', patched - direct, n)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
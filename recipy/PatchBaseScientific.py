@@ -1,8 +1,8 @@
-import sys
+from .PatchImporter import install_patches
 from .PatchSimple import PatchSimple
 
 from .log import log_input, log_output, add_module_to_db
-from recipyCommon.utils import create_wrapper, multiple_insert
+from recipyCommon.utils import create_wrapper
 
 
 class PatchPandas(PatchSimple):
@@ -76,5 +76,5 @@ class PatchBS4(PatchSimple):
     add_module_to_db(modulename, input_functions, output_functions)
 
 
-multiple_insert(sys.meta_path, [PatchNumpy(), PatchPandas(), PatchMPL(),
-                PatchBS4(), PatchLXML()])
+install_patches([PatchNumpy(), PatchPandas(), PatchMPL(), PatchBS4(),
+                 PatchLXML()])
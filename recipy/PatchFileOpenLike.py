@@ -1,6 +1,6 @@
 from .PatchSimple import PatchSimple
 
-from recipyCommon.config import option_set
+from recipyCommon.config import SETTINGS
 from recipyCommon.utils import patch_function
 
 
@@ -12,7 +12,7 @@ class PatchFileOpenLike(PatchSimple):
     """
     def patch(self, mod):
         for f in self.functions:
-            if option_set('general', 'debug'):
+            if SETTINGS.debug:
                 print('Patching input/output function: {}'.format(f))
             patch_function(mod, f, self.wrapper)
 
@@ -1,60 +1,89 @@
 import sys
-import imp
+from importlib.abc import MetaPathFinder
 
-from recipyCommon.config import option_set
-from recipyCommon.utils import recursive_find_module
+from recipyCommon.config import SETTINGS
 
 
 class PatchImporter(object):
-    """A class that handles finding modules, importing them
-    and calling a `patch` method.
+    """A class that describes how a module is patched once it is imported.
 
     This class is not designed to be used itself - instead,
-    subclasses should be created that implement the `patch` method.
+    subclasses should be created that set `modulename` and implement the
+    `patch` method. Instances are registered with `install_patches`.
     """
     modulename = ''
 
-    def find_module(self, fullname, path=None):
-        """Module finding method. It tells Python to use our hook
-        only for the package we want.
-        """
-        #print("Find module: %s" % fullname)
-        if fullname == self.modulename:
-            self.path = path
-            return self
-        return None
-
-    def load_module(self, name):
-        """Module loading method. It imports the module normally,
-        and then calls the `patch` method to wrap the functions we need.
-
-        `patch` is implemented by subclasses
-        """
-        if name != self.modulename:
-            raise ImportError("%s can only be used to import a specific module!",
-                              self.__class__.__name__)
-        if name in sys.modules:
-            return sys.modules[name]    # already imported and patched
-
-        # Find the module
-        file_obj, pathname, desc = recursive_find_module(name, sys.path)
-
-        try:
-            mod = imp.load_module(name, file_obj, pathname, desc)
-        finally:
-            if file_obj:
-                file_obj.close()
-
-        if option_set('general', 'debug'):
+    def patch(self, mod):
+        return mod
+
+
+class PatchFinder(MetaPathFinder):
+    """The meta path finder that patches modules when they are imported.
+
+    A single finder handles all patched modules, so an import of any other
+    module costs one dict lookup. For a patched module, the finder asks the
+    other finders on `sys.meta_path` for the module's spec, and wraps its
+    loader in a `PatchLoader`.
+    """
+    def __init__(self):
+        self.patchers = {}
+
+    def find_spec(self, fullname, path, target=None):
+        patcher = self.patchers.get(fullname)
+        if patcher is None:
+            return None
+
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, 'find_spec'):
+                continue
+            spec = finder.find_spec(fullname, path, target)
+            if spec is not None:
+                break
+        else:
+            return None
+
+        # Loaders that don't implement exec_module can't be wrapped
+        if spec.loader is None or not hasattr(spec.loader, 'exec_module'):
+            return spec
+        spec.loader = PatchLoader(spec.loader, patcher)
+        return spec
+
+
+class PatchLoader(object):
+    """Loader that executes a module with the module's own loader, and then
+    patches it. Other attributes (e.g., `get_resource_reader`) are those of
+    the original loader."""
+    def __init__(self, loader, patcher):
+        self.loader = loader
+        self.patcher = patcher
+
+    def __getattr__(self, name):
+        return getattr(self.loader, name)
+
+    def create_module(self, spec):
+        return self.loader.create_module(spec)
+
+    def exec_module(self, mod):
+        self.loader.exec_module(mod)
+
+        if SETTINGS.debug:
             print("Patching %s" % mod.__name__)
 
         # Actually do the patching
-        mod = self.patch(mod)
+        patched = self.patcher.patch(mod)
 
         # And put the module in Python's proper namespace
-        sys.modules[name] = mod
+        if patched is not None and patched is not mod:
+            sys.modules[mod.__name__] = patched
 
-        return mod
 
-    def patch(self, mod):
-        return mod
+FINDER = PatchFinder()
+
+
+def install_patches(patchers):
+    """Register `PatchImporter` instances, so their modules are patched when
+    they are imported."""
+    for patcher in patchers:
+        FINDER.patchers[patcher.modulename] = patcher
+    if FINDER not in sys.meta_path:
+        sys.meta_path.insert(0, FINDER)
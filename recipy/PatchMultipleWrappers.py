@@ -3,7 +3,7 @@ import six
 from .PatchImporter import PatchImporter
 
 from recipyCommon.utils import patch_function, create_wrapper
-from recipyCommon.config import option_set
+from recipyCommon.config import SETTINGS
 
 
 class PatchMultipleWrappers(PatchImporter):
@@ -22,7 +22,7 @@ class PatchMultipleWrappers(PatchImporter):
         """
         for f in self.wrappers.functions:
             if not self._ignore(f):
-                if option_set('general', 'debug'):
+                if SETTINGS.debug:
                     msg = 'Patching {} function: {}'.format(f['type'],
                                                             f['function'])
                     print(msg)
@@ -35,7 +35,7 @@ class PatchMultipleWrappers(PatchImporter):
                 setattr(self.__class__, 'wrapper', f['wrapper'])
                 patch_function(mod, f['function'], self.wrapper)
             else:
-                if option_set('general', 'debug'):
+                if SETTINGS.debug:
                     print('Ignoring {} for: {}'.format(f['type'],
                                                        self.modulename))
 
@@ -44,9 +44,9 @@ class PatchMultipleWrappers(PatchImporter):
     def _ignore(self, f):
         root_modulename = self.modulename.split('.')[0]
 
-        opt = 'ignored {}s'.format(f['type'])
-
-        return option_set(opt, root_modulename) or option_set(opt, 'all')
+        if f['type'] == 'input':
+            return SETTINGS.ignore_inputs(root_modulename)
+        return SETTINGS.ignore_outputs(root_modulename)
 
 
 class WrapperList(object):
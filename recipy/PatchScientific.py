@@ -1,10 +1,10 @@
-import sys
+from .PatchImporter import install_patches
 from .PatchSimple import PatchSimple
 from .PatchFileOpenLike import PatchFileOpenLike
 from .PatchMultipleWrappers import PatchMultipleWrappers, WrapperList
-from .log import log_input, log_output, add_module_to_db
-from recipyCommon.utils import create_wrapper, create_argument_wrapper, \
-                               multiple_insert
+from .log import log_input, log_output, log_inputs_batch, \
+    log_outputs_batch, add_module_to_db
+from recipyCommon.utils import create_wrapper, create_argument_wrapper
 
 
 class PatchGDAL(PatchSimple):
@@ -108,16 +108,21 @@ class PatchXarray(PatchMultipleWrappers):
 
     wrappers = WrapperList()
 
-    # not patched: open_zarr, Dataset.to_zarr, Dataset.load, DataArray.load
-    input_functions = ['open_dataset', 'open_mfdataset', 'open_rasterio',
-                       'open_dataarray']
-    output_functions = ['Dataset.to_netcdf', 'DataArray.to_netcdf']
+    # not patched: Dataset.load, DataArray.load
+    # Zarr stores are directories, they are hashed as a whole
+    input_functions = ['open_dataset', 'open_rasterio', 'open_dataarray',
+                       'open_zarr']
+    output_functions = ['Dataset.to_netcdf', 'DataArray.to_netcdf',
+                        'Dataset.to_zarr']
 
     wrappers.add_inputs(input_functions, log_input, 0, modulename)
     wrappers.add_outputs(output_functions, log_output, 0, modulename)
-    wrappers.add_outputs('save_mfdataset', log_output, 1, modulename)
+    # Multi-file functions take lists of files or glob patterns
+    wrappers.add_inputs('open_mfdataset', log_inputs_batch, 0, modulename)
+    wrappers.add_outputs('save_mfdataset', log_outputs_batch, 1, modulename)
 
-    add_module_to_db(modulename, input_functions, output_functions)
+    add_module_to_db(modulename, input_functions + ['open_mfdataset'],
+                     output_functions + ['save_mfdataset'])
 
 
 class PatchIris(PatchSimple):
@@ -133,7 +138,5 @@ class PatchIris(PatchSimple):
     add_module_to_db(modulename, input_functions, output_functions)
 
 
-multiple_insert(sys.meta_path, [PatchGDAL(), PatchSKLearn(),
-                                PatchNIBabel(), PatchTifffile(),
-                                PatchImageio(), PatchNetCDF4(), PatchXarray(),
-                                PatchIris()])
+install_patches([PatchGDAL(), PatchSKLearn(), PatchNIBabel(), PatchTifffile(),
+                 PatchImageio(), PatchNetCDF4(), PatchXarray(), PatchIris()])
@@ -1,7 +1,7 @@
 from .PatchImporter import PatchImporter
 
 from recipyCommon.utils import patch_function
-from recipyCommon.config import option_set
+from recipyCommon.config import SETTINGS
 
 
 class PatchSimple(PatchImporter):
@@ -20,31 +20,26 @@ class PatchSimple(PatchImporter):
 
         if not self._ignore_input():
             for f in self.input_functions:
-                if option_set('general', 'debug'):
+                if SETTINGS.debug:
                     print('Patching input function: %s' % f)
                 patch_function(mod, f, self.input_wrapper)
         else:
-            if option_set('general', 'debug'):
+            if SETTINGS.debug:
                     print('Ignoring inputs for: %s' % self.modulename)
 
         if not self._ignore_output():
             for f in self.output_functions:
-                if option_set('general', 'debug'):
+                if SETTINGS.debug:
                     print('Patching output function: %s' % f)
                 patch_function(mod, f, self.output_wrapper)
         else:
-            if option_set('general', 'debug'):
+            if SETTINGS.debug:
                     print('Ignoring outputs for: %s' % self.modulename)
 
         return mod
 
     def _ignore_input(self):
-        root_modulename = self.modulename.split('.')[0]
-
-        return option_set('ignored inputs', root_modulename) or option_set('ignored inputs', 'all')
+        return SETTINGS.ignore_inputs(self.modulename.split('.')[0])
 
     def _ignore_output(self):
-        root_modulename = self.modulename.split('.')[0]
-
-        return (option_set('ignored outputs', root_modulename) or
-                option_set('ignored outputs', 'all'))
+        return SETTINGS.ignore_outputs(self.modulename.split('.')[0])
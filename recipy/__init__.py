@@ -1,4 +1,5 @@
-# These lines ARE needed, as they actually set up sys.meta_path
+# These lines ARE needed, as they actually set up sys.meta_path (see
+# PatchImporter.install_patches)
 from . import PatchWarnings
 from . import PatchBaseScientific
 from . import PatchScientific
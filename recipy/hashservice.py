@@ -0,0 +1,83 @@
+import os
+import threading
+from collections import deque, Counter
+
+from six.moves import queue
+
+from recipyCommon.hashing import cached_hash_file
+from recipyCommon.hashcache import get_hash_cache, stat_signature
+
+
+class HashService(object):
+    """Hashes input files on background threads.
+
+    `submit` records the stat signature of a file and returns right away, so
+    the function that reads the file doesn't have to wait for the hash. The
+    results are collected with `results`: tuples (path, digest, modified),
+    where modified is True if the file was changed between the moment it was
+    submitted and the moment it was hashed (so the hash may not match the data
+    that was read).
+
+    Worker threads are started when jobs are submitted, up to `threads`. They
+    are daemon threads: a process that exits without waiting for the service
+    (see `wait`) does not hang on them.
+    """
+    def __init__(self, threads=1):
+        self.max_threads = max(1, threads)
+        self._jobs = queue.Queue()
+        self._results = deque()
+        self._pending = Counter()
+        self._cond = threading.Condition()
+        self._threads = []
+        self._pid = os.getpid()
+
+    def alive(self):
+        """Return False in a forked child, where the threads don't exist."""
+        return self._pid == os.getpid()
+
+    def submit(self, path):
+        signature = stat_signature(path)
+        with self._cond:
+            self._pending[path] += 1
+        self._jobs.put((path, signature))
+        if len(self._threads) < self.max_threads:
+            t = threading.Thread(target=self._work, name='recipy-hasher')
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def _work(self):
+        while True:
+            path, signature = self._jobs.get()
+            try:
+                digest = cached_hash_file(path, get_hash_cache())
+                modified = signature is None or \
+                    stat_signature(path) != signature
+            except Exception:
+                digest, modified = None, False
+            self._results.append((path, digest, modified))
+            with self._cond:
+                self._pending[path] -= 1
+                if self._pending[path] <= 0:
+                    del self._pending[path]
+                self._cond.notify_all()
+
+    def results(self):
+        """Return (and forget) the results that are ready."""
+        results = []
+        while True:
+            try:
+                results.append(self._results.popleft())
+            except IndexError:
+                return results
+
+    def pending(self):
+        """Return the set of paths that are still being hashed."""
+        with self._cond:
+            return set(self._pending)
+
+    def wait(self, timeout=None):
+        """Wait until all submitted files are hashed (at most `timeout`
+        seconds). Returns True if no jobs are pending."""
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._pending, timeout)
@@ -7,21 +7,55 @@ import platform
 import atexit
 from traceback import format_tb
 import uuid
-import tempfile
+import json
+import socket
 import shutil
-from tinydb import Query
-import difflib
+import threading
 import warnings
-import codecs
+import glob
+import re
 import six
-from binaryornot.check import is_binary
 
-from recipyCommon.version_control import add_git_info, add_svn_info, hash_file
-from recipyCommon.config import option_set, get_db_path, get_notebook_mode
-from recipyCommon.utils import open_or_create_db
-from recipyCommon.libraryversions import get_version
-
-RUN_ID = {}
+from recipyCommon.version_control import collect_vcs_info
+from recipyCommon.vcscache import get_vcs_cache
+from recipyCommon.blobstore import get_blob_store, save_run, \
+    save_file_diffs
+from recipyCommon.hashing import hash_files, cached_hash_file, hash_file, \
+    use_plain_hash
+from recipyCommon.hashcache import get_hash_cache, stat_signature
+from recipyCommon.config import SETTINGS, option_set, get_notebook_mode, \
+    get_checkpoint_interval, get_checkpoint_events, get_hash_threads, \
+    get_hash_threads_per_device, get_hash_timeout, get_file_diff_limit, \
+    get_file_diff_timeout, get_file_diff_processes
+from recipyCommon.storage import open_storage
+from recipyCommon.libraryversions import get_version, get_versions
+from recipyCommon.journal import RunJournal, get_journal_path, \
+    get_child_journal_dir, get_child_journal_path, read_child_journals
+from recipyCommon.snapshots import RunSnapshots, cleanup_snapshots
+from recipyCommon.filediff import diff_files
+from recipyCommon.utils import UniqueList
+
+from .runrecord import RunRecord
+from .hashservice import HashService
+
+RUN_ID = None
+# In-memory record of the current run, written to the DB by `log_flush`
+RUN = None
+# Background hashing of inputs, started by the first input that needs it
+HASH_SERVICE = None
+# Background collection of git/svn information, started by `log_init`
+VCS_INFO = None
+# Snapshots of existing outputs for file diffs, taken by the first write
+SNAPSHOTS = None
+# Characters that make a file name a glob pattern
+GLOB_MAGIC = re.compile('[*?[]')
+# Modules that recipy patches (see `add_module_to_db`)
+PATCHES = []
+# True once PATCHES has been written to the database by this process
+_PATCHES_SAVED = False
+# Environment variable that tells spawned multiprocessing workers which run
+# to forward their events to
+PARENT_RUN_VAR = 'RECIPY_PARENT_RUN'
 
 
 def new_run():
@@ -35,8 +69,23 @@ def log_init(notebookName=None):
     Works out what script has been run, creates a new unique run ID,
     and gets the basic metadata.
 
-    This is called when running `import recipy`.
+    This is called when running `import recipy`. Nothing is written to the
+    database here: the run is inserted by the first `_save_run` (at exit, or
+    at the first checkpoint).
     """
+    global RUN_ID, RUN, VCS_INFO
+
+    # A spawned multiprocessing worker imports the script (and recipy) again;
+    # it forwards its events to the run of the script instead of starting one
+    parent = _parent_run()
+    if parent is not None:
+        unique_id, RUN_ID, pid = parent
+        run = {'unique_id': unique_id, 'inputs': [], 'outputs': [],
+               'libraries': [], 'warnings': [], 'custom_values': {}}
+        RUN = RunRecord(run, RUN_ID, pid=pid,
+                        child_journal=_child_journal(unique_id))
+        return
+
     notebookMode = get_notebook_mode()
     if notebookMode and notebookName is None:
         # Avoid first call without Notebook name
@@ -58,10 +107,15 @@ def log_init(notebookName=None):
         scriptpath = os.path.realpath(sys.argv[0])
         cmd_args = sys.argv[1:]
 
-    global RUN_ID
-
-    # Open the database
-    db = open_or_create_db()
+    # Make sure nothing is lost from a previous run in the same process
+    if RUN is not None and not RUN.finished and not RUN.in_child:
+        _merge_child_events()
+        _finish_vcs_info()
+        _finish_input_hashes()
+        _save_run()
+        if RUN.journal is not None:
+            RUN.journal.remove()
+    _remove_snapshots()
 
     # Create the unique ID for this run
     guid = str(uuid.uuid4())
@@ -83,35 +137,91 @@ def log_init(notebookName=None):
         "custom_values": {}
     }
 
-    if not notebookName and not option_set('ignored metadata', 'git'):
-        add_git_info(run, scriptpath)
-
-    if not notebookName and not option_set('ignored metadata', 'svn'):
-        add_svn_info(run, scriptpath)
-
-
-    # Put basics into DB
-    RUN_ID = db.insert(run)
+    # Computing the diff of a large working copy takes a while, so git and
+    # svn information is collected while the script runs
+    VCS_INFO = None
+    if not notebookName:
+        VCS_INFO = collect_vcs_info(
+            scriptpath, git=not option_set('ignored metadata', 'git'),
+            svn=not option_set('ignored metadata', 'svn'),
+            diff=not option_set('ignored metadata', 'diff'),
+            cache=get_vcs_cache())
+
+    # The run gets its id when it is inserted into the DB
+    RUN_ID = None
+
+    # Journal every change to the run, so it can be recovered after a crash
+    journal = None
+    if option_set('database', 'journal'):
+        journal = RunJournal(get_journal_path(guid))
+        journal.write('start', run=run, pid=os.getpid(),
+                      host=socket.gethostname())
+
+    RUN = RunRecord(run, RUN_ID,
+                    checkpoint_interval=get_checkpoint_interval(),
+                    checkpoint_events=get_checkpoint_events(),
+                    journal=journal, child_journal=_child_journal(guid))
+    os.environ[PARENT_RUN_VAR] = json.dumps([guid, RUN_ID, os.getpid()])
 
     # Print message
-    if not option_set('general', 'quiet'):
+    if not SETTINGS.quiet:
         print("recipy run inserted, with ID %s" % (guid))
 
     # check whether patched modules were imported before recipy was imported
-    patches = db.table('patches')
-
-    for p in patches.all():
+    for p in PATCHES:
         if p['modulename'] in sys.modules:
             msg = 'not tracking inputs and outputs for {}; recipy was ' \
                   'imported after this module'.format(p['modulename'])
             warnings.warn(msg, stacklevel=3)
 
-    db.close()
-
     # Register exception hook so exceptions can be logged
     sys.excepthook = log_exception
 
 
+def _parent_run():
+    """Return (unique_id, run_id, pid) of the run of the script, if this
+    process is a multiprocessing worker that the script spawned."""
+    value = os.environ.get(PARENT_RUN_VAR)
+    # Spawned workers import multiprocessing, and get their name, before
+    # they import the script
+    multiprocessing = sys.modules.get('multiprocessing')
+    if not value or multiprocessing is None or \
+       multiprocessing.current_process().name == 'MainProcess':
+        return None
+    try:
+        unique_id, run_id, pid = json.loads(value)
+    except (TypeError, ValueError):
+        return None
+    return unique_id, run_id, pid
+
+
+def _child_journal(unique_id):
+    """Return the function that opens the journal a child process forwards
+    its events to."""
+    def open_journal(pid):
+        return RunJournal(get_child_journal_path(unique_id, pid))
+    return open_journal
+
+
+def _merge_child_events():
+    """Add the events forwarded by child processes to the record."""
+    directory = get_child_journal_dir(RUN.run['unique_id'])
+    events = read_child_journals(directory)
+    if events:
+        RUN.merge(events)
+    shutil.rmtree(directory, ignore_errors=True)
+
+
+def _after_fork_in_child():
+    # Another thread of the parent may have held the lock when it forked
+    if RUN is not None:
+        RUN.lock = threading.RLock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
 def log_values(custom_values=None, **kwargs):
     """ Log a custom value-key pairs into the database
     e.g,
@@ -127,47 +237,45 @@ def log_values(custom_values=None, **kwargs):
     custom_values.update(kwargs)
 
     # debugging
-    if option_set('general', 'debug'):
+    if SETTINGS.debug:
         print('Logging custom values: %s' % str(custom_values))
 
-    # Update object in DB
-    db = open_or_create_db()
-    db.update(add_dict("custom_values", custom_values), doc_ids=[RUN_ID])
-    db.close()
+    RUN.update_dict("custom_values", custom_values)
+    _checkpoint()
 
 
-def log_input(filename, source):
+def log_input(filename, source, defer_hash=False):
     """Log input to the database.
 
     Called by patched functions that do some sort of input (reading from a file
     etc) with the filename and some sort of information about the source.
+    If `defer_hash` is True, the file is not hashed now; the caller is
+    expected to provide the hash later with `log_file_hash` (otherwise, it is
+    computed at script exit).
 
     Note: the source parameter is currently not stored in the database.
     """
     # Some packages, e.g., xarray, accept a list of files as input argument
-    if isinstance(filename, list):
-        for f in filename:
-            log_input(f, source)
+    if isinstance(filename, (list, tuple)):
+        log_inputs_batch(filename, source, defer_hash)
         return
-    elif not isinstance(filename, six.string_types):
-        try:
-            filename = filename.name
-        except:
-            pass
-    filename = os.path.abspath(filename)
-    if option_set('ignored metadata', 'input_hashes'):
+    filename = os.path.abspath(_file_path(filename))
+    if defer_hash or not SETTINGS.hash_inputs or \
+       SETTINGS.defer_input_hashes:
+        # deferred input hashes are computed at script exit
         record = filename
+    elif SETTINGS.async_input_hashes:
+        # hashed in the background, while the caller reads the file
+        record = filename
+        _hash_service().submit(filename)
     else:
-        record = (filename, hash_file(filename))
+        record = (filename, cached_hash_file(filename, get_hash_cache()))
 
-    if option_set('general', 'debug'):
+    if SETTINGS.debug:
         print("Input from %s using %s" % (record, source))
-    #Update object in DB
-    version = get_version(source)
-    db = open_or_create_db()
-    db.update(append("inputs", record, no_duplicates=True), doc_ids=[RUN_ID])
-    db.update(append("libraries", version, no_duplicates=True), doc_ids=[RUN_ID])
-    db.close()
+    RUN.append("inputs", record)
+    _log_library(source)
+    _checkpoint()
 
 
 def log_output(filename, source):
@@ -178,51 +286,188 @@ def log_output(filename, source):
 
     Note: the source parameter is currently not stored in the database.
     """
-    if isinstance(filename, list):
-        for f in filename:
-            log_output(f, source)
+    if isinstance(filename, (list, tuple)):
+        log_outputs_batch(filename, source)
+        return
+    filename = os.path.abspath(_file_path(filename))
+    _keep_old_output(filename)
+
+    if SETTINGS.debug:
+        print("Output to %s using %s" % (filename, source))
+    # data hash will be hashed at script exit, if enabled
+    RUN.append("outputs", filename)
+    _log_library(source)
+    _checkpoint()
+
+
+def log_inputs_batch(filenames, source, defer_hash=False):
+    """Log many inputs at once (e.g., for `xarray.open_mfdataset`).
+
+    `filenames` is a file name, glob pattern or (nested) list of them. Glob
+    patterns are expanded, the files are hashed in parallel (like the outputs
+    at exit), and they are added to the run as a single event.
+    """
+    filenames = _expand_paths(filenames)
+    if not filenames:
+        return
+    if defer_hash or not SETTINGS.hash_inputs or \
+       SETTINGS.defer_input_hashes:
+        records = filenames
+    elif SETTINGS.async_input_hashes:
+        records = filenames
+        service = _hash_service()
+        for filename in filenames:
+            service.submit(filename)
+    else:
+        hashes = hash_files(filenames, threads=get_hash_threads(),
+                            threads_per_device=get_hash_threads_per_device(),
+                            cache=get_hash_cache())
+        records = [(f, hashes[f]) for f in filenames]
+
+    if SETTINGS.debug:
+        print("Input from %d files using %s" % (len(records), source))
+    RUN.extend("inputs", records)
+    _log_library(source)
+    _checkpoint()
+
+
+def log_outputs_batch(filenames, source):
+    """Log many outputs at once (e.g., for `xarray.save_mfdataset`).
+
+    `filenames` is a file name, glob pattern or (nested) list of them; glob
+    patterns that match files are expanded. The outputs are added to the run
+    as a single event, and hashed at script exit.
+    """
+    filenames = _expand_paths(filenames)
+    if not filenames:
         return
-    elif not isinstance(filename, six.string_types):
+    for filename in filenames:
+        _keep_old_output(filename)
+
+    if SETTINGS.debug:
+        print("Output to %d files using %s" % (len(filenames), source))
+    RUN.extend("outputs", filenames)
+    _log_library(source)
+    _checkpoint()
+
+
+def _log_library(source):
+    """Add the library that read or wrote a file to the run.
+
+    Until the script exits, the run holds the name of the library; the
+    versions of all libraries are looked up at once by
+    `_finish_library_versions`.
+    """
+    RUN.append("libraries", source.split('.')[0])
+
+
+def _finish_library_versions():
+    """Replace the names of the libraries in the run with their versions."""
+    # Versions always contain a space ('numpy v1.0'), module names don't
+    names = [lib for lib in RUN.run.get('libraries') or [] if ' ' not in lib]
+    for name, version in zip(names, get_versions(names)):
+        RUN.replace('libraries', name, version)
+
+
+def _file_path(f):
+    """Return the path of a file name, path-like object or file object."""
+    if isinstance(f, six.string_types):
+        return f
+    try:
+        return os.fspath(f)
+    except (AttributeError, TypeError):
+        pass
+    try:
+        return f.name
+    except AttributeError:
+        return f
+
+
+def _expand_paths(filenames):
+    """Flatten (nested) lists of files into a list of absolute paths, and
+    expand glob patterns that don't name an existing file."""
+    if not isinstance(filenames, (list, tuple)):
+        filenames = [filenames]
+    paths = []
+    for f in filenames:
+        if isinstance(f, (list, tuple)):
+            paths.extend(_expand_paths(f))
+            continue
+        f = _file_path(f)
+        if isinstance(f, six.string_types) and GLOB_MAGIC.search(f) and \
+           not os.path.exists(f):
+            matches = sorted(glob.glob(os.path.expanduser(f)))
+            if matches:
+                paths.extend(os.path.abspath(m) for m in matches)
+                continue
+        paths.append(os.path.abspath(f))
+    return paths
+
+
+def _keep_old_output(filename):
+    """Snapshot an existing output file, to diff it with the new one at exit
+    (if file_diff_outputs is set). Only the version from before the run is
+    kept (see `recipyCommon.snapshots`), so outputs that don't exist yet are
+    passed on too: the run creates them."""
+    global SNAPSHOTS
+    if not SETTINGS.file_diff_outputs:
+        return
+    with RUN.lock:
+        if SNAPSHOTS is None:
+            # Remove what was left behind by runs that were killed
+            cleanup_snapshots()
+            SNAPSHOTS = RunSnapshots(RUN.run['unique_id'], owner=RUN.pid)
         try:
-            filename = filename.name
-        except:
-            pass
-    filename = os.path.abspath(filename)
+            snapshot = SNAPSHOTS.take(filename, is_binary=_is_binary)
+        except (IOError, OSError) as e:
+            warnings.warn('recipy: could not keep {} for its file diff: {}'
+                          .format(filename, e))
+            return
+        if snapshot is not None:
+            RUN.add_file_diff(filename, snapshot)
 
-    version = get_version(source)
-    db = open_or_create_db()
 
-    if option_set('data', 'file_diff_outputs') and os.path.isfile(filename) \
-       and not is_binary(filename):
-        tf = tempfile.NamedTemporaryFile(delete=False)
-        shutil.copy2(filename, tf.name)
-        add_file_diff_to_db(filename, tf.name, db)
+def log_file_hash(filename, digest, output=False):
+    """Log the hash of an input or output file that was computed while it
+    was being read or written (see `recipy.open`).
 
-    if option_set('general', 'debug'):
-        print("Output to %s using %s" % (filename, source))
-    #Update object in DB
-    # data hash will be hashed at script exit, if enabled
-    db.update(append("outputs", filename, no_duplicates=True), doc_ids=[RUN_ID])
-    db.update(append("libraries", version, no_duplicates=True), doc_ids=[RUN_ID])
-    db.close()
+    If `digest` is None (the file was not read or written sequentially), an
+    input is hashed now; an output is hashed at script exit as usual.
+    """
+    if RUN is None or RUN.finished:
+        return
+    filename = os.path.abspath(filename)
+    if output:
+        # Large outputs are fingerprinted or tree-hashed at exit instead
+        if digest is not None and use_plain_hash(filename):
+            RUN.streamed_hashes[filename] = (digest, stat_signature(filename))
+        return
+
+    if not SETTINGS.hash_inputs:
+        return
+    if digest is None:
+        digest = hash_file(filename)
+    RUN.replace('inputs', filename, (filename, digest))
+    _checkpoint()
 
 
 def log_exception(typ, value, traceback):
-    if option_set('general', 'debug'):
+    if SETTINGS.debug:
         print("Logging exception %s" % value)
     exception = {'type': typ.__name__,
                  'message': str(value),
                  'traceback': ''.join(format_tb(traceback))}
-    # Update object in DB
-    db = open_or_create_db()
-    db.update({"exception": exception}, doc_ids=[RUN_ID])
-    db.close()
+    # The script is about to die, so save the record right away (the
+    # exceptions of child processes are not those of the run)
+    if not RUN.in_child:
+        RUN.set("exception", exception)
+        _save_run()
     # Done logging, call default exception handler
     sys.__excepthook__(typ, value, traceback)
 
 
 def log_warning(msg, typ, script, lineno, file=None, line=None):
-    if option_set('general', 'debug'):
+    if SETTINGS.debug:
         print('Logging warning "%s"' % str(msg))
 
     warning = {
@@ -232,155 +477,346 @@ def log_warning(msg, typ, script, lineno, file=None, line=None):
         'lineno': lineno
     }
 
-    # Update object in DB
-    db = open_or_create_db()
-    db.update(append("warnings", warning, no_duplicates=True), doc_ids=[RUN_ID])
-    db.close()
+    RUN.append("warnings", warning)
+    _checkpoint()
 
     # Done logging, print warning to stderr
     sys.stderr.write(warnings.formatwarning(msg, typ, script, lineno, line=line))
 
 
-def add_module_to_db(modulename, input_functions, output_functions,
-                     db_path=get_db_path()):
-    db = open_or_create_db(path=db_path)
-    patches = db.table('patches')
-    patches.insert({'modulename': modulename,
+def add_module_to_db(modulename, input_functions, output_functions):
+    """Add a module to the registry of patched modules.
+
+    The registry is written to the database when the run is saved (only if it
+    differs from the one that is there), so importing recipy doesn't write
+    to the database at all.
+    """
+    PATCHES.append({'modulename': modulename,
                     'input_functions': input_functions,
                     'output_functions': output_functions})
-    db.close()
 
 
-def add_file_diff_to_db(filename, tempfilename, db):
-    diffs = db.table('filediffs')
-    diffs.insert({'run_id': RUN_ID,
-                  'filename': filename,
-                  'tempfilename': tempfilename})
+def _is_binary(filename):
+    # binaryornot is only needed when file diffs are enabled
+    from binaryornot.check import is_binary
+    return is_binary(filename)
 
 
-def append(field, value, no_duplicates=False):
-    """
-    Append a given value to a given array field.
-    Keep an eye on https://github.com/msiemens/tinydb/issues/66
+def _save_run(file_diffs=False):
+    """Write the in-memory run record to the database in a single update.
+
+    Pending file diffs are only stored when `file_diffs` is True, because they
+    are not complete until `output_file_diffs` has run.
+
+    The first save inserts the run (and updates the registry of patched
+    modules), so importing recipy doesn't write to the database.
+
+    Child processes never write to the database; their events are merged
+    into the run of the script by `log_flush`.
     """
-    def transform(element):
-        if no_duplicates and value in element[field]:
-            pass
-        else:
-            element[field].append(value)
+    global RUN_ID
+    if RUN.in_child:
+        return
+    # Other threads wait, so they don't change the run while it is written
+    with RUN.lock:
+        db = open_storage()
+        _save_patches(db)
+        # Large text fields are stored once in the blob store (if it is
+        # enabled), the run refers to them
+        blobs = get_blob_store()
+        RUN_ID = RUN.run_id = save_run(db, RUN_ID, RUN.run, blobs)
+        if file_diffs and RUN.file_diffs:
+            # File diffs may have been added before the run had an id
+            for file_diff in RUN.file_diffs:
+                file_diff['run_id'] = RUN_ID
+            save_file_diffs(db, RUN.file_diffs, blobs)
+            RUN.file_diffs = []
+        db.close()
+        RUN.mark_saved()
+
+
+def _save_patches(db):
+    """Update the registry of patched modules, if it has changed."""
+    global _PATCHES_SAVED
+    if _PATCHES_SAVED:
+        return
 
-    return transform
+    def key(p):
+        return p['modulename']
+    if sorted(db.get_patches(), key=key) != sorted(PATCHES, key=key):
+        db.set_patches(PATCHES)
+    _PATCHES_SAVED = True
 
 
-def add_dict(field, dict_of_values):
+def _checkpoint():
+    """Save the run record if a periodic checkpoint is due."""
+    if RUN.in_child:
+        return
+    with RUN.lock:
+        _collect_input_hashes()
+        if VCS_INFO is not None and VCS_INFO.done():
+            _finish_vcs_info()
+        if RUN.checkpoint_due():
+            _save_run()
+
+
+def _hash_service():
+    global HASH_SERVICE
+    if HASH_SERVICE is None or not HASH_SERVICE.alive():
+        HASH_SERVICE = HashService(get_hash_threads())
+        if RUN.in_child:
+            _flush_at_child_exit()
+    return HASH_SERVICE
+
+
+def _flush_at_child_exit():
+    """Make a child process forward the input hashes it computes in the
+    background before it exits.
+
+    Forked multiprocessing workers don't run atexit handlers (see
+    `log_flush`), but they do run the finalizers of multiprocessing.
     """
-    Add a given dict of values to a given array field.
+    multiprocessing = sys.modules.get('multiprocessing')
+    if multiprocessing is not None:
+        from multiprocessing.util import Finalize
+        Finalize(None, _flush_child, exitpriority=10)
+
+
+def _flush_child():
+    """Wait for the inputs a child process hashes in the background, and
+    forward their hashes to the run (through the journal of the child)."""
+    if RUN is not None and RUN.in_child:
+        _finish_input_hashes()
+
+
+def _collect_input_hashes():
+    """Add the input hashes computed in the background to the record.
+
+    The record is only changed here, on the thread that logs the run.
     """
-    def transform(element):
-        assert isinstance(element[field], dict), \
-            "add_dict called on a non-dict object. type(element[%s]) = %s" % (field, type(element[field]))
-        element[field].update(dict_of_values)
+    if HASH_SERVICE is None or not HASH_SERVICE.alive():
+        return
+    for path, digest, modified in HASH_SERVICE.results():
+        RUN.replace('inputs', path, (path, digest))
+        if modified:
+            RUN.append('modified_inputs', path)
 
-    return transform
+
+def _finish_vcs_info():
+    """Wait for the git/svn information and add it to the record."""
+    global VCS_INFO
+    if VCS_INFO is None or not VCS_INFO.alive():
+        return
+    info = VCS_INFO.result()
+    VCS_INFO = None
+    for key, value in info.items():
+        RUN.set(key, value)
+
+
+def _finish_input_hashes():
+    """Wait (at most hash_timeout seconds) for the inputs that are being
+    hashed in the background."""
+    if HASH_SERVICE is None or not HASH_SERVICE.alive():
+        return
+    if not HASH_SERVICE.wait(get_hash_timeout()):
+        warnings.warn('recipy: gave up waiting for the hashes of %d input '
+                      'files' % len(HASH_SERVICE.pending()))
+    _collect_input_hashes()
 
 
 # atexit functions will run on script exit (even on exception)
 @atexit.register
 def log_flush():
+    if RUN is None or RUN.finished:
+        return
+    if RUN.in_child:
+        _flush_child()
+        return
+    _merge_child_events()
     log_exit()
-    dedupe_inputs()
+
+    if option_set('general', 'detach_finalizer') and hasattr(os, 'fork'):
+        # Leave the hashing, file diffs and final write to a detached
+        # process, so the script can exit right away. Until it is done, the
+        # run is marked as finalizing.
+        _finish_vcs_info()
+        _collect_input_hashes()
+        RUN.set('finalizing', True)
+        _save_run()
+        try:
+            detached = _detach()
+        except OSError:
+            detached = None
+        if detached is False:
+            RUN.finished = True
+            if RUN.journal is not None:
+                RUN.journal.close()
+            return
+        elif detached:
+            RUN.claim()
+            if RUN.journal is not None:
+                RUN.journal.claim()
+            if SNAPSHOTS is not None:
+                SNAPSHOTS.claim(RUN.pid)
+            try:
+                _finalize()
+            finally:
+                # Don't run the rest of the exit handlers of the script
+                os._exit(0)
+
+    _finalize()
+
+
+def _detach():
+    """Fork a detached process (double fork, so it is not a child of the
+    script and can't become a zombie).
+
+    Returns True in the detached process and False in the original process.
+    """
+    # Don't let buffered output be written twice
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pid = os.fork()
+    if pid > 0:
+        _, status = os.waitpid(pid, 0)
+        if status != 0:
+            raise OSError('Could not start the finalizer process')
+        return False
+
+    try:
+        os.setsid()
+        if os.fork() > 0:
+            os._exit(0)
+        # Release the pipes of the script, so whoever reads its output
+        # doesn't wait for the finalizer
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in (0, 1, 2):
+            os.dup2(devnull, fd)
+    except Exception:
+        os._exit(1)
+    return True
+
+
+def _finalize():
+    """Compute what is only known at exit and store the finished run."""
+    _finish_vcs_info()
+    _finish_library_versions()
+    _finish_input_hashes()
     hash_outputs()
+    dedupe_inputs()
     output_file_diffs()
+    if RUN.run.get('finalizing'):
+        RUN.set('finalizing', False)
+    # Everything is known now, so store the whole run with a single write.
+    # This also compacts the journal: once the run is in the DB the journal
+    # is no longer needed.
+    _save_run(file_diffs=True)
+    RUN.finished = True
+    if RUN.journal is not None:
+        RUN.journal.remove()
 
 
 def log_exit():
     # Update the record with the timestamp of the script's completion.
     # We don't save the duration because it's harder to serialize a timedelta.
-    if option_set('general', 'debug'):
+    if SETTINGS.debug:
         print("recipy run complete")
-    exit_date = datetime.datetime.utcnow()
-    db = open_or_create_db()
-    db.update({'exit_date': exit_date}, doc_ids=[RUN_ID])
-    db.close()
+    RUN.set('exit_date', datetime.datetime.utcnow())
 
 
 def hash_outputs():
     # Writing to output files is complete; we can now compute hashes.
-    if option_set('ignored metadata', 'output_hashes'):
+    # Deferred input hashes are computed in the same pass, so all files are
+    # hashed on one thread pool.
+    # Outputs that were hashed while they were written (see recipy.open)
+    # are not read again, unless they were modified after they were closed.
+    hash_out = SETTINGS.hash_outputs
+    hash_in = SETTINGS.hash_inputs
+
+    hashes = {}
+    paths = []
+    if hash_out:
+        for filename in RUN.run.get('outputs'):
+            digest, signature = RUN.streamed_hashes.get(filename,
+                                                        (None, None))
+            if digest is not None and stat_signature(filename) == signature:
+                hashes[filename] = digest
+            else:
+                paths.append(filename)
+    if hash_in:
+        # Inputs whose hashes were deferred (but not those that are still
+        # being hashed in the background after hash_timeout)
+        pending = ()
+        if HASH_SERVICE is not None and HASH_SERVICE.alive():
+            pending = HASH_SERVICE.pending()
+        paths.extend(f for f in RUN.run.get('inputs')
+                     if isinstance(f, six.string_types) and f not in pending)
+    if not paths and not hashes:
         return
 
-    db = open_or_create_db()
-    run = db.get(doc_id=RUN_ID)
-    new_outputs = [(filename, hash_file(filename))
-                   for filename in run.get('outputs')]
-    db.update({'outputs': new_outputs}, doc_ids=[RUN_ID])
-    db.close()
+    hashes.update(hash_files(paths, threads=get_hash_threads(),
+                             threads_per_device=get_hash_threads_per_device(),
+                             cache=get_hash_cache()))
+
+    if hash_out:
+        RUN.set('outputs', [(filename, hashes[filename])
+                            for filename in RUN.run.get('outputs')])
+    if hash_in:
+        # Inputs still being hashed after hash_timeout are stored without
+        # a hash
+        RUN.set('inputs', [(f, hashes[f])
+                           if isinstance(f, six.string_types) and
+                           f in hashes else f
+                           for f in RUN.run.get('inputs')])
 
 
 def output_file_diffs():
     # Writing to output files is complete; we can now compute file diffs.
-    if not option_set('data', 'file_diff_outputs'):
+    if not SETTINGS.file_diff_outputs:
         return
 
-    encodings = ['utf-8', 'latin-1']
+    # Cloned snapshots are not checked when they are taken
+    RUN.file_diffs = [item for item in RUN.file_diffs
+                      if os.path.isfile(item['tempfilename']) and
+                      not _is_binary(item['tempfilename'])]
+    if SETTINGS.debug:
+        for item in RUN.file_diffs:
+            print('Storing file diff for "%s"' % item['filename'])
 
-    with open_or_create_db() as db:
-        diffs_table = db.table('filediffs')
-        diffs = diffs_table.search(Query().run_id == RUN_ID)
+    # All diffs are computed at once (in parallel, with a time limit per
+    # file), and stored with the run by `_save_run`
+    diffs = diff_files([(item['tempfilename'], item['filename'])
+                        for item in RUN.file_diffs],
+                       processes=get_file_diff_processes(),
+                       timeout=get_file_diff_timeout(),
+                       limit=get_file_diff_limit())
+    for item, diff in zip(RUN.file_diffs, diffs):
+        if diff is not None:
+            item['diff'] = diff
 
-    for item in diffs:
-        if option_set('general', 'debug'):
-            print('Storing file diff for "%s"' % item['filename'])
+    _remove_snapshots()
 
-        lines1 = None
-        lines2 = None
-        for enc in encodings:
-            try:
-                with codecs.open(item['tempfilename'], encoding=enc) as f:
-                    lines1 = f.readlines()
-            except UnicodeDecodeError:
-                pass
 
-            try:
-                with codecs.open(item['filename'], encoding=enc) as f:
-                    lines2 = f.readlines()
-            except UnicodeDecodeError:
-                pass
-
-        if lines1 is not None and lines2 is not None:
-            diff = difflib.unified_diff(lines1,
-                                        lines2,
-                                        fromfile='before this run',
-                                        tofile='after this run')
-            with open_or_create_db() as db:
-                diffs_table.update({'diff': ''.join([l for l in diff])},
-                                   doc_ids=[item.doc_id])
-        else:
-            msg = ('Unable to read file "{}" using supported encodings ({}). '
-                   'To be able to store file diffs, use one of the supported '
-                   'encodings to write the output file.')
-            warnings.warn(msg.format(item['filename'], ', '.join(encodings)))
-
-        # delete temporary file
-        os.remove(item['tempfilename'])
+def _remove_snapshots():
+    global SNAPSHOTS
+    if SNAPSHOTS is None and RUN is not None and RUN.file_diffs:
+        # The snapshots were taken by child processes
+        SNAPSHOTS = RunSnapshots(RUN.run['unique_id'])
+    if SNAPSHOTS is not None:
+        SNAPSHOTS.remove()
+        SNAPSHOTS = None
 
 
 def dedupe_inputs():
     """Remove inputs that are logged muliple times.
 
     Sometimes patched libraries use other patched libraries to open files.
-    E.g., xarray internally uses netCDF4 to open netcdf files. If this happens,
-    and recipy is configured to log file hashes, inputs are logged multiple
-    times. Hashed inputs are stored as a list in the database, and tinydb does
-    not automatically dedupe lists.
-
-    Outputs do not need to be deduped, because file hashed are added after the
-    run is finished, and tinydb can automatically dedupe strings.
+    E.g., xarray internally uses netCDF4 to open netcdf files. `RUN.append`
+    ignores duplicates, but a file that was logged both with its hash and
+    without (deferred) appears twice once the deferred hashes are filled in.
+    Order is preserved.
     """
-    if option_set('ignored metadata', 'input_hashes'):
-        return
-    db = open_or_create_db()
-    run = db.get(doc_id=RUN_ID)
-    new_inputs = list(set([tuple(inp) for inp in run['inputs']]))
-    db.update({'inputs': new_inputs}, doc_ids=[RUN_ID])
-    db.close()
+    inputs = RUN.run.get('inputs') or []
+    new_inputs = UniqueList(inputs)
+    if len(new_inputs) != len(inputs):
+        RUN.set('inputs', new_inputs)
@@ -0,0 +1,168 @@
+import os
+import time
+import threading
+
+from recipyCommon.utils import UniqueList
+
+
+class RunRecord(object):
+    """In-memory accumulator for the run that is currently being logged.
+
+    Inputs, outputs, libraries, warnings and custom values are collected here
+    instead of being written to the database on every event. The record is
+    persisted once, when the script exits (see `recipy.log.log_flush`), and
+    optionally at periodic checkpoints, so a crash does not lose everything.
+
+    A checkpoint is due when the record has unsaved changes and either
+    `checkpoint_interval` seconds have passed since the last save or
+    `checkpoint_events` events have been logged since then. Zero (or a
+    negative value) disables the corresponding trigger.
+
+    If a `journal` (see `recipyCommon.journal.RunJournal`) is given, every
+    change is also appended to it, so the run survives a crash.
+
+    The record can be changed from several threads; changes are made under
+    `lock`. It belongs to the process `pid` (the script). In other processes
+    (e.g., forked multiprocessing workers, which inherit the record) changes
+    are appended to the journal returned by `child_journal(pid)` instead; the
+    script adds them to its own record with `merge`.
+    """
+    def __init__(self, run, run_id, checkpoint_interval=0,
+                 checkpoint_events=0, journal=None, pid=None,
+                 child_journal=None):
+        self.run = run
+        self.run_id = run_id
+        self.journal = journal
+        self.pid = os.getpid() if pid is None else pid
+        self.child_journal = child_journal
+        self.lock = threading.RLock()
+        self.checkpoint_interval = checkpoint_interval
+        self.checkpoint_events = checkpoint_events
+        # File diffs that still have to be computed and stored
+        self.file_diffs = []
+        # Hashes of outputs computed while they were written (see
+        # recipy.open), with the stat signature of the file when it was closed
+        self.streamed_hashes = {}
+        self.finished = False
+
+        self._dirty = False
+        self._events = 0
+        self._last_checkpoint = time.time()
+        # (pid, journal) of the child process that forwards the events
+        self._forwarding = None
+
+    def _values(self, field):
+        # Lists of the run are UniqueLists, so appending is O(1); a list that
+        # was set with `set` is converted the first time it is appended to
+        values = self.run.get(field)
+        if not isinstance(values, UniqueList):
+            values = self.run[field] = UniqueList(values or [])
+        return values
+
+    def append(self, field, value):
+        """Append `value` to the list `field`, ignoring duplicates."""
+        with self.lock:
+            if self._values(field).add(value):
+                self._touch('append', field=field, value=value)
+
+    def extend(self, field, values):
+        """Append `values` to the list `field`, ignoring duplicates, as a
+        single event."""
+        with self.lock:
+            target = self._values(field)
+            added = [value for value in values if target.add(value)]
+            if added:
+                self._touch('extend', count=len(added), field=field,
+                            values=added)
+
+    def replace(self, field, old, new):
+        """Replace `old` in the list `field` (or remove it, if `new` is in the
+        list already)."""
+        with self.lock:
+            if self._values(field).replace(old, new):
+                self._touch('replace', field=field, old=old, value=new)
+
+    def update_dict(self, field, dict_of_values):
+        """Add a dict of values to the dict `field`."""
+        assert isinstance(self.run[field], dict), \
+            "update_dict called on a non-dict object. type(run[%s]) = %s" % \
+            (field, type(self.run[field]))
+        with self.lock:
+            self.run[field].update(dict_of_values)
+            self._touch('update', field=field, value=dict_of_values)
+
+    def set(self, field, value):
+        with self.lock:
+            self.run[field] = value
+            self._touch('set', field=field, value=value)
+
+    def add_file_diff(self, filename, tempfilename):
+        file_diff = {'run_id': self.run_id,
+                     'filename': filename,
+                     'tempfilename': tempfilename}
+        with self.lock:
+            self.file_diffs.append(file_diff)
+            self._touch('filediff', value=file_diff)
+
+    def merge(self, events):
+        """Apply the events forwarded by child processes (see
+        `recipyCommon.journal.read_child_journals`) to the record."""
+        with self.lock:
+            for e in events:
+                event = e['event']
+                if event == 'append':
+                    self.append(e['field'], e['value'])
+                elif event == 'extend':
+                    self.extend(e['field'], e['values'])
+                elif event == 'replace':
+                    self.replace(e['field'], e['old'], e['value'])
+                elif event == 'update':
+                    self.run.setdefault(e['field'], {})
+                    self.update_dict(e['field'], e['value'])
+                elif event == 'filediff':
+                    self.add_file_diff(e['value']['filename'],
+                                       e['value']['tempfilename'])
+
+    @property
+    def in_child(self):
+        """True in a process other than the one the record belongs to."""
+        return os.getpid() != self.pid
+
+    def claim(self):
+        """Make the current process the owner of the record (e.g., after the
+        finalizer was detached)."""
+        self.pid = os.getpid()
+        self._forwarding = None
+
+    def _touch(self, event, count=1, **data):
+        self._dirty = True
+        self._events += count
+        if self.in_child and self.child_journal is not None:
+            # The journal of the parent is not ours to write to
+            pid = os.getpid()
+            if self._forwarding is None or self._forwarding[0] != pid:
+                self._forwarding = (pid, self.child_journal(pid))
+            self._forwarding[1].write(event, **data)
+        elif self.journal is not None:
+            self.journal.write(event, **data)
+
+    @property
+    def dirty(self):
+        return self._dirty
+
+    def checkpoint_due(self):
+        """Return True if the record should be written to the database now."""
+        if not self._dirty:
+            return False
+        interval = self.checkpoint_interval
+        if interval > 0 and time.time() - self._last_checkpoint >= interval:
+            return True
+        max_events = self.checkpoint_events
+        if max_events > 0 and self._events >= max_events:
+            return True
+        return False
+
+    def mark_saved(self):
+        self._dirty = False
+        self._events = 0
+        self._last_checkpoint = time.time()
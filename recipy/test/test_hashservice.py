@@ -0,0 +1,69 @@
+import os
+import shutil
+import hashlib
+import tempfile
+import threading
+import unittest
+
+import mock
+
+from recipy.hashservice import HashService
+
+
+class TestHashService(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.paths = []
+        for i in range(5):
+            path = os.path.join(self.dir, 'f%d.txt' % i)
+            with open(path, 'w') as f:
+                f.write('data %d' % i)
+            self.paths.append(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def sha1(self, path):
+        with open(path, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+
+    def test_hashes_in_background(self):
+        service = HashService(threads=2)
+        for path in self.paths:
+            service.submit(path)
+
+        self.assertTrue(service.wait(timeout=10))
+        results = service.results()
+
+        self.assertEqual(sorted(results),
+                         sorted((p, self.sha1(p), False)
+                                for p in self.paths))
+        self.assertEqual(service.results(), [])
+        self.assertEqual(service.pending(), set())
+
+    def test_modified_file_is_flagged(self):
+        service = HashService()
+        path = self.paths[0]
+        signatures = iter([(1, 1, 1, 1), (1, 1, 2, 2)])
+        with mock.patch('recipy.hashservice.stat_signature',
+                        side_effect=lambda p: next(signatures)):
+            service.submit(path)
+            service.wait(timeout=10)
+
+        self.assertEqual(service.results(), [(path, self.sha1(path), True)])
+
+    def test_wait_timeout(self):
+        service = HashService()
+        release = threading.Event()
+
+        def slow_hash(path, cache):
+            release.wait()
+            return 'x'
+
+        with mock.patch('recipy.hashservice.cached_hash_file',
+                        side_effect=slow_hash):
+            service.submit(self.paths[0])
+            self.assertFalse(service.wait(timeout=0.05))
+            self.assertEqual(service.pending(), set([self.paths[0]]))
+            release.set()
+            self.assertTrue(service.wait(timeout=10))
@@ -1,8 +1,21 @@
 import os
+import shutil
+import tempfile
+import hashlib
 import unittest
+import threading
+import multiprocessing
 import mock
+from six.moves.configparser import RawConfigParser
 
-from recipy.log import open_or_create_db, log_values, log_init
+import recipy.log
+from recipy.log import log_values, log_init, log_input, hash_outputs, \
+    _save_run, log_inputs_batch, log_outputs_batch
+from recipyCommon.storage import open_storage
+from recipyCommon.config import Settings
+from recipyCommon.utils import open_or_create_db
+from recipyCommon.libraryversions import get_version
+from recipy.runrecord import RunRecord
 
 
 TEST_DB_PATH = os.path.expanduser('~/.recipy/test_recipyDB.json')
@@ -12,15 +25,27 @@ def open_or_create_test_db():
     return open_or_create_db(TEST_DB_PATH)
 
 
+def open_test_storage():
+    return open_storage(TEST_DB_PATH, backend='tinydb')
+
+
+def make_settings(*option):
+    config = RawConfigParser(allow_no_value=True)
+    config.add_section(option[0])
+    config.set(option[0], option[1], None)
+    return Settings(config)
+
+
 class TestLog(unittest.TestCase):
     def setUp(self):
         """ Invoke log_init with the test database, so as not to interfere with the regular database """
-        with mock.patch('recipy.log.open_or_create_db', open_or_create_test_db):
+        with mock.patch('recipy.log.open_storage', open_test_storage):
             log_init()
 
     def test_log_values_single_dictionary(self):
-        with mock.patch('recipy.log.open_or_create_db', open_or_create_test_db):
+        with mock.patch('recipy.log.open_storage', open_test_storage):
             log_values({'a': 1, 'b': 2})
+            _save_run()
 
         db = open_or_create_test_db()
         last_entry = db.all()[-1]
@@ -29,10 +54,11 @@ class TestLog(unittest.TestCase):
         self.assertEquals(last_entry['custom_values'], {'a': 1, 'b': 2})
 
     def test_log_values_multiple_dictionaries(self):
-        with mock.patch('recipy.log.open_or_create_db', open_or_create_test_db):
+        with mock.patch('recipy.log.open_storage', open_test_storage):
             log_values({'a': 1, 'b': 2})
             log_values({'a': 3, 'b': 4})
             log_values({'c': 5, 'd': 6})
+            _save_run()
 
         db = open_or_create_test_db()
         last_entry = db.all()[-1]
@@ -41,8 +67,9 @@ class TestLog(unittest.TestCase):
         self.assertEquals(last_entry['custom_values'], {'a': 3, 'b': 4, 'c': 5, 'd': 6})
 
     def test_log_values_keyword_arguments(self):
-        with mock.patch('recipy.log.open_or_create_db', open_or_create_test_db):
+        with mock.patch('recipy.log.open_storage', open_test_storage):
             log_values(cat=1, dog=2)
+            _save_run()
 
         db = open_or_create_test_db()
         last_entry = db.all()[-1]
@@ -51,11 +78,287 @@ class TestLog(unittest.TestCase):
         self.assertEquals(last_entry['custom_values'], {'cat': 1, 'dog': 2})
 
     def test_log_values_dict_and_keyword_arguments(self):
-        with mock.patch('recipy.log.open_or_create_db', open_or_create_test_db):
+        with mock.patch('recipy.log.open_storage', open_test_storage):
             log_values({'bananas': 3, 'pears': 4}, apples=1, oranges=2)
+            _save_run()
 
         db = open_or_create_test_db()
         last_entry = db.all()[-1]
 
         self.assertIn('custom_values', last_entry)
         self.assertEquals(last_entry['custom_values'], {'bananas': 3, 'pears': 4, 'apples':1, 'oranges':2})
+
+    def test_log_values_is_buffered(self):
+        with mock.patch('recipy.log.open_storage', open_test_storage):
+            log_values({'a': 1, 'b': 2})
+
+        # Nothing is written before the run is saved, not even the run
+        unique_id = recipy.log.RUN.run['unique_id']
+        self.assertIsNone(open_test_storage().get_run_by_unique_id(unique_id))
+
+        with mock.patch('recipy.log.open_storage', open_test_storage):
+            _save_run()
+        run = open_test_storage().get_run_by_unique_id(unique_id)
+        self.assertEquals(run['custom_values'], {'a': 1, 'b': 2})
+
+    def test_deferred_input_hashes(self):
+        with tempfile.NamedTemporaryFile(delete=False) as f:
+            f.write(b'some input')
+        self.addCleanup(os.remove, f.name)
+
+        with mock.patch('recipy.log.SETTINGS', make_settings('data', 'defer_input_hashes')):
+            log_input(f.name, 'test')
+            self.assertEquals(recipy.log.RUN.run['inputs'], [f.name])
+
+            hash_outputs()
+
+        expected = hashlib.sha1(b'some input').hexdigest()
+        self.assertEquals(recipy.log.RUN.run['inputs'], [(f.name, expected)])
+
+    def test_async_input_hashes(self):
+        with tempfile.NamedTemporaryFile(delete=False) as f:
+            f.write(b'some input')
+        self.addCleanup(os.remove, f.name)
+
+        with mock.patch('recipy.log.SETTINGS', make_settings('data', 'async_input_hashes')):
+            log_input(f.name, 'test')
+            recipy.log._finish_input_hashes()
+
+        expected = hashlib.sha1(b'some input').hexdigest()
+        self.assertEquals(recipy.log.RUN.run['inputs'], [(f.name, expected)])
+        self.assertNotIn('modified_inputs', recipy.log.RUN.run)
+
+    def test_pending_input_hashes_are_not_required(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        paths = []
+        for name in ['in.txt', 'out.txt']:
+            paths.append(os.path.join(tmpdir, name))
+            with open(paths[-1], 'wb') as f:
+                f.write(name.encode())
+
+        # The input is still being hashed in the background when
+        # hash_timeout expires
+        service = mock.Mock()
+        service.alive.return_value = True
+        service.pending.return_value = {paths[0]}
+        recipy.log.RUN.set('inputs', [paths[0]])
+        recipy.log.RUN.set('outputs', [paths[1]])
+        self.addCleanup(recipy.log.RUN.set, 'outputs', [])
+        with mock.patch('recipy.log.HASH_SERVICE', service):
+            hash_outputs()
+
+        self.assertEquals(recipy.log.RUN.run['inputs'], [paths[0]])
+        self.assertEquals(recipy.log.RUN.run['outputs'],
+                          [(paths[1], hashlib.sha1(b'out.txt').hexdigest())])
+
+    def test_library_versions_are_looked_up_at_exit(self):
+        log_outputs_batch(['out1.nc'], 'recipy.open')
+
+        self.assertEquals(recipy.log.RUN.run['libraries'][-1], 'recipy')
+        recipy.log._finish_library_versions()
+        self.assertEquals(recipy.log.RUN.run['libraries'],
+                          [get_version('recipy')])
+
+    def test_log_inputs_batch(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        paths = []
+        for name in ['b.nc', 'a.nc', 'c.txt']:
+            paths.append(os.path.join(tmpdir, name))
+            with open(paths[-1], 'wb') as f:
+                f.write(name.encode())
+
+        log_inputs_batch([os.path.join(tmpdir, '*.nc'), [paths[2]]], 'test')
+
+        self.assertEquals(recipy.log.RUN.run['inputs'],
+                          [(os.path.join(tmpdir, name),
+                            hashlib.sha1(name.encode()).hexdigest())
+                           for name in ['a.nc', 'b.nc', 'c.txt']])
+
+    def test_log_outputs_batch(self):
+        log_outputs_batch(['out1.nc', 'out2.nc', 'out1.nc'], 'test')
+
+        self.assertEquals(recipy.log.RUN.run['outputs'],
+                          [os.path.abspath('out1.nc'),
+                           os.path.abspath('out2.nc')])
+
+    def test_detach_finalizer_parent(self):
+        def options(section, name):
+            return (section, name) == ('general', 'detach_finalizer')
+
+        with mock.patch('recipy.log.open_storage', open_test_storage), \
+                mock.patch('recipy.log.option_set', side_effect=options), \
+                mock.patch('recipy.log._detach', return_value=False), \
+                mock.patch('recipy.log.hash_outputs') as hash_outputs:
+            recipy.log.log_flush()
+
+        self.assertFalse(hash_outputs.called)
+        self.assertTrue(recipy.log.RUN.finished)
+        last_entry = open_or_create_test_db().all()[-1]
+        self.assertTrue(last_entry['finalizing'])
+
+    def test_detach_finalizer_child(self):
+        def options(section, name):
+            return (section, name) == ('general', 'detach_finalizer')
+
+        with mock.patch('recipy.log.open_storage', open_test_storage), \
+                mock.patch('recipy.log.option_set', side_effect=options), \
+                mock.patch('recipy.log._detach', return_value=True), \
+                mock.patch('recipy.log.os._exit') as exit:
+            recipy.log.log_flush()
+
+        exit.assert_called_once_with(0)
+        last_entry = open_or_create_test_db().all()[-1]
+        self.assertFalse(last_entry['finalizing'])
+        self.assertIn('exit_date', last_entry)
+
+    @unittest.skipUnless('fork' in multiprocessing.get_all_start_methods(),
+                         'processes are not forked on this platform')
+    def test_child_process_events_are_merged(self):
+        with tempfile.NamedTemporaryFile(delete=False) as f:
+            f.write(b'some input')
+        self.addCleanup(os.remove, f.name)
+
+        # The child journals are kept next to a temporary database
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        db_path = os.path.join(tmpdir, 'recipyDB.json')
+
+        context = multiprocessing.get_context('fork')
+        with mock.patch('recipyCommon.journal.get_db_path',
+                        return_value=db_path):
+            process = context.Process(target=log_input, args=(f.name, 'test'))
+            process.start()
+            process.join()
+
+            # The child didn't change the record of the parent
+            self.assertEquals(recipy.log.RUN.run['inputs'], [])
+            self.assertTrue(os.listdir(os.path.join(tmpdir, 'journals')))
+            recipy.log._merge_child_events()
+        expected = hashlib.sha1(b'some input').hexdigest()
+        self.assertEquals(recipy.log.RUN.run['inputs'],
+                          [[f.name, expected]])
+
+    @unittest.skipUnless('fork' in multiprocessing.get_all_start_methods(),
+                         'processes are not forked on this platform')
+    def test_child_process_async_input_hashes_are_merged(self):
+        with tempfile.NamedTemporaryFile(delete=False) as f:
+            f.write(b'some input')
+        self.addCleanup(os.remove, f.name)
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        db_path = os.path.join(tmpdir, 'recipyDB.json')
+
+        # The child hashes its input in the background, and forwards the
+        # hash when it exits
+        context = multiprocessing.get_context('fork')
+        with mock.patch('recipyCommon.journal.get_db_path',
+                        return_value=db_path), \
+                mock.patch('recipy.log.SETTINGS',
+                           make_settings('data', 'async_input_hashes')):
+            process = context.Process(target=log_input, args=(f.name, 'test'))
+            process.start()
+            process.join()
+            recipy.log._merge_child_events()
+
+        expected = hashlib.sha1(b'some input').hexdigest()
+        self.assertEquals(recipy.log.RUN.run['inputs'],
+                          [[f.name, expected]])
+
+    def test_patches_registry_written_once(self):
+        recipy.log._PATCHES_SAVED = False
+        with mock.patch('recipy.log.open_storage', open_test_storage):
+            open_test_storage().reset_patches()
+            log_init()
+            _save_run()
+
+        patches = sorted(m['modulename'] for m in recipy.log.PATCHES)
+        self.assertEqual(sorted(p['modulename'] for p in
+                                open_test_storage().get_patches()), patches)
+
+        with mock.patch('recipy.log.open_storage', open_test_storage), \
+                mock.patch('recipyCommon.tinydb_storage.TinyDBStorage.'
+                           'set_patches') as set_patches:
+            _save_run()
+            recipy.log._PATCHES_SAVED = False
+            log_init()
+            _save_run()
+
+        # The registry is unchanged
+        self.assertFalse(set_patches.called)
+
+
+class TestRunRecord(unittest.TestCase):
+    def test_append_ignores_duplicates(self):
+        record = RunRecord({'inputs': []}, 1)
+        record.append('inputs', ('a.csv', 'hash'))
+        record.append('inputs', ('a.csv', 'hash'))
+
+        self.assertEquals(record.run['inputs'], [('a.csv', 'hash')])
+
+    def test_append_preserves_order(self):
+        record = RunRecord({'inputs': ['b.csv', 'a.csv']}, 1)
+        record.append('inputs', 'c.csv')
+        record.append('inputs', 'b.csv')
+        record.replace('inputs', 'a.csv', ('a.csv', 'hash'))
+
+        self.assertEquals(record.run['inputs'],
+                          ['b.csv', ('a.csv', 'hash'), 'c.csv'])
+
+    def test_checkpoint_not_due_when_clean(self):
+        record = RunRecord({'inputs': []}, 1, checkpoint_events=1)
+
+        self.assertFalse(record.checkpoint_due())
+
+    def test_checkpoint_due_after_events(self):
+        record = RunRecord({'inputs': []}, 1, checkpoint_events=2)
+        record.append('inputs', 'a.csv')
+        self.assertFalse(record.checkpoint_due())
+
+        record.append('inputs', 'b.csv')
+        self.assertTrue(record.checkpoint_due())
+
+        record.mark_saved()
+        self.assertFalse(record.checkpoint_due())
+
+    def test_append_from_threads(self):
+        record = RunRecord({'inputs': []}, 1)
+
+        def work(i):
+            for j in range(1000):
+                record.append('inputs', '{}-{}.csv'.format(i, j))
+        threads = [threading.Thread(target=work, args=(i,))
+                   for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEquals(len(record.run['inputs']), 8000)
+        self.assertEquals(len(set(record.run['inputs'])), 8000)
+
+    def test_child_events_are_forwarded(self):
+        journal = mock.Mock()
+        record = RunRecord({'inputs': []}, 1, pid=os.getpid() + 1,
+                           child_journal=lambda pid: journal)
+        record.append('inputs', 'a.csv')
+
+        self.assertTrue(record.in_child)
+        journal.write.assert_called_once_with('append', field='inputs',
+                                              value='a.csv')
+
+    def test_merge(self):
+        record = RunRecord({'inputs': ['a.csv'], 'custom_values': {}}, 1)
+        record.merge([
+            {'event': 'append', 'field': 'inputs', 'value': 'a.csv'},
+            {'event': 'extend', 'field': 'outputs', 'values': ['b.csv']},
+            {'event': 'update', 'field': 'custom_values', 'value': {'a': 1}},
+            {'event': 'filediff', 'value': {'run_id': 2, 'filename': 'b.csv',
+                                            'tempfilename': 'tmp'}}])
+
+        self.assertEquals(record.run['inputs'], ['a.csv'])
+        self.assertEquals(record.run['outputs'], ['b.csv'])
+        self.assertEquals(record.run['custom_values'], {'a': 1})
+        self.assertEquals(record.file_diffs, [
+            {'run_id': 1, 'filename': 'b.csv', 'tempfilename': 'tmp'}])
@@ -0,0 +1,74 @@
+import os
+import shutil
+import hashlib
+import tempfile
+import unittest
+import warnings
+
+from recipy.utils import open_hashing
+
+
+class TestOpenHashing(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'data.txt')
+        self.data = b'line\n' * 100000
+        with open(self.path, 'wb') as f:
+            f.write(self.data)
+        self.digests = []
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def open(self, *args, **kwargs):
+        return open_hashing(self.digests.append, *args, **kwargs)
+
+    def test_read_text(self):
+        with self.open(self.path) as f:
+            lines = f.readlines()
+
+        self.assertEqual(len(lines), 100000)
+        self.assertEqual(self.digests,
+                         [hashlib.sha1(self.data).hexdigest()])
+
+    def test_partial_read_is_completed(self):
+        with self.open(self.path, 'rb') as f:
+            f.read(10)
+
+        self.assertEqual(self.digests,
+                         [hashlib.sha1(self.data).hexdigest()])
+
+    def test_write(self):
+        with self.open(self.path, 'w') as f:
+            f.write('abc')
+            f.write('def')
+
+        self.assertEqual(self.digests,
+                         [hashlib.sha1(b'abcdef').hexdigest()])
+
+    def test_seek_invalidates_digest(self):
+        with self.open(self.path, 'wb') as f:
+            f.write(b'abc')
+            f.seek(0)
+            f.write(b'x')
+
+        self.assertEqual(self.digests, [None])
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(), b'xbc')
+
+    def test_missing_file(self):
+        with self.assertRaises(IOError):
+            self.open(os.path.join(self.dir, 'missing'))
+        self.assertEqual(self.digests, [])
+
+    def test_close_does_not_raise_when_logging_fails(self):
+        def on_close(digest):
+            raise OSError('removed')
+
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            with open_hashing(on_close, self.path, 'rb') as f:
+                f.read()
+
+        self.assertTrue(f.closed)
+        self.assertIn('could not log the hash', str(caught[-1].message))
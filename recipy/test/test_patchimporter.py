@@ -0,0 +1,63 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+from recipy.PatchImporter import PatchImporter, PatchFinder, PatchLoader
+
+
+class PatchMarker(PatchImporter):
+    def __init__(self, modulename):
+        self.modulename = modulename
+
+    def patch(self, mod):
+        mod.patched = True
+        return mod
+
+
+class TestPatchFinder(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        pkg = os.path.join(self.tmpdir, 'recipy_fakepkg')
+        os.mkdir(pkg)
+        with open(os.path.join(pkg, '__init__.py'), 'w') as f:
+            f.write('loaded = globals().get("loaded", 0) + 1\n')
+        with open(os.path.join(pkg, 'sub.py'), 'w') as f:
+            f.write('def load(path):\n    return path\n')
+        sys.path.insert(0, self.tmpdir)
+
+        self.finder = PatchFinder()
+        sys.meta_path.insert(0, self.finder)
+
+    def tearDown(self):
+        sys.meta_path.remove(self.finder)
+        sys.path.remove(self.tmpdir)
+        for name in ['recipy_fakepkg', 'recipy_fakepkg.sub']:
+            sys.modules.pop(name, None)
+        shutil.rmtree(self.tmpdir)
+
+    def test_other_modules_are_ignored(self):
+        self.assertIsNone(self.finder.find_spec('recipy_fakepkg', None))
+
+    def test_patches_submodule(self):
+        self.finder.patchers['recipy_fakepkg.sub'] = \
+            PatchMarker('recipy_fakepkg.sub')
+
+        import recipy_fakepkg.sub
+
+        self.assertTrue(recipy_fakepkg.sub.patched)
+        self.assertIsInstance(recipy_fakepkg.sub.__loader__, PatchLoader)
+        self.assertEqual(recipy_fakepkg.sub.load('x'), 'x')
+        # The parent package is loaded once, and not patched
+        self.assertEqual(recipy_fakepkg.loaded, 1)
+        self.assertFalse(hasattr(recipy_fakepkg, 'patched'))
+
+    def test_patches_package(self):
+        self.finder.patchers['recipy_fakepkg'] = PatchMarker('recipy_fakepkg')
+
+        import recipy_fakepkg
+
+        self.assertTrue(recipy_fakepkg.patched)
+        # Attributes of the original loader are available
+        self.assertTrue(recipy_fakepkg.__loader__.is_package('recipy_fakepkg'))
@@ -1,6 +1,14 @@
+import io
+import os
+import warnings
+
 import six
 
-from .log import log_input, log_output
+from recipyCommon.config import SETTINGS
+from recipyCommon.hashing import get_algorithm, new_hasher, tag_digest, \
+    use_plain_hash
+
+from .log import log_input, log_output, log_file_hash
 
 
 def open(*args, **kwargs):
@@ -15,16 +23,22 @@ def open(*args, **kwargs):
 
     If python 2 is used, and an `encoding` parameter is passed to this
     function, `codecs` is used to open the file with proper encoding.
+
+    Files that are only read or only written are hashed while the user reads
+    or writes them (see `HashingFileIO`), so they don't have to be read again
+    just to compute their hash.
     """
     try:
         mode = args[1]
     except IndexError:
         mode = kwargs.get('mode', 'r')
 
+    stream_hash = _can_stream_hash(args[0], mode)
+
     # open file for reading?
     for c in 'r+':
         if c in mode:
-            log_input(args[0], 'recipy.open')
+            log_input(args[0], 'recipy.open', defer_hash=stream_hash)
 
     # open file for writing?
     for c in 'wax+':
@@ -37,7 +51,16 @@ def open(*args, **kwargs):
     # opened for writing, its contents will be discarded.
     # TODO: add tests for this
     if six.PY3:
-        f = __builtins__['open'](*args, **kwargs)
+        if stream_hash:
+            output = 'r' not in mode
+            filename = args[0]
+
+            def on_close(digest):
+                log_file_hash(filename, digest, output=output)
+
+            f = open_hashing(on_close, *args, **kwargs)
+        else:
+            f = __builtins__['open'](*args, **kwargs)
     else:
         if 'encoding' in kwargs.keys():
             import codecs
@@ -46,3 +69,174 @@ def open(*args, **kwargs):
             f = __builtins__['open'](*args, **kwargs)
 
     return(f)
+
+
+def _can_stream_hash(filename, mode):
+    """Return True if a file opened with `mode` can be hashed while it is
+    being read or written."""
+    if not six.PY3 or not isinstance(filename, six.string_types):
+        return False
+    # Only files that are either read or written from the start (appending
+    # or updating would only hash part of the file)
+    if not set(mode) <= set('rwxbt') or \
+       len([c for c in mode if c in 'rwx']) != 1:
+        return False
+    if 'r' in mode:
+        if not SETTINGS.hash_inputs:
+            return False
+        try:
+            # Large inputs are fingerprinted or tree-hashed instead
+            return use_plain_hash(filename)
+        except OSError:
+            return False
+    return SETTINGS.hash_outputs
+
+
+class HashingFileIO(io.RawIOBase):
+    """Raw file that hashes the data that is read from or written to it.
+
+    Wraps an `io.FileIO`. As long as the file is read or written sequentially
+    from the start, all data is fed to a hasher. When the file is closed,
+    `on_close` is called with the digest of the file, or None if it can't be
+    known from the data that went through (e.g., after a seek). If a file
+    that is being read is closed before the end, the rest of it is read to
+    complete the digest.
+    """
+    def __init__(self, raw, algorithm, on_close):
+        super(HashingFileIO, self).__init__()
+        self._raw = raw
+        self._algorithm = algorithm
+        self._hasher = new_hasher(algorithm)
+        self._on_close = on_close
+        self._pos = 0
+        self._sequential = True
+
+    @property
+    def name(self):
+        return self._raw.name
+
+    @property
+    def mode(self):
+        return self._raw.mode
+
+    def fileno(self):
+        return self._raw.fileno()
+
+    def isatty(self):
+        return self._raw.isatty()
+
+    def readable(self):
+        return self._raw.readable()
+
+    def writable(self):
+        return self._raw.writable()
+
+    def seekable(self):
+        return self._raw.seekable()
+
+    def tell(self):
+        return self._raw.tell()
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        pos = self._raw.seek(offset, whence)
+        if pos != self._pos:
+            self._sequential = False
+        return pos
+
+    def truncate(self, size=None):
+        self._sequential = False
+        return self._raw.truncate(size)
+
+    def readinto(self, b):
+        n = self._raw.readinto(b)
+        if n and self._sequential:
+            self._hasher.update(memoryview(b)[:n])
+            self._pos += n
+        return n
+
+    def write(self, b):
+        n = self._raw.write(b)
+        if n and self._sequential:
+            self._hasher.update(memoryview(b)[:n])
+            self._pos += n
+        return n
+
+    def _digest(self):
+        if not self._sequential:
+            return None
+        if self._raw.readable():
+            # Hash the part of the file that was not read
+            buf = bytearray(io.DEFAULT_BUFFER_SIZE * 16)
+            n = self._raw.readinto(buf)
+            while n:
+                self._hasher.update(memoryview(buf)[:n])
+                n = self._raw.readinto(buf)
+        return tag_digest(self._algorithm, self._hasher.hexdigest())
+
+    def close(self):
+        if self.closed:
+            return
+        digest = None
+        try:
+            try:
+                digest = self._digest()
+            except (IOError, OSError, ValueError):
+                pass
+        finally:
+            self._raw.close()
+            super(HashingFileIO, self).close()
+        # Logging must never make the close of the file fail (e.g., when an
+        # output was removed right after it was written)
+        try:
+            self._on_close(digest)
+        except Exception as e:
+            warnings.warn('recipy: could not log the hash of {}: {}'
+                          .format(self.name, e))
+
+
+def open_hashing(on_close, file, mode='r', buffering=-1, encoding=None,
+                 errors=None, newline=None, closefd=True, opener=None):
+    """Open a file like the built-in `open`, with a `HashingFileIO` as raw
+    file (mode must be one of r, w or x, in text or binary mode).
+
+    `on_close` is called with the digest of the file when it is closed.
+    """
+    binary = 'b' in mode
+    rawmode = ''.join(c for c in mode if c in 'rwx')
+    if binary and encoding is not None:
+        raise ValueError("binary mode doesn't take an encoding argument")
+    if buffering == 0 and not binary:
+        raise ValueError("can't have unbuffered text I/O")
+
+    fileio = io.FileIO(file, rawmode, closefd, opener=opener)
+    try:
+        raw = HashingFileIO(fileio, get_algorithm(), on_close)
+        line_buffering = False
+        if buffering == 1 or buffering < 0 and raw.isatty():
+            buffering = -1
+            line_buffering = True
+        if buffering < 0:
+            buffering = io.DEFAULT_BUFFER_SIZE
+            try:
+                blksize = os.fstat(raw.fileno()).st_blksize
+            except (OSError, AttributeError):
+                pass
+            else:
+                if blksize > 1:
+                    buffering = blksize
+        if buffering == 0:
+            return raw
+
+        if rawmode == 'r':
+            buffer = io.BufferedReader(raw, buffering)
+        else:
+            buffer = io.BufferedWriter(raw, buffering)
+        if binary:
+            return buffer
+        text = io.TextIOWrapper(buffer, encoding, errors, newline,
+                                line_buffering)
+        text.mode = mode
+        return text
+    except BaseException:
+        fileio.close()
+        raise
@@ -7,6 +7,10 @@ Usage:
   recipy gui [options]
   recipy annotate [<idvalue>]
   recipy pm [--format=<rst|plain>]
+  recipy db compact [--live]
+  recipy db migrate <tinydbfile> <sqlitefile>
+  recipy db gc
+  recipy cache (info | clear)
   recipy (-h | --help)
   recipy --version
 
@@ -17,22 +21,22 @@ Options:
   -f --fuzzy       Use fuzzy searching on filename
   -r --regex       Use regex searching on filename
   -i --id          Search based on (a fragment of) the run ID
+  -s --sampled     Search based on the sampled fingerprint of the file
   -a --all         Show all results (otherwise just latest result given)
   -v --verbose     Be verbose
   -d --diff        Show diff
   -j --json        Show output as JSON
   --no-browser     Do not open browser window
   --debug          Turn on debugging mode
+  --live           Also compact journals of runs that are still running
 
 """
 import os
-import re
 import sys
 import tempfile
 
 from docopt import docopt
 from jinja2 import Template
-from tinydb import where, Query
 from json import dumps
 
 import six
@@ -40,14 +44,21 @@ import six
 from . import __version__
 from recipyCommon import config, utils
 from recipyCommon.config import get_editor
-from recipyCommon.version_control import hash_file
+from recipyCommon.hashing import search_digests, digest_variants
+from recipyCommon.hashcache import HashCache, get_hash_cache
+from recipyCommon.journal import compact_journals
+from recipyCommon.blobstore import open_blob_store, resolve_run, gc_blobs
+from recipyCommon.storage import open_storage
 
 from colorama import init
 init()
 
-db = utils.open_or_create_db()
+db = open_storage()
 
 template_str = """\aRun ID:\b {{ unique_id }}
+{% if finalizing %}
+\aStatus:\b finalizing (output hashes and file diffs are still being computed)
+{% endif %}
 \aCreated by\b {{ author }} on {{ date }} UTC
 \aRan\b {{ script }} using {{ command }}
 {% if command_args|length > 0 %}
@@ -78,6 +89,12 @@ Using command-line arguments: {{ command_args }}
 {% endif %}
 {% endfor %}
 {% endif %}
+{% if modified_inputs is defined %}
+\aModified while being hashed:\b
+{% for input in modified_inputs %}
+{{ input }}
+{% endfor %}
+{% endif %}
 {% if outputs | length == 0 %}
 \aOutputs:\b none
 {% else %}
@@ -128,7 +145,7 @@ def main():
         print('')
         print('Full config file (as interpreted):')
         print('----------------------------------')
-        conf = config.read_config_file()
+        conf = config.conf
         s = six.StringIO()
         conf.write(s)
         print(s.getvalue())
@@ -144,6 +161,10 @@ def main():
         annotate(args)
     elif args['pm']:
         patched_modules(args)
+    elif args['db']:
+        database(args)
+    elif args['cache']:
+        hash_cache(args)
 
 
 def annotate(args):
@@ -151,9 +172,8 @@ def annotate(args):
     editor = get_editor()
 
     if args['<idvalue>']:
-        try:
-            run = db.search(where('unique_id') == args['<idvalue>'])[0]
-        except IndexError:
+        run = db.get_run_by_unique_id(args['<idvalue>'])
+        if run is None:
             print('Could not find id %s' % args['<idvalue>'])
             return
     else:
@@ -192,7 +212,7 @@ def annotate(args):
         return
 
     # Store in the DB
-    db.update({'notes': notes}, where('unique_id') == run['unique_id'])
+    db.update_run(run.run_id, {'notes': notes})
     db.close()
 
 
@@ -241,18 +261,7 @@ def gui(args):
 
 
 def get_latest_run():
-    results = db.all()
-
-    # If no runs in the database
-    if len(results) == 0:
-        return None
-
-    results = [_change_date(result) for result in results]
-
-    # Sort the results
-    results = sorted(results, key=lambda x: x['date'])
-
-    return results[-1]
+    return db.latest_run()
 
 
 def latest(args):
@@ -267,7 +276,8 @@ def latest(args):
             return
 
     if args['--json']:
-        output = dumps(run, indent=2, sort_keys=True, default=utils.json_serializer)
+        output = dumps(resolve_run(run), indent=2, sort_keys=True,
+                       default=utils.json_serializer)
         print(output)
     else:
         print(template_result(run))
@@ -275,55 +285,25 @@ def latest(args):
         if args['--diff']:
             if 'diff' in run:
                 print("\n\n")
-                print(run['diff'])
-
-
-def find_by_hash(x, val):
-    for output in x:
-        if isinstance(output, six.string_types):
-            # If it's just a string it doesn't have a hash
-            # so skip it
-            return False
-        else:
-            test_val = output[1]
-
-        if test_val == val:
-            return True
-
-
-def find_by_filepath(x, val):
-    for output in x:
-        if isinstance(output, six.string_types):
-            test_val = output
-        else:
-            test_val = output[0]
-        if test_val == val:
-            return True
-
-
-def find_by_regex(x, val):
-    for output in x:
-        if isinstance(output, six.string_types):
-            test_val = output
-        else:
-            test_val = output[0]
-        if re.match(val, test_val):
-            return True
+                print(resolve_run(run)['diff'])
 
 
 def search_hash(args):
-    try:
-        hash_value = hash_file(args['<outputfile>'])
-    except Exception:
+    target = args['<outputfile>']
+    if os.path.isfile(target) or os.path.isdir(target):
+        # The database may contain digests made with different algorithms
+        # --sampled forces fingerprints; otherwise they are used if the
+        # file is larger than hash_sample_threshold
+        hash_values = search_digests(target, get_hash_cache(),
+                                     sampled=args['--sampled'] or None)
+    else:
         # Probably an invalid filename/path so assume it is a raw hash value instead
-        hash_value = args['<outputfile>']
+        hash_values = digest_variants(target) or [target]
 
-    Run = Query()
     # Search both outputs AND inputs
     # TODO: Add a command-line argument to force searching of just one
     # of inputs or outputs
-    results = db.search(Run.outputs.test(find_by_hash, hash_value))
-    results += db.search(Run.inputs.test(find_by_hash, hash_value))
+    results = db.find_by_hash(hash_values)
 
     results = sorted(results, key=lambda x: x['date'])
 
@@ -332,9 +312,9 @@ def search_hash(args):
             print('[]')
             return
         if args['--all']:
-            res_to_output = results
+            res_to_output = [resolve_run(r) for r in results]
         else:
-            res_to_output = results[-1]
+            res_to_output = resolve_run(results[-1])
         output = dumps(res_to_output, indent=2, sort_keys=True, default=utils.json_serializer)
         print(output)
     else:
@@ -355,7 +335,7 @@ def search_hash(args):
                 if args['--diff']:
                     if 'diff' in results[-1]:
                         print("\n\n")
-                        print(results[-1]['diff'])
+                        print(resolve_run(results[-1])['diff'])
 
     db.close()
 
@@ -370,22 +350,17 @@ def search(args):
 def search_text(args):
     filename = args['<outputfile>']
 
-    Run = Query()
-
     if args['--fuzzy']:
-        results = db.search(Run.outputs.test(find_by_regex, ".+%s.+" % filename))
-        results += db.search(Run.inputs.test(find_by_regex, ".+%s.+" % filename))
+        results = db.find_by_path_regex(".+%s.+" % filename)
     elif args['--regex']:
-        results = db.search(Run.outputs.test(find_by_regex, filename))
-        results += db.search(Run.inputs.test(find_by_regex, filename))
+        results = db.find_by_path_regex(filename)
     elif args['--id']:
-        results = db.search(where('unique_id').matches('%s.*' % filename))
+        results = db.find_by_id_prefix(filename)
         # Automatically turn on display of all results so we don't misleadingly
         # suggest that their shortened ID is unique when it isn't
         args['--all'] = True
     elif args['--filepath']:
-        results = db.search(Run.outputs.test(find_by_filepath, os.path.abspath(filename)))
-        results += db.search(Run.inputs.test(find_by_filepath, os.path.abspath(filename)))
+        results = db.find_by_path(os.path.abspath(filename))
     else:
         print('Unknown arguments')
         print(__doc__)
@@ -399,9 +374,9 @@ def search_text(args):
             print('[]')
             return
         if args['--all']:
-            res_to_output = results
+            res_to_output = [resolve_run(r) for r in results]
         else:
-            res_to_output = results[-1]
+            res_to_output = resolve_run(results[-1])
         output = dumps(res_to_output, indent=2, sort_keys=True, default=utils.json_serializer)
         print(output)
     else:
@@ -422,18 +397,58 @@ def search_text(args):
                 if args['--diff']:
                     if 'diff' in results[-1]:
                         print("\n\n")
-                        print(results[-1]['diff'])
+                        print(resolve_run(results[-1])['diff'])
 
     db.close()
 
 
-def _change_date(result):
-    result['date'] = str(result['date']).replace('{TinyDate}:', '')
-    return result
+def database(args):
+    if args['compact']:
+        compacted = compact_journals(config.get_db_path(),
+                                     include_live=args['--live'])
+        if len(compacted) == 0:
+            print('No journals to compact')
+        for unique_id in compacted:
+            print('Compacted journal of run %s' % unique_id)
+    elif args['migrate']:
+        from recipyCommon.sqlite_storage import migrate_tinydb
+        try:
+            n = migrate_tinydb(args['<tinydbfile>'], args['<sqlitefile>'])
+        except ValueError as e:
+            print(e)
+            return
+        print('Migrated %d runs from %s to %s' % (n, args['<tinydbfile>'],
+                                                  args['<sqlitefile>']))
+    elif args['gc']:
+        n = gc_blobs(db, open_blob_store())
+        print('Removed %d unreferenced blobs' % n)
+
+
+def hash_cache(args):
+    path = config.get_hash_cache_path()
+    if not os.path.exists(path):
+        print('The hash cache (%s) is empty' % path)
+        return
+    cache = HashCache(path, config.get_hash_cache_size())
+    if args['clear']:
+        n = len(cache)
+        cache.clear()
+        print('Removed %d entries from the hash cache' % n)
+    else:
+        info = cache.info()
+        if not config.option_set('data', 'hash_cache'):
+            print('The hash cache is disabled (add hash_cache to the [data] '
+                  'section of recipyrc to enable it)')
+        print('Path: %s' % info['path'])
+        print('Entries: %d (max. %d)' % (info['entries'],
+                                         info['max_entries']))
+        print('Data hashed: %d bytes' % info['bytes_hashed'])
+        print('Directories: %d' % info['directories'])
+    cache.close()
 
 
 def patched_modules(args):
-    modules = db.table('patches').all()
+    modules = db.get_patches()
     db.close()
 
     fmt = args.get('--format', 'plain')
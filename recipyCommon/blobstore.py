@@ -0,0 +1,260 @@
+"""
+Content-addressed store of large text fields of runs.
+
+Git and svn diffs, file diffs and tracebacks can be large, and consecutive
+runs of a script often have exactly the same diff. With ``blob_store`` in the
+``[database]`` section of recipyrc, text fields of at least
+``blob_threshold`` bytes are not stored in the run itself: the text is
+compressed and stored once in a blob store next to the database
+(``blobs/<name of the database>/``), keyed by its SHA-256 digest, and the
+run holds a reference, a dict like ``{"blob": "sha256:0123...", "size":
+5120}``.
+
+References are only resolved when the text is shown (`resolve_run`,
+`resolve_file_diffs`), so listing and searching runs never reads the blobs.
+Blobs that are no longer referenced by any run are removed with ``recipy db
+gc``.
+"""
+import os
+import time
+import zlib
+import shutil
+import hashlib
+import tempfile
+
+import six
+
+from .config import get_db_path, get_blob_threshold, option_set
+
+BLOB_DIR = 'blobs'
+
+# Fields of runs that are kept in the blob store (the traceback is a field of
+# the exception of the run)
+BLOB_FIELDS = ('diff',)
+
+# Blobs younger than this are never removed by `gc_blobs`: the run that
+# refers to them may not have been written to the database yet
+MIN_AGE = 3600
+
+
+def get_blob_dir(db_path=None):
+    """Return the directory of the blob store of the database."""
+    if db_path is None:
+        db_path = get_db_path()
+    db_path = os.path.abspath(db_path)
+    return os.path.join(os.path.dirname(db_path), BLOB_DIR,
+                        os.path.basename(db_path))
+
+
+def is_blob_ref(value):
+    return isinstance(value, dict) and 'blob' in value and \
+        set(value) <= set(['blob', 'size'])
+
+
+class BlobStore(object):
+    """Compressed text blobs in a directory, keyed by digest."""
+    def __init__(self, path, threshold=1024):
+        self.path = path
+        self.threshold = threshold
+        # References of the texts stored by this process, so a diff that is
+        # saved at every checkpoint is only hashed once
+        self._refs = {}
+
+    def _blob_path(self, digest):
+        hexdigest = digest.split(':', 1)[-1]
+        return os.path.join(self.path, hexdigest[:2], hexdigest[2:])
+
+    def put(self, text):
+        """Store a text and return its reference."""
+        ref = self._refs.get(text)
+        if ref is not None:
+            return ref
+        data = text.encode('utf-8')
+        digest = 'sha256:' + hashlib.sha256(data).hexdigest()
+        path = self._blob_path(digest)
+        if not os.path.exists(path):
+            directory = os.path.dirname(path)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            # Write to a temporary file first, so readers never see a
+            # partial blob
+            fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(zlib.compress(data))
+                os.replace(tmp, path)
+            except Exception:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+                raise
+        ref = {'blob': digest, 'size': len(data)}
+        self._refs[text] = ref
+        return ref
+
+    def get(self, ref):
+        """Return the text of a reference, or None if the blob is missing."""
+        try:
+            with open(self._blob_path(ref['blob']), 'rb') as f:
+                return zlib.decompress(f.read()).decode('utf-8')
+        except (IOError, OSError, zlib.error):
+            return None
+
+    def externalize(self, value):
+        """Return a reference for a text of at least `threshold` bytes, or
+        the value itself."""
+        if isinstance(value, six.string_types) and \
+           len(value) >= self.threshold:
+            return self.put(value)
+        return value
+
+    def resolve(self, value):
+        """Return the text of a value that may be a reference."""
+        if is_blob_ref(value):
+            text = self.get(value)
+            if text is None:
+                return '(missing blob {})'.format(value['blob'])
+            return text
+        return value
+
+    def digests(self):
+        """Iterate over (digest, path) of all stored blobs."""
+        if not os.path.isdir(self.path):
+            return
+        for prefix in sorted(os.listdir(self.path)):
+            directory = os.path.join(self.path, prefix)
+            if not os.path.isdir(directory):
+                continue
+            for name in sorted(os.listdir(directory)):
+                if not name.endswith('.tmp'):
+                    yield ('sha256:' + prefix + name,
+                           os.path.join(directory, name))
+
+
+def open_blob_store(db_path=None):
+    return BlobStore(get_blob_dir(db_path), get_blob_threshold())
+
+
+def get_blob_store(db_path=None):
+    """Return the blob store to write to, or None if it is disabled."""
+    if not option_set('database', 'blob_store'):
+        return None
+    return open_blob_store(db_path)
+
+
+def externalize_run(run, store):
+    """Return a (shallow) copy of the fields of a run, with the large text
+    fields replaced by references."""
+    fields = dict(run)
+    for field in BLOB_FIELDS:
+        if field in fields:
+            fields[field] = store.externalize(fields[field])
+    exception = fields.get('exception')
+    if isinstance(exception, dict) and 'traceback' in exception:
+        exception = dict(exception)
+        exception['traceback'] = store.externalize(exception['traceback'])
+        fields['exception'] = exception
+    return fields
+
+
+def externalize_file_diffs(file_diffs, store):
+    result = []
+    for file_diff in file_diffs:
+        file_diff = dict(file_diff)
+        if 'diff' in file_diff:
+            file_diff['diff'] = store.externalize(file_diff['diff'])
+        result.append(file_diff)
+    return result
+
+
+def save_run(db, run_id, run, store=None):
+    """Write a run to the database (insert it if `run_id` is None), with its
+    large text fields in `store` if it is not None. Returns the run id."""
+    if store is not None:
+        run = externalize_run(run, store)
+    if run_id is None:
+        return db.insert_run(run)
+    db.update_run(run_id, run)
+    return run_id
+
+
+def save_file_diffs(db, file_diffs, store=None):
+    """Add file diffs to the database, with their diffs in `store` if it is
+    not None."""
+    if store is not None:
+        file_diffs = externalize_file_diffs(file_diffs, store)
+    db.add_file_diffs(file_diffs)
+
+
+def resolve_run(run, store=None):
+    """Replace the references in a run by their texts (in place); returns
+    the run."""
+    if run is None:
+        return run
+    if store is None:
+        store = open_blob_store()
+    for field in BLOB_FIELDS:
+        if field in run:
+            run[field] = store.resolve(run[field])
+    exception = run.get('exception')
+    if isinstance(exception, dict) and 'traceback' in exception:
+        exception['traceback'] = store.resolve(exception['traceback'])
+    return run
+
+
+def resolve_file_diffs(file_diffs, store=None):
+    if store is None:
+        store = open_blob_store()
+    for file_diff in file_diffs:
+        if 'diff' in file_diff:
+            file_diff['diff'] = store.resolve(file_diff['diff'])
+    return file_diffs
+
+
+def _run_refs(run):
+    values = [run.get(field) for field in BLOB_FIELDS]
+    exception = run.get('exception')
+    if isinstance(exception, dict):
+        values.append(exception.get('traceback'))
+    return [value['blob'] for value in values if is_blob_ref(value)]
+
+
+def gc_blobs(db, store, min_age=MIN_AGE):
+    """Remove the blobs that are not referenced by any run in `db` (a
+    `recipyCommon.storage.StorageBackend`). Returns the number of removed
+    blobs."""
+    referenced = set()
+    for run in db.iter_runs():
+        referenced.update(_run_refs(run))
+    for file_diff in db.iter_file_diffs():
+        if is_blob_ref(file_diff.get('diff')):
+            referenced.add(file_diff['diff']['blob'])
+
+    removed = 0
+    now = time.time()
+    for digest, path in list(store.digests()):
+        if digest in referenced:
+            continue
+        try:
+            if now - os.path.getmtime(path) < min_age:
+                continue
+            os.remove(path)
+        except OSError:
+            continue
+        removed += 1
+    return removed
+
+
+def copy_blobs(source_db_path, target_db_path):
+    """Copy the blob store of a database to that of another database (e.g.,
+    when it is migrated)."""
+    source = get_blob_dir(source_db_path)
+    if not os.path.isdir(source):
+        return
+    target = get_blob_dir(target_db_path)
+    for prefix in os.listdir(source):
+        directory = os.path.join(target, prefix)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        for name in os.listdir(os.path.join(source, prefix)):
+            if not os.path.exists(os.path.join(directory, name)):
+                shutil.copy2(os.path.join(source, prefix, name), directory)
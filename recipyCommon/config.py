@@ -10,7 +10,11 @@ except:
 import os
 import sys
 
-from distutils.spawn import find_executable
+try:
+    from shutil import which as find_executable
+except ImportError:  # Python 2
+    # Importing distutils can pull in pkg_resources, which is slow
+    from distutils.spawn import find_executable
 
 
 def read_config_file():
@@ -31,20 +35,168 @@ def read_config_file():
     return CONFIG
 
 
-conf = read_config_file()
+# Environment variables that override options have this prefix, followed by
+# the section and the option name (e.g., RECIPY_GENERAL_DEBUG)
+ENV_PREFIX = 'RECIPY_'
+SECTIONS = ['general', 'data', 'database', 'ignored metadata',
+            'ignored inputs', 'ignored outputs']
+# Values of environment variables that unset an option
+FALSE_VALUES = ('', '0', 'false', 'no', 'off')
+
+
+def apply_environment(config, environ=None):
+    """Override options in `config` with environment variables.
+
+    RECIPY_<SECTION>_<OPTION>, where spaces in the section name are replaced
+    by underscores, sets an option (e.g., RECIPY_IGNORED_METADATA_DIFF=1, or
+    RECIPY_DATA_HASH_ALGORITHM=blake2b). A value of 0, false, no, off or the
+    empty string removes the option.
+    """
+    if environ is None:
+        environ = os.environ
+    # Longest first, so `database_path` is not read as `data` `base_path`
+    prefixes = sorted(((s.replace(' ', '_') + '_', s) for s in SECTIONS),
+                      reverse=True)
+    for key, value in environ.items():
+        if not key.startswith(ENV_PREFIX):
+            continue
+        key = key[len(ENV_PREFIX):].lower()
+        for prefix, section in prefixes:
+            if key.startswith(prefix) and len(key) > len(prefix):
+                name = key[len(prefix):]
+                if value.lower() in FALSE_VALUES:
+                    if config.has_section(section):
+                        config.remove_option(section, name)
+                else:
+                    if not config.has_section(section):
+                        config.add_section(section)
+                    config.set(section, name, value)
+                break
+    return config
+
+
+SIZE_SUFFIXES = {'k': 1 << 10, 'm': 1 << 20, 'g': 1 << 30, 't': 1 << 40}
+
+
+def parse_size(value):
+    """Parse a size in bytes, optionally with a suffix (e.g., 500M or 2G)."""
+    value = value.strip().lower().rstrip('b')
+    if value and value[-1] in SIZE_SUFFIXES:
+        return int(float(value[:-1]) * SIZE_SUFFIXES[value[-1]])
+    return int(value)
+
+
+def _parse_option(config, section, name, parse, default):
+    """Return the value of an option converted by `parse` (`default` if it is
+    not set or not valid)."""
+    try:
+        return parse(config.get(section, name))
+    except (Error, AttributeError, TypeError, ValueError):
+        return default
+
+
+class Settings(object):
+    """Read-only snapshot of the configuration, for the code that runs on
+    every logged input or output.
+
+    `options` is the set of (section, option) pairs that are set; the
+    attributes are precomputed from the options that are checked most often.
+    """
+    __slots__ = ('options', 'debug', 'quiet', 'hash_inputs', 'hash_outputs',
+                 'diff', 'file_diff_outputs', 'defer_input_hashes',
+                 'async_input_hashes', 'ignored_inputs', 'ignored_outputs',
+                 'hash_sample_threshold', 'hash_sample_blocks',
+                 'hash_tree_threshold', 'hash_tree_leaf_size')
+
+    def __init__(self, config):
+        options = frozenset((section, name) for section in config.sections()
+                            for name in config.options(section))
+        values = {
+            'options': options,
+            'debug': ('general', 'debug') in options,
+            'quiet': ('general', 'quiet') in options,
+            'hash_inputs': ('ignored metadata', 'input_hashes') not in options,
+            'hash_outputs':
+                ('ignored metadata', 'output_hashes') not in options,
+            'diff': ('ignored metadata', 'diff') not in options,
+            'file_diff_outputs': ('data', 'file_diff_outputs') in options,
+            'defer_input_hashes': ('data', 'defer_input_hashes') in options,
+            'async_input_hashes': ('data', 'async_input_hashes') in options,
+            'ignored_inputs': frozenset(
+                name for section, name in options
+                if section == 'ignored inputs'),
+            'ignored_outputs': frozenset(
+                name for section, name in options
+                if section == 'ignored outputs'),
+            # Files of at least this many bytes are fingerprinted instead of
+            # hashed (0: never), with this number of blocks sampled between
+            # their head and tail
+            'hash_sample_threshold': _parse_option(
+                config, 'data', 'hash_sample_threshold', parse_size, 0),
+            'hash_sample_blocks': max(0, _parse_option(
+                config, 'data', 'hash_sample_blocks', int, 16)),
+            # Files of at least this many bytes are tree-hashed on several
+            # threads (0: never), in leaves of this size
+            'hash_tree_threshold': _parse_option(
+                config, 'data', 'hash_tree_threshold', parse_size, 0),
+            'hash_tree_leaf_size': max(64 * 1024, _parse_option(
+                config, 'data', 'hash_tree_leaf_size', parse_size,
+                4 * 1024 * 1024)),
+        }
+        for name, value in values.items():
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('settings are read-only')
+
+    def is_set(self, section, name):
+        return (section, name.lower()) in self.options
+
+    def ignore_inputs(self, modulename):
+        """True if inputs of a (root) module are not logged."""
+        return 'all' in self.ignored_inputs or \
+            modulename.lower() in self.ignored_inputs
+
+    def ignore_outputs(self, modulename):
+        """True if outputs of a (root) module are not logged."""
+        return 'all' in self.ignored_outputs or \
+            modulename.lower() in self.ignored_outputs
+
+
+conf = apply_environment(read_config_file())
+SETTINGS = Settings(conf)
 
 
 def option_set(section, name):
-    return conf.has_option(section, name)
+    return (section, name.lower()) in SETTINGS.options
+
+
+def get_db_backend():
+    """Name of the storage backend for the database (tinydb or sqlite)."""
+    try:
+        return conf.get('database', 'backend') or 'tinydb'
+    except Error:
+        return 'tinydb'
 
 
 def get_db_path():
     try:
         return conf.get('database', 'path')
     except Error:
+        if get_db_backend() == 'sqlite':
+            return os.path.expanduser('~/.recipy/recipyDB.sqlite')
         return os.path.expanduser('~/.recipy/recipyDB.json')
 
 
+def get_blob_threshold():
+    """Text fields of runs of at least this many bytes are kept in the blob
+    store, if it is enabled (default: 1K)."""
+    try:
+        return parse_size(conf.get('database', 'blob_threshold'))
+    except (Error, AttributeError, TypeError, ValueError):
+        return 1024
+
+
 def get_editor():
     try:
         editor = conf.get('general', 'editor')
@@ -53,7 +205,7 @@ def get_editor():
             editor = '$EDITOR'
         else:
             editor = find_editor()
-    if editor is None or editor is '':
+    if editor is None or editor == '':
         raise RuntimeError("Cannot launch text editor. "
                            "Try setting the editor in the ~/.recipy/recipyrc file")
 
@@ -92,6 +244,122 @@ def get_gui_port():
     except Error:
         return 9000
 
+
+def get_checkpoint_interval():
+    """Seconds between checkpoints of the run record (0 disables them)."""
+    try:
+        return float(conf.get('database', 'checkpoint_interval'))
+    except (Error, TypeError, ValueError):
+        return 30.0
+
+
+def get_checkpoint_events():
+    """Number of logged events between checkpoints (0 disables them)."""
+    try:
+        return int(conf.get('database', 'checkpoint_events'))
+    except (Error, TypeError, ValueError):
+        return 0
+
+
+def get_hash_threads():
+    """Number of threads used to hash files when the script exits."""
+    try:
+        return max(1, int(conf.get('data', 'hash_threads')))
+    except (Error, TypeError, ValueError):
+        return min(8, os.cpu_count() or 1)
+
+
+def get_hash_threads_per_device():
+    """Max. number of files hashed at the same time on one device (0: no
+    limit)."""
+    try:
+        return max(0, int(conf.get('data', 'hash_threads_per_device')))
+    except (Error, TypeError, ValueError):
+        return 4
+
+
+def get_hash_algorithm():
+    """Name of the algorithm used to hash files (default: sha1)."""
+    try:
+        return conf.get('data', 'hash_algorithm') or 'sha1'
+    except Error:
+        return 'sha1'
+
+
+def get_file_diff_max_size():
+    """Outputs larger than this are not copied for file diffs, if they can't
+    be cloned (default: 64M)."""
+    try:
+        return parse_size(conf.get('data', 'file_diff_max_size'))
+    except (Error, AttributeError, TypeError, ValueError):
+        return 64 * 1024 * 1024
+
+
+def get_file_diff_budget():
+    """Max. number of bytes of snapshots of outputs kept by one run for file
+    diffs (default: 1G)."""
+    try:
+        return parse_size(conf.get('data', 'file_diff_budget'))
+    except (Error, AttributeError, TypeError, ValueError):
+        return 1 << 30
+
+
+def get_file_diff_limit():
+    """File diffs longer than this are truncated (default: 1M)."""
+    try:
+        return parse_size(conf.get('data', 'file_diff_limit'))
+    except (Error, AttributeError, TypeError, ValueError):
+        return 1024 * 1024
+
+
+def get_file_diff_timeout():
+    """Max. number of seconds spent on one file diff at exit (default: 60;
+    0 for no limit)."""
+    try:
+        return max(0.0, float(conf.get('data', 'file_diff_timeout'))) or None
+    except (Error, TypeError, ValueError):
+        return 60.0
+
+
+def get_file_diff_processes():
+    """Number of processes used to compute file diffs at exit."""
+    try:
+        return max(1, int(conf.get('data', 'file_diff_processes')))
+    except (Error, TypeError, ValueError):
+        return min(4, os.cpu_count() or 1)
+
+
+def get_hash_timeout():
+    """Max. number of seconds to wait at exit for inputs that are hashed in
+    the background (no limit if not set)."""
+    try:
+        return float(conf.get('data', 'hash_timeout'))
+    except (Error, TypeError, ValueError):
+        return None
+
+
+def get_hash_cache_path():
+    try:
+        return conf.get('data', 'hash_cache_path')
+    except Error:
+        return os.path.expanduser('~/.recipy/hashcache.sqlite')
+
+
+def get_hash_cache_size():
+    """Max. number of entries in the hash cache (0: no limit)."""
+    try:
+        return int(conf.get('data', 'hash_cache_size'))
+    except (Error, TypeError, ValueError):
+        return 100000
+
+
+def get_vcs_cache_path():
+    try:
+        return conf.get('general', 'vcs_cache_path')
+    except Error:
+        return os.path.expanduser('~/.recipy/vcscache')
+
+
 _notebookMode = False
 
 def get_notebook_mode():
@@ -0,0 +1,179 @@
+"""
+Digests of directories, e.g., Zarr stores.
+
+A directory is logged as a single input or output. Its digest is a Merkle
+tree: the digest of a directory is the hash of the list of its entries
+(sorted by name), each with its kind and digest. Files are hashed with
+`recipyCommon.hashing.hash_files`, so in parallel; subdirectories are hashed
+recursively; symbolic links are not followed, their target is part of the
+digest instead. Digests are stored with the prefix ``dir:`` (e.g.,
+``dir:blake2b:0123...``).
+
+With the hash cache (``hash_cache`` in the ``[data]`` section of recipyrc),
+the digest of every subdirectory is cached together with a signature of its
+contents: the names and stat signatures of its files, and the signatures of
+its subdirectories. Hashing a store again only costs a stat of every file;
+after one file changed, the digests of the unchanged subdirectories come
+from the cache and of all other files from the file hash cache, so only the
+changed file is read.
+"""
+import os
+import time
+import sqlite3
+import hashlib
+
+from .config import get_hash_threads, get_hash_threads_per_device
+from .hashcache import RACY_SECONDS
+from .hashing import DIR_PREFIX, get_algorithm, new_hasher, tag_digest, \
+    hash_files, _cache_key
+
+# Part of every directory digest, so the format can be changed later
+HEADER = b'recipy-dir-v1\n'
+
+
+class _Tree(object):
+    """A scanned directory: entries are (name, kind, value) tuples, where
+    kind is 'f' (value: path), 'd' (value: _Tree) or 'l' (value: target of
+    the link)."""
+    __slots__ = ('path', 'dev', 'inode', 'entries', 'signature', 'racy')
+
+    def __init__(self, path, dev, inode):
+        self.path = path
+        self.dev = dev
+        self.inode = inode
+        self.entries = []
+        self.signature = None
+        # True if something in the tree was modified too recently to cache
+        # its digest
+        self.racy = False
+
+
+def _encode(name):
+    return name.encode('utf-8', 'surrogateescape')
+
+
+def _entry_line(kind, name, value):
+    name = _encode(name)
+    # The length makes names with spaces or newlines unambiguous
+    return kind.encode('ascii') + b' ' + str(len(name)).encode('ascii') + \
+        b':' + name + b' ' + _encode(value) + b'\n'
+
+
+def _scan(path, now):
+    st = os.stat(path)
+    tree = _Tree(path, st.st_dev, st.st_ino)
+    signature = hashlib.sha1()
+    for entry in sorted(os.scandir(path), key=lambda e: e.name):
+        try:
+            if entry.is_symlink():
+                value = os.readlink(entry.path)
+                kind = 'l'
+                tree.entries.append((entry.name, kind, value))
+            elif entry.is_dir():
+                subtree = _scan(entry.path, now)
+                kind, value = 'd', subtree.signature
+                tree.entries.append((entry.name, kind, subtree))
+                tree.racy = tree.racy or subtree.racy
+            elif entry.is_file():
+                st = entry.stat()
+                mtime_ns = getattr(st, 'st_mtime_ns', int(st.st_mtime * 1e9))
+                kind = 'f'
+                value = '{} {} {} {}'.format(st.st_dev, st.st_ino, st.st_size,
+                                             mtime_ns)
+                tree.entries.append((entry.name, kind, entry.path))
+                if now - mtime_ns / 1e9 < RACY_SECONDS:
+                    tree.racy = True
+            else:
+                # Sockets, FIFOs, devices
+                continue
+        except OSError:
+            # Removed while we were looking at it
+            continue
+        signature.update(_entry_line(kind, entry.name, value))
+    tree.signature = signature.hexdigest()
+    return tree
+
+
+def _subtrees(tree):
+    yield tree
+    for _, kind, value in tree.entries:
+        if kind == 'd':
+            for subtree in _subtrees(value):
+                yield subtree
+
+
+def _uncached(tree, cached):
+    """Yield the subtrees whose digests have to be computed."""
+    if tree.path in cached:
+        return
+    yield tree
+    for _, kind, value in tree.entries:
+        if kind == 'd':
+            for subtree in _uncached(value, cached):
+                yield subtree
+
+
+def _combine(tree, algorithm, file_digests, digests):
+    """Compute the digest of a tree (and of its subtrees) into `digests`."""
+    if tree.path in digests:
+        return digests[tree.path]
+    hasher = new_hasher(algorithm)
+    hasher.update(HEADER)
+    for name, kind, value in tree.entries:
+        if kind == 'f':
+            # Files that can't be read are part of the digest as such
+            value = file_digests.get(value) or '-'
+        elif kind == 'd':
+            value = _combine(value, algorithm, file_digests, digests)
+        hasher.update(_entry_line(kind, name, value))
+    digest = DIR_PREFIX + tag_digest(algorithm, hasher.hexdigest())
+    digests[tree.path] = digest
+    return digest
+
+
+def hash_directory(path, algorithm=None, cache=None, threads=None,
+                   threads_per_device=None):
+    """Return the (tagged) digest of a directory, or None if it can't be
+    read.
+
+    The files are hashed on `threads` threads (see
+    `recipyCommon.hashing.hash_files`; by default the configured number).
+    Digests of files and subdirectories are taken from (and stored in)
+    `cache`, a `recipyCommon.hashcache.HashCache`, if one is given.
+    """
+    if threads is None:
+        threads = get_hash_threads()
+    if threads_per_device is None:
+        threads_per_device = get_hash_threads_per_device()
+    algorithm = get_algorithm(algorithm)
+    try:
+        root = _scan(os.path.abspath(path), time.time())
+    except OSError:
+        return None
+
+    key = _cache_key(algorithm)
+    digests = {}
+    if cache is not None:
+        try:
+            digests = cache.lookup_trees(
+                [(t.path, t.dev, t.inode, t.signature)
+                 for t in _subtrees(root)], key)
+        except sqlite3.Error:
+            cache = None
+
+    uncached = list(_uncached(root, digests))
+    files = [value for tree in uncached
+             for _, kind, value in tree.entries if kind == 'f']
+    file_digests = hash_files(files, threads, threads_per_device, cache,
+                              algorithm)
+    digest = _combine(root, algorithm, file_digests, digests)
+
+    if cache is not None:
+        # Trees with files that may still be written to are not cached
+        try:
+            cache.store_trees(
+                [(t.path, t.dev, t.inode, t.signature, digests[t.path])
+                 for t in uncached if not t.racy], key)
+        except sqlite3.Error:
+            pass
+    return digest
@@ -0,0 +1,252 @@
+"""
+Unified diffs of output files, computed when the script exits.
+
+Diffing large outputs with `difflib` directly can take minutes (its matching
+is quadratic in the worst case), so `diff_file` does the cheap work first:
+
+* files with the same contents are not read as text (the diff is empty)
+* lines are replaced by integer ids (a dict of the distinct lines), so
+  matching compares integers instead of strings
+* the common prefix and suffix of the files are skipped before matching; for
+  logs and other files that are appended to, nothing is left to match
+* the diff is truncated after `limit` characters, with a marker
+
+`diff_files` diffs several files at once in separate processes, each of
+which is killed when it takes longer than `timeout` seconds. Where processes
+can't be forked (Windows), the files are diffed one after the other in the
+current process, and the timeout is not enforced.
+"""
+import time
+import filecmp
+import difflib
+import warnings
+
+ENCODINGS = ('utf-8', 'latin-1')
+# Number of lines of context around changes
+CONTEXT = 3
+FROMFILE = 'before this run'
+TOFILE = 'after this run'
+TRUNCATED = '... (diff truncated after {} characters)\n'
+TIMED_OUT = '(diff not computed: it took longer than {:g} seconds)\n'
+
+
+def read_lines(path):
+    """Return the lines of a text file, decoded with the first of ENCODINGS
+    that works."""
+    with open(path, 'rb') as f:
+        data = f.read()
+    for encoding in ENCODINGS:
+        try:
+            text = data.decode(encoding)
+            break
+        except UnicodeDecodeError:
+            continue
+    return text.splitlines(True)
+
+
+def _opcodes(a, b):
+    """Return the opcodes (as `difflib.SequenceMatcher.get_opcodes`) that
+    turn the lines `a` into the lines `b`."""
+    n = min(len(a), len(b))
+    prefix = 0
+    while prefix < n and a[prefix] == b[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < n - prefix and a[-1 - suffix] == b[-1 - suffix]:
+        suffix += 1
+
+    ids = {}
+    a_ids = [ids.setdefault(line, len(ids))
+             for line in a[prefix:len(a) - suffix]]
+    b_ids = [ids.setdefault(line, len(ids))
+             for line in b[prefix:len(b) - suffix]]
+    opcodes = []
+    if prefix:
+        opcodes.append(('equal', 0, prefix, 0, prefix))
+    if a_ids or b_ids:
+        matcher = difflib.SequenceMatcher(None, a_ids, b_ids)
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            opcodes.append((tag, i1 + prefix, i2 + prefix,
+                            j1 + prefix, j2 + prefix))
+    if suffix:
+        opcodes.append(('equal', len(a) - suffix, len(a),
+                        len(b) - suffix, len(b)))
+    return opcodes
+
+
+def _groups(opcodes, n=CONTEXT):
+    """Group opcodes in hunks with `n` lines of context (as
+    `difflib.SequenceMatcher.get_grouped_opcodes`)."""
+    if not opcodes:
+        return
+    codes = list(opcodes)
+    if codes[0][0] == 'equal':
+        tag, i1, i2, j1, j2 = codes[0]
+        codes[0] = tag, max(i1, i2 - n), i2, max(j1, j2 - n), j2
+    if codes[-1][0] == 'equal':
+        tag, i1, i2, j1, j2 = codes[-1]
+        codes[-1] = tag, i1, min(i2, i1 + n), j1, min(j2, j1 + n)
+
+    group = []
+    for tag, i1, i2, j1, j2 in codes:
+        # End the current group and start a new one whenever there is a
+        # large range with no changes
+        if tag == 'equal' and i2 - i1 > n * 2:
+            group.append((tag, i1, min(i2, i1 + n), j1, min(j2, j1 + n)))
+            yield group
+            group = []
+            i1, j1 = max(i1, i2 - n), max(j1, j2 - n)
+        group.append((tag, i1, i2, j1, j2))
+    if group and not (len(group) == 1 and group[0][0] == 'equal'):
+        yield group
+
+
+def _range(start, stop):
+    """Format a range of lines of a hunk header (as `difflib`)."""
+    beginning = start + 1
+    length = stop - start
+    if length == 1:
+        return '{}'.format(beginning)
+    if not length:
+        beginning -= 1
+    return '{},{}'.format(beginning, length)
+
+
+def unified_diff(a, b, fromfile=FROMFILE, tofile=TOFILE):
+    """Generate the lines of the unified diff of the lines `a` and `b`, in
+    the format of `difflib.unified_diff` (but much faster on files with few
+    changes).
+
+    The diff is valid, but the lines that are common to the start and end of
+    `a` and `b` are matched before the rest is compared, so a change can be
+    aligned differently than by `difflib` (e.g., which of several identical
+    lines is reported as inserted). Don't compare diffs with ones stored by
+    earlier versions of recipy."""
+    started = False
+    for group in _groups(_opcodes(a, b)):
+        if not started:
+            started = True
+            yield '--- {}\n'.format(fromfile)
+            yield '+++ {}\n'.format(tofile)
+        first, last = group[0], group[-1]
+        yield '@@ -{} +{} @@\n'.format(_range(first[1], last[2]),
+                                       _range(first[3], last[4]))
+        for tag, i1, i2, j1, j2 in group:
+            if tag == 'equal':
+                for line in a[i1:i2]:
+                    yield ' ' + line
+                continue
+            if tag in ('replace', 'delete'):
+                for line in a[i1:i2]:
+                    yield '-' + line
+            if tag in ('replace', 'insert'):
+                for line in b[j1:j2]:
+                    yield '+' + line
+
+
+def diff_file(before, after, limit=None):
+    """Return the unified diff of two text files, truncated after `limit`
+    characters."""
+    if filecmp.cmp(before, after, shallow=False):
+        return ''
+    parts = []
+    size = 0
+    for line in unified_diff(read_lines(before), read_lines(after)):
+        if limit is not None and size + len(line) > limit:
+            parts.append(TRUNCATED.format(limit))
+            break
+        parts.append(line)
+        size += len(line)
+    return ''.join(parts)
+
+
+def _diff_in_child(conn, before, after, limit):
+    try:
+        result = (True, diff_file(before, after, limit))
+    except Exception as e:
+        result = (False, str(e))
+    conn.send(result)
+    conn.close()
+
+
+def _diff_serially(pairs, limit):
+    results = []
+    for before, after in pairs:
+        try:
+            results.append((True, diff_file(before, after, limit)))
+        except (IOError, OSError) as e:
+            results.append((False, str(e)))
+    return results
+
+
+def _diff_in_processes(pairs, processes, timeout, limit):
+    import multiprocessing
+    from multiprocessing.connection import wait
+    context = multiprocessing.get_context('fork')
+    results = [None] * len(pairs)
+    pending = list(enumerate(pairs))
+    running = {}
+    while pending or running:
+        while pending and len(running) < processes:
+            index, (before, after) = pending.pop(0)
+            reader, writer = context.Pipe(duplex=False)
+            process = context.Process(target=_diff_in_child,
+                                      args=(writer, before, after, limit))
+            process.daemon = True
+            process.start()
+            writer.close()
+            deadline = None if timeout is None else time.time() + timeout
+            running[reader] = (index, process, deadline)
+
+        deadlines = [deadline for _, _, deadline in running.values()
+                     if deadline is not None]
+        wait_time = max(0, min(deadlines) - time.time()) if deadlines \
+            else None
+        for reader in wait(list(running), wait_time):
+            index, process, _ = running.pop(reader)
+            try:
+                results[index] = reader.recv()
+            except EOFError:
+                results[index] = (False, 'the diff process died')
+            reader.close()
+            process.join()
+
+        now = time.time()
+        for reader, (index, process, deadline) in list(running.items()):
+            if deadline is not None and now >= deadline:
+                process.terminate()
+                process.join()
+                reader.close()
+                del running[reader]
+                results[index] = (True, TIMED_OUT.format(timeout))
+    return results
+
+
+def diff_files(pairs, processes=1, timeout=None, limit=None):
+    """Return the unified diffs of (before, after) pairs of text files, in
+    the same order. The diff of a pair that could not be diffed (e.g., one of
+    the files is gone) is None.
+
+    Diffs that take longer than `timeout` seconds are replaced by a note that
+    says so; diffs longer than `limit` characters are truncated.
+    """
+    pairs = list(pairs)
+    if not pairs:
+        return []
+    # Imported here: multiprocessing is only needed at exit, for runs with
+    # file diffs
+    import multiprocessing
+    if 'fork' in multiprocessing.get_all_start_methods() and \
+       (timeout is not None or (processes > 1 and len(pairs) > 1)):
+        results = _diff_in_processes(pairs, processes, timeout, limit)
+    else:
+        results = _diff_serially(pairs, limit)
+
+    diffs = []
+    for (before, after), (ok, value) in zip(pairs, results):
+        if not ok:
+            warnings.warn('recipy: could not store the file diff of {}: {}'
+                          .format(after, value))
+            value = None
+        diffs.append(value)
+    return diffs
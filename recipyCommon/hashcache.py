@@ -0,0 +1,238 @@
+"""
+Persistent cache of file hashes.
+
+Hashing large input files is often the most expensive thing recipy does, and
+the same reference data is typically hashed by many runs. The hash cache
+stores the hash of a file together with its stat signature (device, inode,
+size and modification time in nanoseconds); as long as the signature does not
+change, the stored hash is reused instead of reading the file again.
+
+The cache is an SQLite database (``~/.recipy/hashcache.sqlite`` by default)
+shared by all processes of a user, both when logging runs and in the recipy
+command. It holds at most ``hash_cache_size`` entries; when it grows beyond
+that, the least recently used entries are evicted. Enable it by adding
+``hash_cache`` to the ``[data]`` section of recipyrc, and inspect or clear it
+with ``recipy cache``.
+
+The digests of directories (see `recipyCommon.dirhash`) are cached too, keyed
+on a signature of everything in the directory tree, so an unchanged subtree
+of a large directory is not walked through the file hashes again.
+"""
+import os
+import time
+import sqlite3
+import threading
+
+from .config import option_set, get_hash_cache_path, get_hash_cache_size
+
+# Bump when the layout of the cache changes; old caches are discarded
+SCHEMA_VERSION = 3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS hashes (
+    dev INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    algorithm TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    path TEXT NOT NULL,
+    hash TEXT NOT NULL,
+    last_used REAL NOT NULL,
+    PRIMARY KEY (dev, inode, algorithm)
+);
+CREATE INDEX IF NOT EXISTS hashes_last_used ON hashes(last_used);
+CREATE TABLE IF NOT EXISTS trees (
+    dev INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    algorithm TEXT NOT NULL,
+    signature TEXT NOT NULL,
+    path TEXT NOT NULL,
+    hash TEXT NOT NULL,
+    last_used REAL NOT NULL,
+    PRIMARY KEY (dev, inode, algorithm)
+);
+CREATE INDEX IF NOT EXISTS trees_last_used ON trees(last_used);
+"""
+
+# Files modified less than this many seconds ago are not cached: they may be
+# modified again without a visible change of mtime (the "racy" files of git)
+RACY_SECONDS = 2
+
+
+def stat_signature(path):
+    """Return the (dev, inode, size, mtime_ns) signature of a file, or None
+    if it can't be stat'ed."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    mtime_ns = getattr(st, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(st.st_mtime * 1e9)
+    return (st.st_dev, st.st_ino, st.st_size, mtime_ns)
+
+
+class HashCache(object):
+    """Persistent map from file stat signatures to hashes."""
+    def __init__(self, path, max_entries=100000):
+        self.path = path
+        self.max_entries = max_entries
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        version = self.conn.execute('PRAGMA user_version').fetchone()[0]
+        if version != SCHEMA_VERSION:
+            self.conn.execute('DROP TABLE IF EXISTS hashes')
+            self.conn.execute('DROP TABLE IF EXISTS trees')
+            self.conn.execute('PRAGMA user_version = %d' % SCHEMA_VERSION)
+        self.conn.executescript(SCHEMA)
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def lookup(self, paths, algorithm):
+        """Return a dict with the cached hashes (made with `algorithm`) of
+        those paths that have them, and a dict with the stat signatures of
+        all paths."""
+        signatures = dict((path, stat_signature(path)) for path in paths)
+        hashes = {}
+        now = time.time()
+        used = []
+        for path, sig in signatures.items():
+            if sig is None:
+                continue
+            row = self.conn.execute(
+                'SELECT hash FROM hashes WHERE dev = ? AND inode = ? '
+                'AND size = ? AND mtime_ns = ? AND algorithm = ?',
+                sig + (algorithm,)).fetchone()
+            if row is not None:
+                hashes[path] = row[0]
+                used.append((now, sig[0], sig[1], algorithm))
+        if used:
+            self.conn.executemany(
+                'UPDATE hashes SET last_used = ? WHERE dev = ? AND inode = ? '
+                'AND algorithm = ?', used)
+            self.conn.commit()
+        return hashes, signatures
+
+    def store(self, hashes, signatures, algorithm):
+        """Store freshly computed hashes (made with `algorithm`).
+
+        A hash is only stored if the file still has the signature it had
+        before it was hashed (i.e., it was not modified while being read) and
+        was not modified very recently.
+        """
+        now = time.time()
+        rows = []
+        for path, value in hashes.items():
+            sig = signatures.get(path)
+            if value is None or sig is None or stat_signature(path) != sig:
+                continue
+            if now - sig[3] / 1e9 < RACY_SECONDS:
+                continue
+            rows.append(sig + (algorithm, path, value, now))
+        if not rows:
+            return
+        self.conn.executemany(
+            'INSERT OR REPLACE INTO hashes '
+            '(dev, inode, size, mtime_ns, algorithm, path, hash, last_used) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+        self.evict()
+        self.conn.commit()
+
+    def lookup_trees(self, trees, algorithm):
+        """Return the cached digests of directories. `trees` is a list of
+        (path, dev, inode, signature); the result maps paths to digests."""
+        hashes = {}
+        now = time.time()
+        used = []
+        for path, dev, inode, signature in trees:
+            row = self.conn.execute(
+                'SELECT hash FROM trees WHERE dev = ? AND inode = ? '
+                'AND algorithm = ? AND signature = ?',
+                (dev, inode, algorithm, signature)).fetchone()
+            if row is not None:
+                hashes[path] = row[0]
+                used.append((now, dev, inode, algorithm))
+        if used:
+            self.conn.executemany(
+                'UPDATE trees SET last_used = ? WHERE dev = ? AND inode = ? '
+                'AND algorithm = ?', used)
+            self.conn.commit()
+        return hashes
+
+    def store_trees(self, trees, algorithm):
+        """Store directory digests; `trees` is a list of (path, dev, inode,
+        signature, digest)."""
+        now = time.time()
+        rows = [(dev, inode, algorithm, signature, path, digest, now)
+                for path, dev, inode, signature, digest in trees]
+        if not rows:
+            return
+        self.conn.executemany(
+            'INSERT OR REPLACE INTO trees '
+            '(dev, inode, algorithm, signature, path, hash, last_used) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+        self.evict()
+        self.conn.commit()
+
+    def evict(self):
+        """Remove the least recently used entries beyond max_entries."""
+        if self.max_entries <= 0:
+            return
+        for table in ('hashes', 'trees'):
+            count = self.conn.execute(
+                'SELECT COUNT(*) FROM %s' % table).fetchone()[0]
+            excess = count - self.max_entries
+            if excess > 0:
+                self.conn.execute(
+                    'DELETE FROM {0} WHERE rowid IN (SELECT rowid FROM {0} '
+                    'ORDER BY last_used LIMIT ?)'.format(table), (excess,))
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM hashes').fetchone()[0]
+
+    def info(self):
+        """Return a dict describing the cache."""
+        row = self.conn.execute(
+            'SELECT COUNT(*), SUM(size), MIN(last_used), MAX(last_used) '
+            'FROM hashes').fetchone()
+        return {'path': self.path,
+                'entries': row[0],
+                'max_entries': self.max_entries,
+                'bytes_hashed': row[1] or 0,
+                'directories': self.conn.execute(
+                    'SELECT COUNT(*) FROM trees').fetchone()[0],
+                'oldest_use': row[2],
+                'newest_use': row[3]}
+
+    def clear(self):
+        self.conn.execute('DELETE FROM hashes')
+        self.conn.execute('DELETE FROM trees')
+        self.conn.commit()
+        self.conn.execute('VACUUM')
+
+
+_local = threading.local()
+
+
+def get_hash_cache():
+    """Return the hash cache of this thread, or None if it is disabled or
+    can't be opened."""
+    if not option_set('data', 'hash_cache'):
+        return None
+    # SQLite connections must not be shared between threads, or with forked
+    # children
+    if getattr(_local, 'pid', None) != os.getpid():
+        try:
+            _local.cache = HashCache(get_hash_cache_path(),
+                                     get_hash_cache_size())
+        except (sqlite3.Error, OSError):
+            return None
+        _local.pid = os.getpid()
+    return _local.cache
@@ -0,0 +1,697 @@
+"""
+Hashing of input and output files.
+
+Outputs (and, if ``defer_input_hashes`` is set, inputs) are hashed when the
+script exits. A pipeline can write thousands of files, so `hash_files` hashes
+them on a pool of threads; hashlib releases the GIL while it digests large
+buffers, so the threads really run in parallel. The number of files that are
+read at the same time from a single device can be limited, so spinning disks
+are not thrashed by concurrent seeks.
+
+If a `recipyCommon.hashcache.HashCache` is passed, files whose stat signature
+has not changed since they were last hashed are not read at all.
+
+The hash algorithm is set with ``hash_algorithm`` in the ``[data]`` section
+of recipyrc. Digests are stored with the name of the algorithm as a prefix
+(e.g., ``blake2b:0123...``), so databases with digests made by different
+algorithms can still be searched. SHA-1 digests are stored without a prefix,
+as they were before the algorithm could be chosen.
+
+Files are read into a preallocated buffer (one per thread) with `readinto`,
+so hashing a large file doesn't allocate a new bytes object for every block.
+The block size is picked from the size of the file and the preferred I/O size
+of the filesystem, and the kernel is told that the file is read sequentially
+(`posix_fadvise`) so it reads ahead aggressively. With ``hash_mmap`` in the
+``[data]`` section of recipyrc, large files are memory-mapped instead. See
+``benchmarks/bench_hashing.py`` for a comparison of the read strategies.
+
+Files of at least ``hash_sample_threshold`` bytes can be fingerprinted
+instead of hashed: the fingerprint is a hash of the size of the file, its
+first and last block and ``hash_sample_blocks`` evenly spaced blocks in
+between. Fingerprints are stored with the prefix ``sampled:``. They are
+cheap to compute for huge files, but only detect changes in the sampled
+blocks (or in the size).
+
+Files of at least ``hash_tree_threshold`` bytes are tree-hashed: the file is
+split in leaves of ``hash_tree_leaf_size`` bytes, which are read with
+`os.pread` and hashed on a pool of threads, and the digest is the hash of the
+size of the file, the leaf size and the digests of the leaves. A single huge
+file is then hashed on all cores, as fast as the disk can deliver it. Tree
+digests depend on the leaf size, which is part of their prefix (e.g.,
+``tree-4m:blake2b:0123...``). See ``benchmarks/bench_treehash.py``.
+
+Directories are hashed as a whole, as a Merkle tree of the digests of the
+files in them (see `recipyCommon.dirhash`); their digests have the prefix
+``dir:``.
+"""
+import os
+import re
+import mmap
+import sqlite3
+import hashlib
+import threading
+import warnings
+from collections import OrderedDict
+
+from .config import SETTINGS, get_hash_algorithm, option_set, \
+    get_hash_threads, SIZE_SUFFIXES
+
+# Smallest and largest read size; hashlib releases the GIL for large updates,
+# so big blocks also let threads hash in parallel
+BLOCKSIZE = 65536
+MAX_BLOCKSIZE = 4 * 1024 * 1024
+
+# Files at least this large are memory-mapped (if enabled)
+MMAP_THRESHOLD = 64 * 1024 * 1024
+
+# Fingerprints of large files are prefixed with this
+SAMPLED_PREFIX = 'sampled:'
+SAMPLE_BLOCKSIZE = 1024 * 1024
+
+# Digests of directories are prefixed with this
+DIR_PREFIX = 'dir:'
+PREFIXES = (SAMPLED_PREFIX, DIR_PREFIX)
+
+# Tree digests are prefixed with this and their leaf size (see tree_prefix)
+TREE_PREFIX = 'tree-'
+
+# Digests made with this algorithm are stored without a prefix
+LEGACY_ALGORITHM = 'sha1'
+
+
+def _blake2b():
+    # hashlib has BLAKE2 since Python 3.6
+    if not hasattr(hashlib, 'blake2b'):
+        raise ImportError('blake2b needs Python 3.6 or later')
+    return hashlib.blake2b()
+
+
+def _xxh128():
+    import xxhash
+    return xxhash.xxh3_128()
+
+
+ALGORITHMS = OrderedDict([
+    ('sha1', hashlib.sha1),
+    ('sha256', hashlib.sha256),
+    ('blake2b', _blake2b),
+    # Very fast, but not cryptographic; needs the xxhash package
+    ('xxh128', _xxh128),
+])
+
+ALIASES = {'xxhash': 'xxh128', 'blake2': 'blake2b'}
+
+PREFIX_RE = re.compile(r'^(?:sampled|dir|tree-[0-9]+[kmgt]?):')
+DIGEST_RE = re.compile(r'^((?:sampled|dir|tree-[0-9]+[kmgt]?):)?'
+                       r'(?:([a-z0-9_]+):)?([0-9a-f]+)$')
+
+
+def new_hasher(algorithm):
+    return ALGORITHMS[algorithm]()
+
+
+_available = None
+
+
+def available_algorithms():
+    """Return the names of the hash algorithms that can be used here."""
+    global _available
+    if _available is None:
+        _available = []
+        for name in ALGORITHMS:
+            try:
+                new_hasher(name)
+            except ImportError:
+                continue
+            _available.append(name)
+    return list(_available)
+
+
+def get_algorithm(name=None):
+    """Return the name of the hash algorithm to use (the one set in recipyrc
+    if `name` is None).
+
+    Falls back to SHA-1 (with a warning) if the algorithm is unknown or not
+    available.
+    """
+    if name is None:
+        name = get_hash_algorithm()
+    name = ALIASES.get(name.lower(), name.lower())
+    if name not in available_algorithms():
+        warnings.warn('Hash algorithm "{}" is not available, using {} '
+                      'instead'.format(name, LEGACY_ALGORITHM))
+        return LEGACY_ALGORITHM
+    return name
+
+
+def tag_digest(algorithm, hexdigest, sampled=False):
+    """Return the digest as stored in the database."""
+    if algorithm != LEGACY_ALGORITHM:
+        hexdigest = '{}:{}'.format(algorithm, hexdigest)
+    if sampled:
+        hexdigest = SAMPLED_PREFIX + hexdigest
+    return hexdigest
+
+
+def is_sampled(digest):
+    return digest.startswith(SAMPLED_PREFIX)
+
+
+def tree_prefix(leaf_size):
+    """Return the prefix of tree digests with leaves of `leaf_size` bytes
+    (e.g., tree-4m:)."""
+    for suffix in 'tgmk':
+        unit = SIZE_SUFFIXES[suffix]
+        if leaf_size % unit == 0:
+            return '{}{}{}:'.format(TREE_PREFIX, leaf_size // unit, suffix)
+    return '{}{}:'.format(TREE_PREFIX, leaf_size)
+
+
+def _search_prefixes():
+    # A bare digest can be a tree digest, but only with a known leaf size
+    leaf_sizes = sorted(set([SETTINGS.hash_tree_leaf_size, 4 * 1024 * 1024]))
+    return PREFIXES + tuple(tree_prefix(size) for size in leaf_sizes)
+
+
+def split_digest(digest):
+    """Return the (algorithm, hexdigest) of a stored digest (of a file,
+    sampled, tree-hashed or not, or a directory)."""
+    digest = PREFIX_RE.sub('', digest, count=1)
+    algorithm, sep, hexdigest = digest.rpartition(':')
+    if not sep:
+        return LEGACY_ALGORITHM, digest
+    return algorithm, hexdigest
+
+
+def digest_variants(value):
+    """Return the stored digests that a digest given by a user can match.
+
+    A digest without a prefix can have been made by any algorithm, of a
+    sampled file, a whole file, a tree-hashed file (with the configured or
+    default leaf size) or a directory (it is matched against the hex part of
+    all digests), and
+    ``sha1:<hex>`` matches the legacy SHA-1 digests without prefix. Returns
+    an empty list if the value does not look like a digest.
+    """
+    m = DIGEST_RE.match(value.strip().lower())
+    if m is None:
+        return []
+    prefix, algorithm, hexdigest = m.groups()
+    if algorithm is None:
+        algorithms = list(ALGORITHMS)
+    else:
+        algorithms = [ALIASES.get(algorithm, algorithm)]
+        if algorithms[0] not in ALGORITHMS:
+            return []
+    prefixes = [prefix] if prefix else ('',) + _search_prefixes()
+    return [p + tag_digest(a, hexdigest) for p in prefixes for a in algorithms]
+
+
+def block_size(size, preferred=0):
+    """Return the read size for a file of `size` bytes on a filesystem with
+    preferred I/O size `preferred` (st_blksize).
+
+    Small files are read in one go; larger files in blocks of 1/16 of the file
+    (at most MAX_BLOCKSIZE), rounded up to a multiple of the preferred size.
+    """
+    preferred = max(preferred or 0, 4096)
+    if size <= BLOCKSIZE:
+        block = BLOCKSIZE
+    else:
+        block = min(MAX_BLOCKSIZE, max(BLOCKSIZE, size // 16))
+    return -(-block // preferred) * preferred
+
+
+_buffers = threading.local()
+
+
+def _buffer(size):
+    """Return a memoryview of at least `size` bytes, reused by all files
+    hashed in the current thread."""
+    view = getattr(_buffers, 'view', None)
+    if view is None or len(view) < size:
+        view = memoryview(bytearray(size))
+        _buffers.view = view
+    return view
+
+
+def _advise_sequential(fd):
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        except OSError:
+            pass
+
+
+def _hash_mmap(f, size, block, hashers):
+    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        if hasattr(mm, 'madvise') and hasattr(mmap, 'MADV_SEQUENTIAL'):
+            mm.madvise(mmap.MADV_SEQUENTIAL)
+        view = memoryview(mm)
+        try:
+            for start in range(0, size, block):
+                chunk = view[start:start + block]
+                for hasher in hashers:
+                    hasher.update(chunk)
+                chunk.release()
+        finally:
+            view.release()
+    finally:
+        mm.close()
+
+
+def _read_into(path, hashers, use_mmap=None):
+    """Feed the contents of a file to a number of hashers."""
+    if use_mmap is None:
+        use_mmap = option_set('data', 'hash_mmap')
+    with open(path, 'rb', buffering=0) as f:
+        st = os.fstat(f.fileno())
+        block = block_size(st.st_size, getattr(st, 'st_blksize', 0))
+        _advise_sequential(f.fileno())
+
+        # Note: the process gets SIGBUS if a mapped file is truncated while
+        # it is being hashed, which is why mmap is not the default
+        if use_mmap and st.st_size >= MMAP_THRESHOLD:
+            _hash_mmap(f, st.st_size, block, hashers)
+            return
+
+        buf = _buffer(block)[:block]
+        n = f.readinto(buf)
+        while n:
+            chunk = buf[:n]
+            for hasher in hashers:
+                hasher.update(chunk)
+            n = f.readinto(buf)
+
+
+def sample_offsets(size, blocks, blocksize=SAMPLE_BLOCKSIZE):
+    """Return the (offset, length) of the blocks of a file of `size` bytes
+    that are hashed for its fingerprint: the first and last block and
+    `blocks` evenly spaced blocks in between (or the whole file, if it is
+    smaller than that)."""
+    if size <= (blocks + 2) * blocksize:
+        return [(0, size)]
+    step = (size - blocksize) / float(blocks + 1)
+    offsets = [0] + [int(step * (i + 1)) for i in range(blocks)] + \
+        [size - blocksize]
+    return [(offset, blocksize) for offset in offsets]
+
+
+def _sample_into(path, hashers, blocks):
+    """Feed the fingerprint material of a file to a number of hashers."""
+    with open(path, 'rb', buffering=0) as f:
+        size = os.fstat(f.fileno()).st_size
+        # The sampling parameters are part of the fingerprint, so
+        # fingerprints made with different parameters never match
+        header = 'recipy-sampled-v1 {} {} {}\n'.format(size, blocks,
+                                                       SAMPLE_BLOCKSIZE)
+        header = header.encode('ascii')
+        for hasher in hashers:
+            hasher.update(header)
+        buf = _buffer(SAMPLE_BLOCKSIZE)
+        for offset, length in sample_offsets(size, blocks):
+            f.seek(offset)
+            while length > 0:
+                n = f.readinto(buf[:min(length, len(buf))])
+                if not n:
+                    break
+                for hasher in hashers:
+                    hasher.update(buf[:n])
+                length -= n
+
+
+def _pread_into(fd, view, offset):
+    if hasattr(os, 'preadv'):
+        return os.preadv(fd, [view], offset)
+    data = os.pread(fd, len(view), offset)
+    view[:len(data)] = data
+    return len(data)
+
+
+class _TreeHasher(object):
+    """Tree-hashes one file with a number of algorithms, reading it only once.
+
+    The leaves are read with `os.pread`, so they can be hashed on any number
+    of threads that share one file descriptor, in any order.
+    """
+    def __init__(self, path, algorithms, leaf_size):
+        self.path = path
+        self.algorithms = algorithms
+        self.leaf_size = leaf_size
+        self.fd = os.open(path, os.O_RDONLY)
+        try:
+            self.size = os.fstat(self.fd).st_size
+        except Exception:
+            os.close(self.fd)
+            raise
+        # An empty file has one empty leaf
+        self.leaves = max(1, -(-self.size // leaf_size))
+
+    def hash_leaf(self, i):
+        offset = i * self.leaf_size
+        length = min(self.leaf_size, self.size - offset)
+        buf = _buffer(self.leaf_size)[:length]
+        done = 0
+        while done < length:
+            n = _pread_into(self.fd, buf[done:], offset + done)
+            if not n:
+                raise IOError('{} was truncated while it was being '
+                              'hashed'.format(self.path))
+            done += n
+        digests = []
+        for algorithm in self.algorithms:
+            hasher = new_hasher(algorithm)
+            hasher.update(buf)
+            digests.append(hasher.digest())
+        return digests
+
+    def close(self):
+        os.close(self.fd)
+
+    def roots(self, digests):
+        """Return a dict mapping algorithm names to the hex digests of the
+        file, given the digests returned by `hash_leaf` (in order)."""
+        # The size and leaf size are part of the digest, so digests made
+        # with different leaf sizes never match
+        header = 'recipy-tree-v1 {} {}\n'.format(self.size, self.leaf_size)
+        header = header.encode('ascii')
+        roots = {}
+        for j, algorithm in enumerate(self.algorithms):
+            root = new_hasher(algorithm)
+            root.update(header)
+            for leaf_digests in digests:
+                root.update(leaf_digests[j])
+            roots[algorithm] = root.hexdigest()
+        return roots
+
+
+def _tree_into(path, algorithms, leaf_size, threads):
+    """Tree-hash a file with a number of algorithms, reading it only once.
+
+    The leaves are hashed on `threads` threads. Returns a dict mapping
+    algorithm names to hex digests.
+    """
+    tree = _TreeHasher(path, algorithms, leaf_size)
+    try:
+        if threads > 1 and tree.leaves > 1:
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(min(threads, tree.leaves)) as pool:
+                digests = list(pool.map(tree.hash_leaf, range(tree.leaves)))
+        else:
+            digests = [tree.hash_leaf(i) for i in range(tree.leaves)]
+    finally:
+        tree.close()
+    return tree.roots(digests)
+
+
+def use_sampling(path):
+    """Return True if a file should be fingerprinted instead of hashed."""
+    threshold = SETTINGS.hash_sample_threshold
+    return threshold > 0 and os.path.getsize(path) >= threshold
+
+
+def use_tree_hash(path):
+    """Return True if a file should be tree-hashed (and is not
+    fingerprinted)."""
+    threshold = SETTINGS.hash_tree_threshold
+    return threshold > 0 and hasattr(os, 'pread') and \
+        os.path.getsize(path) >= threshold and not use_sampling(path)
+
+
+def use_plain_hash(path):
+    """Return True if the digest of a file is the hash of its contents in
+    one go, so it can be computed while the file is read or written."""
+    return not use_sampling(path) and not use_tree_hash(path)
+
+
+def hash_file(path, algorithm=None, sampled=None):
+    """Return the (tagged) digest of a file, or None if it can't be read.
+
+    If `sampled` is None, files larger than ``hash_sample_threshold`` are
+    fingerprinted and files larger than ``hash_tree_threshold`` are
+    tree-hashed; if it is True, the file is always fingerprinted.
+    Directories are hashed with `recipyCommon.dirhash.hash_directory`.
+    """
+    if os.path.isdir(path):
+        from .dirhash import hash_directory
+        return hash_directory(path, algorithm)
+    try:
+        algorithm = get_algorithm(algorithm)
+        if sampled is None:
+            sampled = use_sampling(path)
+            if not sampled and use_tree_hash(path):
+                return _tree_hash(path, [algorithm])[algorithm]
+        hasher = new_hasher(algorithm)
+        if sampled:
+            _sample_into(path, [hasher], SETTINGS.hash_sample_blocks)
+        else:
+            _read_into(path, [hasher])
+        return tag_digest(algorithm, hasher.hexdigest(), sampled)
+    except Exception:
+        return None
+
+
+def _tree_hash(path, algorithms):
+    leaf_size = SETTINGS.hash_tree_leaf_size
+    roots = _tree_into(path, algorithms, leaf_size, get_hash_threads())
+    prefix = tree_prefix(leaf_size)
+    return dict((a, prefix + tag_digest(a, roots[a])) for a in algorithms)
+
+
+def hash_file_all(path, algorithms=None, sampled=False):
+    """Hash (or fingerprint) a file with several algorithms, reading it only
+    once.
+
+    Returns a dict mapping algorithm names to digests (empty if the file
+    can't be read).
+    """
+    if algorithms is None:
+        algorithms = available_algorithms()
+    hashers = [(a, new_hasher(a)) for a in algorithms]
+    try:
+        if sampled:
+            _sample_into(path, [h for _, h in hashers],
+                         SETTINGS.hash_sample_blocks)
+        else:
+            _read_into(path, [h for _, h in hashers])
+    except Exception:
+        return {}
+    return dict((a, tag_digest(a, h.hexdigest(), sampled))
+                for a, h in hashers)
+
+
+def search_digests(path, cache=None, sampled=None):
+    """Return the digests of a file with all available algorithms, to search
+    databases that contain digests made with different algorithms.
+
+    If `sampled` is True (or None and the file is larger than
+    ``hash_sample_threshold``), the fingerprints of the file are returned
+    instead. Files larger than ``hash_tree_threshold`` are tree-hashed.
+    Directories are hashed with all algorithms as a whole.
+    """
+    algorithms = available_algorithms()
+    if os.path.isdir(path):
+        from .dirhash import hash_directory
+        digests = [hash_directory(path, a, cache) for a in algorithms]
+        return [d for d in digests if d is not None]
+    if sampled is None:
+        sampled = use_sampling(path)
+    if sampled:
+        # Fingerprints are cheap, don't bother with the cache
+        digests = hash_file_all(path, algorithms, sampled=True)
+        return [digests[a] for a in algorithms if a in digests]
+    tree = use_tree_hash(path)
+    # Tree digests are cached under the same keys as by hash_files
+    keys = dict((a, _cache_key(a) if tree else a) for a in algorithms)
+
+    digests = {}
+    signatures = {}
+    if cache is not None:
+        try:
+            for a in algorithms:
+                hashes, signatures = cache.lookup([path], keys[a])
+                if path in hashes:
+                    digests[a] = hashes[path]
+        except sqlite3.Error:
+            cache = None
+    missing = [a for a in algorithms if a not in digests]
+    if missing:
+        if tree:
+            try:
+                new_digests = _tree_hash(path, missing)
+            except Exception:
+                new_digests = {}
+        else:
+            new_digests = hash_file_all(path, missing)
+        digests.update(new_digests)
+        if cache is not None:
+            try:
+                for a, digest in new_digests.items():
+                    cache.store({path: digest}, signatures, keys[a])
+            except sqlite3.Error:
+                pass
+    return [digests[a] for a in algorithms if a in digests]
+
+
+def _device(path):
+    try:
+        return os.stat(path).st_dev
+    except OSError:
+        return None
+
+
+def _interleave_devices(paths):
+    """Group paths by device and interleave the groups, so the pool works on
+    all devices at once instead of queueing up on the first one."""
+    by_device = OrderedDict()
+    for path in paths:
+        by_device.setdefault(_device(path), []).append(path)
+    groups = list(by_device.items())
+    ordered = []
+    i = 0
+    while groups:
+        groups = [(dev, files) for dev, files in groups if len(files) > i]
+        ordered.extend((dev, files[i]) for dev, files in groups)
+        i += 1
+    return ordered
+
+
+def hash_files(paths, threads=1, threads_per_device=0, cache=None,
+               algorithm=None):
+    """Hash a number of files, using up to `threads` threads.
+
+    At most `threads_per_device` files are read at the same time from the same
+    device (0 means no limit). Hashes found in `cache` are reused, and new
+    hashes are stored in it. Returns a dict mapping every path to its hash
+    (None if the file could not be read).
+    """
+    paths = list(OrderedDict.fromkeys(paths))
+    algorithm = get_algorithm(algorithm)
+
+    # Directories are hashed from the files in them (the stat signature of a
+    # directory doesn't change when a file in it changes)
+    directories = [path for path in paths if os.path.isdir(path)]
+    if directories:
+        from .dirhash import hash_directory
+        hashes = dict((path, hash_directory(path, algorithm, cache, threads,
+                                            threads_per_device))
+                      for path in directories)
+        hashes.update(hash_files([p for p in paths if p not in hashes],
+                                 threads, threads_per_device, cache,
+                                 algorithm))
+        return hashes
+
+    if cache is None:
+        return _hash_files(paths, threads, threads_per_device, algorithm)
+
+    # The cache is an optimization: if it is unusable (e.g., locked for too
+    # long by another process), just hash the files
+    key = _cache_key(algorithm)
+    try:
+        hashes, signatures = cache.lookup(paths, key)
+    except sqlite3.Error:
+        return _hash_files(paths, threads, threads_per_device, algorithm)
+    missing = [path for path in paths if path not in hashes]
+    new_hashes = _hash_files(missing, threads, threads_per_device, algorithm)
+    try:
+        cache.store(new_hashes, signatures, key)
+    except sqlite3.Error:
+        pass
+    hashes.update(new_hashes)
+    return hashes
+
+
+def _cache_key(algorithm):
+    # Whether a file is fingerprinted depends on the sampling settings, so
+    # these are part of the key of the cached hashes
+    key = algorithm
+    threshold = SETTINGS.hash_sample_threshold
+    if threshold > 0:
+        key += '/sampled-{}-{}'.format(threshold,
+                                       SETTINGS.hash_sample_blocks)
+    threshold = SETTINGS.hash_tree_threshold
+    if threshold > 0:
+        key += '/tree-{}-{}'.format(threshold, SETTINGS.hash_tree_leaf_size)
+    return key
+
+
+def cached_hash_file(path, cache=None, algorithm=None):
+    """Like `hash_file`, but use the hash cache if one is given."""
+    if cache is None:
+        return hash_file(path, algorithm)
+    return hash_files([path], cache=cache, algorithm=algorithm)[path]
+
+
+def _hash_files(paths, threads, threads_per_device, algorithm):
+    # The leaves of tree-hashed files are hashed on the same pool as the
+    # other files (not on a pool per file), so the number of concurrent reads
+    # from a device stays within threads_per_device
+    trees = set(path for path in paths if _use_tree_hash(path))
+    if threads <= 1 or (len(paths) <= 1 and not trees):
+        return dict((path, hash_file(path, algorithm)) for path in paths)
+
+    jobs = _interleave_devices(paths)
+    limits = {}
+    if threads_per_device > 0:
+        for dev, _ in jobs:
+            if dev not in limits:
+                limits[dev] = threading.Semaphore(threads_per_device)
+
+    def work(dev, func, *args):
+        limit = limits.get(dev)
+        if limit is None:
+            return func(*args)
+        with limit:
+            return func(*args)
+
+    # Imported here: concurrent.futures is slow to import, and is only needed
+    # for the files of a run that are hashed at exit
+    from concurrent.futures import ThreadPoolExecutor
+    pool = ThreadPoolExecutor(max_workers=threads)
+    try:
+        results = []
+        for dev, path in jobs:
+            if path in trees:
+                results.append((path, _submit_tree(pool, work, dev, path,
+                                                   algorithm)))
+            else:
+                future = pool.submit(work, dev, hash_file, path, algorithm)
+                results.append((path, future.result))
+        return dict((path, result()) for path, result in results)
+    finally:
+        pool.shutdown()
+
+
+def _use_tree_hash(path):
+    try:
+        return use_tree_hash(path)
+    except OSError:
+        return False
+
+
+def _submit_tree(pool, work, dev, path, algorithm):
+    """Submit the leaves of a tree-hashed file to `pool`, and return a
+    function that waits for them and returns the digest of the file (None if
+    it can't be read)."""
+    leaf_size = SETTINGS.hash_tree_leaf_size
+    try:
+        tree = _TreeHasher(path, [algorithm], leaf_size)
+    except Exception:
+        return lambda: None
+    futures = [pool.submit(work, dev, tree.hash_leaf, i)
+               for i in range(tree.leaves)]
+
+    def result():
+        try:
+            digests = [future.result() for future in futures]
+        except Exception:
+            return None
+        finally:
+            # Wait for all leaves before closing the file they read
+            for future in futures:
+                future.exception()
+            tree.close()
+        return tree_prefix(leaf_size) + \
+            tag_digest(algorithm, tree.roots(digests)[algorithm])
+    return result
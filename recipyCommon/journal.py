@@ -0,0 +1,263 @@
+"""
+Append-only run journals.
+
+While a script runs, every change to its run record is appended as one line of
+JSON to a journal file next to the database (``journals/<unique_id>.jsonl``).
+Each event is a single ``O_APPEND`` write, so logging stays cheap and a killed
+process leaves behind everything it logged up to that point. When the run
+finishes normally, the record is written to the database and the journal is
+removed; journals left behind by crashed or killed runs can be folded into the
+database with ``recipy db compact``.
+
+Child processes of a script (e.g., multiprocessing workers) don't write to the
+database: they forward their events to the run of the script through journals
+of their own (``journals/<unique_id>.children/<pid>.jsonl``), which are merged
+into the run when the script exits (see `recipy.runrecord.RunRecord`).
+"""
+import os
+import json
+import shutil
+import socket
+import errno
+from datetime import datetime
+
+from .config import get_db_path
+from .storage import open_storage
+from .blobstore import get_blob_store, save_run, save_file_diffs
+from .utils import json_serializer, UniqueList
+
+JOURNAL_DIR = 'journals'
+JOURNAL_EXT = '.jsonl'
+CHILDREN_EXT = '.children'
+
+# Events that child processes may forward to the run of their parent; the
+# other fields of the run belong to the parent
+CHILD_EVENTS = ('append', 'extend', 'replace', 'update', 'filediff')
+
+# Fields of the run that are stored as datetime objects
+DATE_FIELDS = ('date', 'exit_date')
+
+
+def get_journal_dir(db_path=None):
+    """Return the directory holding the run journals for the database."""
+    if db_path is None:
+        db_path = get_db_path()
+    return os.path.join(os.path.dirname(os.path.abspath(db_path)),
+                        JOURNAL_DIR)
+
+
+def get_journal_path(unique_id, db_path=None):
+    return os.path.join(get_journal_dir(db_path), unique_id + JOURNAL_EXT)
+
+
+def get_child_journal_dir(unique_id, db_path=None):
+    """Return the directory holding the journals of the child processes of a
+    run."""
+    return os.path.join(get_journal_dir(db_path), unique_id + CHILDREN_EXT)
+
+
+def get_child_journal_path(unique_id, pid, db_path=None):
+    return os.path.join(get_child_journal_dir(unique_id, db_path),
+                        '{}{}'.format(pid, JOURNAL_EXT))
+
+
+class RunJournal(object):
+    """Append-only JSON-lines journal for a single run."""
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self._fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                           0o644)
+
+    def write(self, event, **data):
+        """Append one event to the journal with a single write."""
+        data['event'] = event
+        line = json.dumps(data, default=json_serializer) + '\n'
+        os.write(self._fd, line.encode('utf-8'))
+
+    def claim(self):
+        """Record the current process as the owner of the journal (e.g., the
+        finalizer, once it is detached from the script)."""
+        self.write('owner', pid=os.getpid(), host=socket.gethostname())
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def remove(self):
+        """Close and delete the journal (the run is safely in the DB)."""
+        self.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+def read_journal(path):
+    """Return the list of events stored in a journal.
+
+    A process that is killed halfway through a write can leave a truncated
+    last line behind; such lines are ignored.
+    """
+    events = []
+    with open(path, 'rb') as f:
+        for line in f:
+            try:
+                events.append(json.loads(line.decode('utf-8')))
+            except ValueError:
+                pass
+    return events
+
+
+def read_child_journals(directory):
+    """Return the events forwarded by the child processes of a run (only
+    those in CHILD_EVENTS) from the directory of their journals, one child
+    after the other."""
+    if not os.path.isdir(directory):
+        return []
+    events = []
+    for name in sorted(os.listdir(directory)):
+        if name.endswith(JOURNAL_EXT):
+            path = os.path.join(directory, name)
+            events.extend(e for e in read_journal(path)
+                          if e.get('event') in CHILD_EVENTS)
+    return events
+
+
+def _parse_date(value):
+    if isinstance(value, datetime) or value is None:
+        return value
+    # isoformat() leaves out the microseconds if they are 0
+    if '.' in value:
+        return datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%f')
+    return datetime.strptime(value, '%Y-%m-%dT%H:%M:%S')
+
+
+def _unique_values(run, field):
+    values = run.get(field)
+    if not isinstance(values, UniqueList):
+        values = run[field] = UniqueList(values or [])
+    return values
+
+
+def fold_events(events):
+    """Replay journal events into a run dict.
+
+    Returns a tuple (run, file_diffs, owner), where owner is a dict with the
+    pid and host of the process that writes the journal (the last one that
+    claimed it). The run is None if the journal does not contain a start
+    event.
+    """
+    run = None
+    file_diffs = []
+    owner = {}
+    for e in events:
+        event = e['event']
+        if event == 'start':
+            run = e['run']
+            owner = {'pid': e.get('pid'), 'host': e.get('host')}
+        elif run is None:
+            continue
+        elif event == 'append':
+            _unique_values(run, e['field']).add(e['value'])
+        elif event == 'extend':
+            _unique_values(run, e['field']).extend(e['values'])
+        elif event == 'replace':
+            _unique_values(run, e['field']).replace(e['old'], e['value'])
+        elif event == 'update':
+            run.setdefault(e['field'], {}).update(e['value'])
+        elif event == 'set':
+            run[e['field']] = e['value']
+        elif event == 'filediff':
+            file_diffs.append(e['value'])
+        elif event == 'owner':
+            owner = {'pid': e.get('pid'), 'host': e.get('host')}
+
+    if run is not None:
+        for field in DATE_FIELDS:
+            if field in run:
+                run[field] = _parse_date(run[field])
+
+    return run, file_diffs, owner
+
+
+def journal_owner_alive(owner):
+    """Return True if the process that owns a journal is still running."""
+    if owner.get('host') != socket.gethostname() or not owner.get('pid'):
+        # We can't check processes on other hosts
+        return False
+    try:
+        os.kill(owner['pid'], 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def compact_journal(path, db, store=None):
+    """Fold the events of a journal into the database and remove it.
+
+    The run is matched on its unique_id; if the run never made it into the
+    database it is inserted. Returns the run's unique_id, or None if the
+    journal was empty. The events of the child processes of the run are
+    folded in too. Like runs that are saved normally, large text fields are
+    kept in the blob `store`, if it is given.
+    """
+    events = read_journal(path)
+    run, file_diffs, _ = fold_events(events)
+    if run is None:
+        os.remove(path)
+        return None
+    children_dir = os.path.splitext(path)[0] + CHILDREN_EXT
+    children = read_child_journals(children_dir)
+    if children:
+        run, file_diffs, _ = fold_events(events + children)
+
+    existing = db.get_run_by_unique_id(run['unique_id'])
+    run_id = save_run(db, existing.run_id if existing is not None else None,
+                      run, store)
+
+    if file_diffs and not db.get_file_diffs(run_id):
+        for d in file_diffs:
+            d['run_id'] = run_id
+        save_file_diffs(db, file_diffs, store)
+
+    os.remove(path)
+    shutil.rmtree(children_dir, ignore_errors=True)
+    return run['unique_id']
+
+
+def compact_journals(db_path=None, include_live=False):
+    """Compact all journals left next to the database.
+
+    Journals of runs that are still in progress on this host are skipped,
+    unless `include_live` is True. Returns the list of compacted run ids.
+    """
+    if db_path is None:
+        db_path = get_db_path()
+    journal_dir = get_journal_dir(db_path)
+    if not os.path.isdir(journal_dir):
+        return []
+
+    paths = sorted(os.path.join(journal_dir, name)
+                   for name in os.listdir(journal_dir)
+                   if name.endswith(JOURNAL_EXT))
+    compacted = []
+    db = open_storage(path=db_path)
+    store = get_blob_store(db_path)
+    try:
+        for path in paths:
+            if not include_live:
+                # The owner is the script, or the finalizer that claimed
+                # the journal when it was detached
+                _, _, owner = fold_events(read_journal(path))
+                if journal_owner_alive(owner):
+                    continue
+            unique_id = compact_journal(path, db, store)
+            if unique_id is not None:
+                compacted.append(unique_id)
+    finally:
+        db.close()
+    return compacted
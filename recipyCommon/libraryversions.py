@@ -1,21 +1,53 @@
+import re
 import sys
-import pkg_resources
 import warnings
 import numbers
 
 import six
 
+# Versions of the libraries that have been looked up in this process, keyed
+# on the root module name. Versions don't change while a script runs, so they
+# are resolved only once.
+_versions = {}
+
+# Map of root module names to the names of the distributions that provide
+# them (e.g., sklearn -> scikit-learn), built when it is first needed
+_distributions = None
+
 
 def get_version(modulename):
     "Return a string containing the module name and the library version."
-    version = '?'
-
     # Get the root module name (in case we have something like `recipy.open`
     # or `matplotlib.pyplot`)
     modulename = modulename.split('.')[0]
 
+    try:
+        return _versions[modulename]
+    except KeyError:
+        pass
+    return _resolve_version(modulename)
+
+
+def get_versions(modulenames):
+    """Return the version strings (see `get_version`) of a number of modules.
+
+    The versions that are not cached yet are looked up together, with one
+    pass over the installed distributions (instead of one per module).
+    """
+    roots = [m.split('.')[0] for m in modulenames]
+    missing = [m for m in roots if m not in _versions and m in sys.modules]
+    metadata = _metadata()
+    if len(missing) > 1 and metadata is not None:
+        installed = _installed_versions(metadata)
+        for modulename in missing:
+            _resolve_version(modulename, installed)
+    return [get_version(m) for m in roots]
+
+
+def _resolve_version(modulename, installed=None):
+    version = '?'
     if modulename in sys.modules:
-        version = _get_version_from_pkg_resources(modulename)
+        version = _get_version_from_metadata(modulename, installed)
         if version == '?':
             version = _get_version_from_module(modulename)
     else:
@@ -27,17 +59,81 @@ def get_version(modulename):
     if not isinstance(version, (six.string_types, numbers.Number)):
         version = '?'
 
-    return '{} v{}'.format(modulename, version)
+    result = '{} v{}'.format(modulename, version)
+    # Modules that are not imported yet may be imported later
+    if modulename in sys.modules:
+        _versions[modulename] = result
+    return result
 
 
-def _get_version_from_pkg_resources(modulename):
-    ws = pkg_resources.working_set
-    package = ws.find(pkg_resources.Requirement(modulename))
+def _metadata():
+    # importlib.metadata is imported when the first version is needed, not
+    # when recipy is imported
     try:
-        version = package.version
-    except AttributeError:
-        version = '?'
-    return version
+        from importlib import metadata
+    except ImportError:  # Python < 3.8
+        try:
+            import importlib_metadata as metadata
+        except ImportError:
+            return None
+    return metadata
+
+
+def _normalize(name):
+    return re.sub(r'[-_.]+', '-', name).lower()
+
+
+def _installed_versions(metadata):
+    """Return a dict mapping the (normalized) names of the installed
+    distributions to their versions. Like `metadata.version`, the first
+    distribution found on sys.path wins."""
+    versions = {}
+    for dist in metadata.distributions():
+        name = dist.metadata['Name']
+        if name:
+            versions.setdefault(_normalize(name), dist.version)
+    return versions
+
+
+def _distribution_map(metadata):
+    global _distributions
+    if _distributions is None:
+        if hasattr(metadata, 'packages_distributions'):
+            _distributions = metadata.packages_distributions()
+        else:
+            _distributions = {}
+            for dist in metadata.distributions():
+                top_level = dist.read_text('top_level.txt') or ''
+                for name in top_level.split():
+                    _distributions.setdefault(name, []).append(
+                        dist.metadata['Name'])
+    return _distributions
+
+
+def _get_version_from_metadata(modulename, installed=None):
+    """Look up the version of the distribution that provides a module (in
+    `installed`, see `_installed_versions`, if it is given)."""
+    metadata = _metadata()
+    if metadata is None:
+        return '?'
+
+    def version(name):
+        if installed is not None:
+            return installed.get(_normalize(name))
+        try:
+            return metadata.version(name)
+        except (metadata.PackageNotFoundError, ValueError):
+            return None
+
+    # Most distributions have the same name as their module
+    result = version(modulename)
+    if result is not None:
+        return result
+    for dist in _distribution_map(metadata).get(modulename, []):
+        result = version(dist)
+        if result is not None:
+            return result
+    return '?'
 
 
 def _get_version_from_module(modulename):
@@ -0,0 +1,196 @@
+"""
+Snapshots of output files, for file diffs.
+
+With ``file_diff_outputs``, an output file that exists before the script
+writes it is kept, so it can be diffed with the new version at exit. The
+snapshots of a run are stored in ``snapshots/<unique_id>/`` next to the
+database. A snapshot is a reflink (``FICLONE``, on filesystems such as Btrfs
+and XFS), which shares the blocks of the file until it is overwritten and
+costs nothing to make; elsewhere the file is copied, unless it is larger
+than ``file_diff_max_size``. Only the version from before the run is kept:
+an output that is rewritten in a loop is snapshotted once, and an output
+that the run creates is never snapshotted, even if the run rewrites it. A
+run keeps at most ``file_diff_budget`` bytes of snapshots.
+
+Hardlinks are not used: most writers truncate and rewrite a file in place,
+which would change the snapshot too.
+
+Every snapshot directory records the process that owns it. Directories of
+processes that are gone (e.g., killed runs) are removed by
+`cleanup_snapshots`, which is called when a run takes its first snapshot.
+Directories that don't record their owner yet (they were just made) are
+left alone for a while.
+"""
+import os
+import json
+import time
+import errno
+import shutil
+import socket
+import warnings
+
+from .config import get_db_path, get_file_diff_max_size, \
+    get_file_diff_budget
+from .journal import journal_owner_alive
+
+SNAPSHOT_DIR = 'snapshots'
+OWNER_FILE = 'owner.json'
+
+# ioctl that clones a file on Linux (_IOW(0x94, 9, int))
+FICLONE = 0x40049409
+
+# Snapshot directories of other hosts are only removed after this many
+# seconds, as we can't tell if their runs are still going
+FOREIGN_MAX_AGE = 7 * 24 * 3600
+
+# Snapshot directories without an owner are only removed after this many
+# seconds, as their owner may be about to be recorded
+NEW_MAX_AGE = 60
+
+
+def get_snapshot_dir(db_path=None):
+    """Return the directory holding the snapshots for the database."""
+    if db_path is None:
+        db_path = get_db_path()
+    return os.path.join(os.path.dirname(os.path.abspath(db_path)),
+                        SNAPSHOT_DIR)
+
+
+def reflink(src, dst):
+    """Make `dst` a clone of `src` that shares its blocks; raises OSError if
+    the filesystem (or platform) doesn't support it."""
+    try:
+        import fcntl
+    except ImportError:
+        raise OSError(errno.EOPNOTSUPP, 'reflinks are not supported')
+    with open(src, 'rb') as s:
+        fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        try:
+            fcntl.ioctl(fd, FICLONE, s.fileno())
+        except (IOError, OSError):
+            os.close(fd)
+            os.remove(dst)
+            raise
+        os.close(fd)
+    shutil.copystat(src, dst)
+
+
+def _owner_alive(directory):
+    try:
+        with open(os.path.join(directory, OWNER_FILE)) as f:
+            owner = json.load(f)
+    except (IOError, OSError, ValueError):
+        return time.time() - os.path.getmtime(directory) < NEW_MAX_AGE
+    if journal_owner_alive(owner):
+        return True
+    if owner.get('host') not in (None, socket.gethostname()):
+        return time.time() - os.path.getmtime(directory) < FOREIGN_MAX_AGE
+    return False
+
+
+def cleanup_snapshots(db_path=None):
+    """Remove the snapshot directories of runs whose process is gone.
+    Returns the number of removed directories."""
+    root = get_snapshot_dir(db_path)
+    if not os.path.isdir(root):
+        return 0
+    removed = 0
+    for name in os.listdir(root):
+        directory = os.path.join(root, name)
+        try:
+            if not os.path.isdir(directory) or _owner_alive(directory):
+                continue
+        except OSError:
+            continue
+        shutil.rmtree(directory, ignore_errors=True)
+        removed += 1
+    return removed
+
+
+class RunSnapshots(object):
+    """The snapshots taken by one run, of the versions of files from
+    before the run.
+
+    `owner` is the pid of the process that runs the script (default: the
+    current process); child processes of the script take snapshots in the
+    same directory.
+    """
+    def __init__(self, unique_id, db_path=None, max_copy_size=None,
+                 budget=None, owner=None):
+        self.unique_id = unique_id
+        self.owner = owner
+        self.path = os.path.join(get_snapshot_dir(db_path), unique_id)
+        self.max_copy_size = get_file_diff_max_size() \
+            if max_copy_size is None else max_copy_size
+        self.budget = get_file_diff_budget() if budget is None else budget
+        self.used = 0
+        # Snapshots by file name
+        self.files = {}
+        self._budget_warned = False
+
+    def claim(self, owner=None):
+        """Record the owner of the snapshots (e.g., the finalizer, once it
+        was detached)."""
+        if owner is not None:
+            self.owner = owner
+        try:
+            os.makedirs(self.path)
+        except OSError:
+            # Child processes of the run may create it at the same time
+            if not os.path.isdir(self.path):
+                raise
+        pid = os.getpid() if self.owner is None else self.owner
+        # Written to a temporary file first, so `cleanup_snapshots` never
+        # reads a partial owner
+        path = os.path.join(self.path, OWNER_FILE)
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump({'pid': pid, 'host': socket.gethostname()}, f)
+        os.replace(tmp, path)
+
+    def take(self, filename, is_binary=None):
+        """Keep the current version of `filename`; returns the path of the
+        snapshot, or None if no snapshot was taken (the file was seen before,
+        or it doesn't exist, or it is too large, or binary).
+
+        `is_binary` is a function that tells if a file is binary. Binary
+        files are not copied (a clone is cheap enough to check it later).
+        """
+        if filename in self.files:
+            return None
+        if not os.path.isfile(filename):
+            # The run creates the file: there is no version from before the
+            # run, and the versions the run writes are not kept either
+            self.files[filename] = None
+            return None
+        size = os.path.getsize(filename)
+        if self.used + size > self.budget:
+            if not self._budget_warned:
+                warnings.warn('recipy: not keeping {} for its file diff; the '
+                              'run has used its file_diff_budget'.format(
+                                  filename))
+                self._budget_warned = True
+            return None
+        if not os.path.isdir(self.path):
+            self.claim()
+        # Child processes inherit `files`, so the names include the pid
+        snapshot = os.path.join(self.path, '{}-{}'.format(os.getpid(),
+                                                          len(self.files)))
+        try:
+            reflink(filename, snapshot)
+        except (IOError, OSError):
+            if is_binary is not None and is_binary(filename):
+                return None
+            if size > self.max_copy_size:
+                warnings.warn('recipy: not keeping {} for its file diff; it '
+                              'is larger than file_diff_max_size'.format(
+                                  filename))
+                return None
+            shutil.copy2(filename, snapshot)
+        self.used += size
+        self.files[filename] = snapshot
+        return snapshot
+
+    def remove(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+        self.files = {}
@@ -0,0 +1,437 @@
+"""
+SQLite storage backend for the recipy database.
+
+Runs are stored in normalized tables (runs, inputs, outputs, libraries,
+warnings, filediffs and patches), with indexes on file hashes, absolute paths,
+script, date and unique_id, so searches don't have to scan the whole database.
+The database runs in WAL mode, so readers (e.g., the GUI) never block a script
+that is logging a run.
+
+Select this backend by adding ``backend = sqlite`` to the ``[database]``
+section of recipyrc. Existing TinyDB databases can be converted with
+``recipy db migrate``.
+"""
+import os
+import re
+import json
+import sqlite3
+from datetime import datetime
+
+import six
+
+from .storage import StorageBackend, Run
+from .blobstore import is_blob_ref, copy_blobs
+from .utils import json_serializer, UniqueList
+
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+# Run fields that are stored as datetime objects
+DATE_FIELDS = ('date', 'exit_date')
+
+# Run fields that have a column of their own in the runs table
+RUN_COLUMNS = ('unique_id', 'script', 'date', 'author', 'notes')
+
+# List fields that are stored in a table of their own
+FILE_FIELDS = ('inputs', 'outputs')
+LIST_FIELDS = FILE_FIELDS + ('libraries', 'warnings')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    unique_id TEXT NOT NULL UNIQUE,
+    script TEXT,
+    date TEXT,
+    author TEXT,
+    notes TEXT,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS inputs (
+    run_id INTEGER NOT NULL REFERENCES runs(id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    path TEXT,
+    hash TEXT,
+    hashed INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS outputs (
+    run_id INTEGER NOT NULL REFERENCES runs(id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    path TEXT,
+    hash TEXT,
+    hashed INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS libraries (
+    run_id INTEGER NOT NULL REFERENCES runs(id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    library TEXT
+);
+CREATE TABLE IF NOT EXISTS warnings (
+    run_id INTEGER NOT NULL REFERENCES runs(id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    warning TEXT
+);
+CREATE TABLE IF NOT EXISTS filediffs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    run_id INTEGER NOT NULL,
+    filename TEXT,
+    tempfilename TEXT,
+    diff TEXT
+);
+CREATE TABLE IF NOT EXISTS patches (
+    modulename TEXT PRIMARY KEY,
+    input_functions TEXT,
+    output_functions TEXT
+);
+CREATE INDEX IF NOT EXISTS runs_script ON runs(script);
+CREATE INDEX IF NOT EXISTS runs_date ON runs(date);
+CREATE INDEX IF NOT EXISTS inputs_run ON inputs(run_id);
+CREATE INDEX IF NOT EXISTS inputs_hash ON inputs(hash);
+CREATE INDEX IF NOT EXISTS inputs_path ON inputs(path);
+CREATE INDEX IF NOT EXISTS outputs_run ON outputs(run_id);
+CREATE INDEX IF NOT EXISTS outputs_hash ON outputs(hash);
+CREATE INDEX IF NOT EXISTS outputs_path ON outputs(path);
+CREATE INDEX IF NOT EXISTS libraries_run ON libraries(run_id);
+CREATE INDEX IF NOT EXISTS warnings_run ON warnings(run_id);
+CREATE INDEX IF NOT EXISTS filediffs_run ON filediffs(run_id);
+"""
+
+# SQL for the filters of `StorageBackend.iter_runs`. Every ? is bound to the
+# value of the filter.
+FILTER_SQL = {
+    'hash': 'id IN (SELECT run_id FROM inputs WHERE hash = ? '
+            'UNION SELECT run_id FROM outputs WHERE hash = ?)',
+    'path': 'id IN (SELECT run_id FROM inputs WHERE path = ? '
+            'UNION SELECT run_id FROM outputs WHERE path = ?)',
+    'path_regex': 'id IN (SELECT run_id FROM inputs '
+                  'WHERE REGEXP_MATCH(?, path) '
+                  'UNION SELECT run_id FROM outputs '
+                  'WHERE REGEXP_MATCH(?, path))',
+    'unique_id': 'unique_id = ?',
+    'unique_id_prefix': 'REGEXP_MATCH(?, unique_id)',
+    'script': 'script = ?',
+    'text': '(id IN (SELECT run_id FROM inputs '
+            'WHERE REGEXP(?, path) OR REGEXP(?, hash) '
+            'UNION SELECT run_id FROM outputs '
+            'WHERE REGEXP(?, path) OR REGEXP(?, hash)) '
+            'OR REGEXP(?, script) OR REGEXP(?, notes) '
+            'OR REGEXP(?, unique_id))',
+    'since': 'date >= ?',
+    'until': 'date <= ?',
+}
+
+
+def _encode_date(value):
+    if isinstance(value, datetime):
+        return value.strftime(DATE_FORMAT)
+    return value
+
+
+def _decode_date(value):
+    if value is None or isinstance(value, datetime):
+        return value
+    try:
+        return datetime.strptime(value[:19], DATE_FORMAT)
+    except ValueError:
+        return value
+
+
+def _encode_diff(value):
+    # References to the blob store are stored as JSON in the diff column
+    if is_blob_ref(value):
+        return json.dumps(value, sort_keys=True)
+    return value
+
+
+def _decode_diff(value):
+    if value.startswith('{"blob": '):
+        try:
+            ref = json.loads(value)
+        except ValueError:
+            return value
+        if is_blob_ref(ref):
+            return ref
+    return value
+
+
+def _regexp(pattern, value):
+    # Implements `pattern REGEXP value` with re.search semantics
+    if value is None:
+        return False
+    return re.search(pattern, value) is not None
+
+
+def _regexp_match(pattern, value):
+    # Like _regexp, but anchored at the start (re.match semantics)
+    if value is None:
+        return False
+    return re.match(pattern, value) is not None
+
+
+class SQLiteStorage(StorageBackend):
+    """Storage backed by an SQLite database."""
+    def __init__(self, path):
+        super(SQLiteStorage, self).__init__(path)
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.exists(directory):
+            os.mkdir(directory)
+
+        self.conn = sqlite3.connect(path, timeout=30,
+                                    check_same_thread=False)
+        self.conn.create_function('REGEXP', 2, _regexp)
+        self.conn.create_function('REGEXP_MATCH', 2, _regexp_match)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('PRAGMA foreign_keys=ON')
+        with self.conn:
+            self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    # Runs
+
+    def insert_run(self, run, run_id=None):
+        with self.conn:
+            cur = self.conn.execute(
+                'INSERT INTO runs (id, unique_id, data) VALUES (?, ?, ?)',
+                (run_id, run['unique_id'], '{}'))
+            run_id = cur.lastrowid
+            self._write_fields(run_id, run)
+        return run_id
+
+    def update_run(self, run_id, fields):
+        with self.conn:
+            self._write_fields(run_id, fields)
+
+    def _write_fields(self, run_id, fields):
+        row = self.conn.execute('SELECT data FROM runs WHERE id = ?',
+                                (run_id,)).fetchone()
+        if row is None:
+            raise KeyError('Run {} does not exist'.format(run_id))
+        data = json.loads(row[0])
+
+        for field, value in fields.items():
+            if field in RUN_COLUMNS:
+                self.conn.execute(
+                    'UPDATE runs SET {} = ? WHERE id = ?'.format(field),
+                    (_encode_date(value), run_id))
+            elif field in LIST_FIELDS:
+                self._write_list(run_id, field, value)
+            else:
+                data[field] = _encode_date(value)
+
+        self.conn.execute('UPDATE runs SET data = ? WHERE id = ?',
+                          (json.dumps(data, default=json_serializer),
+                           run_id))
+
+    def _write_list(self, run_id, field, values):
+        self.conn.execute('DELETE FROM {} WHERE run_id = ?'.format(field),
+                          (run_id,))
+        if field in FILE_FIELDS:
+            rows = []
+            for i, f in enumerate(values):
+                if isinstance(f, six.string_types):
+                    rows.append((run_id, i, f, None, 0))
+                else:
+                    rows.append((run_id, i, f[0], f[1], 1))
+            self.conn.executemany(
+                'INSERT INTO {} (run_id, position, path, hash, hashed) '
+                'VALUES (?, ?, ?, ?, ?)'.format(field), rows)
+        elif field == 'libraries':
+            self.conn.executemany(
+                'INSERT INTO libraries (run_id, position, library) '
+                'VALUES (?, ?, ?)',
+                [(run_id, i, v) for i, v in enumerate(values)])
+        else:
+            self.conn.executemany(
+                'INSERT INTO warnings (run_id, position, warning) '
+                'VALUES (?, ?, ?)',
+                [(run_id, i, json.dumps(v, default=json_serializer))
+                 for i, v in enumerate(values)])
+
+    def _load_runs(self, where='', params=(), order='id'):
+        rows = self.conn.execute(
+            'SELECT id, unique_id, script, date, author, notes, data '
+            'FROM runs {} ORDER BY {}'.format(where, order), params).fetchall()
+        if not rows:
+            return []
+
+        runs = {}
+        result = []
+        for row in rows:
+            run = Run(json.loads(row[6]), row[0])
+            for i, column in enumerate(RUN_COLUMNS):
+                value = row[i + 1]
+                if value is not None or column != 'notes':
+                    run[column] = value
+            for field in DATE_FIELDS:
+                if field in run:
+                    run[field] = _decode_date(run[field])
+            for field in LIST_FIELDS:
+                run[field] = []
+            runs[row[0]] = run
+            result.append(run)
+
+        ids = list(runs.keys())
+        # Stay well below SQLite's limit on the number of host parameters
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            marks = ','.join('?' * len(chunk))
+            for field in FILE_FIELDS:
+                for run_id, path, hash_value, hashed in self.conn.execute(
+                        'SELECT run_id, path, hash, hashed FROM {} '
+                        'WHERE run_id IN ({}) ORDER BY run_id, position'
+                        .format(field, marks), chunk):
+                    runs[run_id][field].append(
+                        [path, hash_value] if hashed else path)
+            for run_id, library in self.conn.execute(
+                    'SELECT run_id, library FROM libraries '
+                    'WHERE run_id IN ({}) ORDER BY run_id, position'
+                    .format(marks), chunk):
+                runs[run_id]['libraries'].append(library)
+            for run_id, warning in self.conn.execute(
+                    'SELECT run_id, warning FROM warnings '
+                    'WHERE run_id IN ({}) ORDER BY run_id, position'
+                    .format(marks), chunk):
+                runs[run_id]['warnings'].append(json.loads(warning))
+
+        return result
+
+    def append_events(self, run_id, field, values):
+        existing = self.get_run(run_id).get(field, [])
+        new_values = UniqueList(existing)
+        for value in values:
+            if isinstance(value, tuple):
+                value = list(value)
+            new_values.add(value)
+        if len(new_values) != len(existing):
+            self.update_run(run_id, {field: list(new_values)})
+
+    def get_run(self, run_id):
+        runs = self._load_runs('WHERE id = ?', (run_id,))
+        return runs[0] if runs else None
+
+    def iter_runs(self, **filters):
+        clauses = []
+        params = []
+        for name, value in filters.items():
+            if name not in FILTER_SQL:
+                raise ValueError('Unknown filter: {}'.format(name))
+            sql = FILTER_SQL[name]
+            n = sql.count('?')
+            if name in ('hash', 'path') and isinstance(value, (list, tuple)):
+                # Match any of a list of values
+                sql = sql.replace('= ?', 'IN (%s)' %
+                                  ', '.join('?' * len(value)))
+                params.extend(list(value) * n)
+            else:
+                params.extend([_encode_date(value)] * n)
+            clauses.append(sql)
+        where = 'WHERE ' + ' AND '.join(clauses) if clauses else ''
+        return iter(self._load_runs(where, params))
+
+    def latest_run(self):
+        runs = self._load_runs(
+            'WHERE id = (SELECT id FROM runs ORDER BY date DESC, id DESC '
+            'LIMIT 1)')
+        return runs[0] if runs else None
+
+    # File diffs
+
+    def add_file_diffs(self, file_diffs):
+        with self.conn:
+            self.conn.executemany(
+                'INSERT INTO filediffs (run_id, filename, tempfilename, diff) '
+                'VALUES (?, ?, ?, ?)',
+                [(d['run_id'], d.get('filename'), d.get('tempfilename'),
+                  _encode_diff(d.get('diff'))) for d in file_diffs])
+
+    def get_file_diffs(self, run_id):
+        return self._load_file_diffs('WHERE run_id = ?', (run_id,))
+
+    def iter_file_diffs(self):
+        return iter(self._load_file_diffs())
+
+    def _load_file_diffs(self, where='', params=()):
+        rows = self.conn.execute(
+            'SELECT run_id, filename, tempfilename, diff FROM filediffs '
+            '{} ORDER BY id'.format(where), params).fetchall()
+        diffs = []
+        for row in rows:
+            d = {'run_id': row[0], 'filename': row[1], 'tempfilename': row[2]}
+            if row[3] is not None:
+                d['diff'] = _decode_diff(row[3])
+            diffs.append(d)
+        return diffs
+
+    # Patches registry
+
+    def get_patches(self):
+        return [{'modulename': m,
+                 'input_functions': json.loads(i),
+                 'output_functions': json.loads(o)}
+                for m, i, o in self.conn.execute(
+                    'SELECT modulename, input_functions, output_functions '
+                    'FROM patches')]
+
+    def add_patch(self, modulename, input_functions, output_functions):
+        with self.conn:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO patches '
+                '(modulename, input_functions, output_functions) '
+                'VALUES (?, ?, ?)',
+                (modulename, json.dumps(input_functions),
+                 json.dumps(output_functions)))
+
+    def reset_patches(self):
+        with self.conn:
+            self.conn.execute('DELETE FROM patches')
+
+    def set_patches(self, patches):
+        with self.conn:
+            self.conn.execute('DELETE FROM patches')
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO patches '
+                '(modulename, input_functions, output_functions) '
+                'VALUES (?, ?, ?)',
+                [(p['modulename'], json.dumps(p['input_functions']),
+                  json.dumps(p['output_functions'])) for p in patches])
+
+
+def migrate_tinydb(tinydb_path, sqlite_path):
+    """Copy all runs, file diffs, patches and blobs from a TinyDB database
+    into an SQLite database.
+
+    This is a one-shot conversion into a new (empty) SQLite database. Run ids
+    are preserved, so file diffs keep pointing at the right run. Returns the
+    number of runs that were copied.
+    """
+    from .tinydb_storage import TinyDBStorage
+
+    tinydb_path = os.path.abspath(tinydb_path)
+    if not os.path.isfile(tinydb_path):
+        raise ValueError('Cannot migrate {}: no such file'.format(tinydb_path))
+
+    source = TinyDBStorage(tinydb_path)
+    target = SQLiteStorage(sqlite_path)
+    try:
+        if target.conn.execute('SELECT COUNT(*) FROM runs').fetchone()[0]:
+            raise ValueError('Cannot migrate into {}: the database is not '
+                             'empty'.format(sqlite_path))
+        runs = source.all_runs()
+        with target.conn:
+            for run in runs:
+                target.conn.execute(
+                    'INSERT INTO runs (id, unique_id, data) VALUES (?, ?, ?)',
+                    (run.run_id, run['unique_id'], '{}'))
+                target._write_fields(run.run_id, run)
+
+        target.add_file_diffs(source.db.table('filediffs').all())
+        copy_blobs(tinydb_path, sqlite_path)
+        for patch in source.get_patches():
+            target.add_patch(patch['modulename'], patch['input_functions'],
+                             patch['output_functions'])
+    finally:
+        source.close()
+        target.close()
+
+    return len(runs)
@@ -0,0 +1,292 @@
+"""
+Access to the recipy database.
+
+All reads and writes of runs, file diffs and the patches registry go through a
+storage backend: a subclass of `StorageBackend` returned by `open_storage`.
+The backend is selected with the ``backend`` option in the ``[database]``
+section of recipyrc. recipy ships with two backends: ``tinydb`` (the default
+and reference implementation, a single JSON file) and ``sqlite`` (indexed, for
+large databases).
+
+Other packages can provide backends by registering a `StorageBackend`
+subclass under the ``recipy.storage`` entry point group, e.g., in setup.py::
+
+    entry_points={
+        'recipy.storage': ['mystore = mypackage.storage:MyStorage']
+    }
+
+and setting ``backend = mystore`` in recipyrc.
+"""
+import re
+import importlib
+
+import six
+
+from .config import get_db_path, get_db_backend
+
+ENTRY_POINT_GROUP = 'recipy.storage'
+
+# Backends that ship with recipy. These are also registered as entry points
+# in setup.py, but are listed here so they can be used from a source checkout.
+BUILTIN_BACKENDS = {
+    'tinydb': 'recipyCommon.tinydb_storage:TinyDBStorage',
+    'sqlite': 'recipyCommon.sqlite_storage:SQLiteStorage',
+}
+
+
+class Run(dict):
+    """A run, as returned by a storage backend.
+
+    A dict with all fields of the run, with the backend-specific id of the run
+    in the `run_id` attribute. Dates (`date`, `exit_date`) are datetime
+    objects.
+    """
+    def __init__(self, value, run_id):
+        super(Run, self).__init__(value)
+        self.run_id = run_id
+
+
+def file_path(f):
+    """Return the path of an entry in the inputs or outputs of a run.
+
+    Entries are either a path, or a (path, hash) pair if hashing is enabled.
+    """
+    if isinstance(f, six.string_types):
+        return f
+    try:
+        return f[0]
+    except IndexError:
+        return ''
+
+
+def file_hash(f):
+    """Return the hash of an entry in the inputs or outputs of a run (or None
+    if it was not hashed)."""
+    if isinstance(f, six.string_types):
+        return None
+    try:
+        return f[1]
+    except IndexError:
+        return None
+
+
+class StorageBackend(object):
+    """Interface of a recipy storage backend.
+
+    Subclasses must implement all methods that raise NotImplementedError.
+    Runs are dicts with the fields described in the database schema
+    documentation; they are identified by a backend-specific `run_id`, which
+    is returned by `insert_run` and stored in the `run_id` attribute of the
+    `Run` objects returned by the query methods.
+
+    Supported filters for `iter_runs` (all filters must match):
+
+    * hash - an input or output has this hash (or one of these hashes, if a
+      list is given)
+    * path - an input or output has this (absolute) path (or one of these
+      paths, if a list is given)
+    * path_regex - the path of an input or output matches this regular
+      expression (re.match semantics)
+    * unique_id - the unique id of the run
+    * unique_id_prefix - the unique id starts with this regular expression
+    * script - path of the script that was run
+    * text - regular expression (re.search semantics) that is searched in the
+      paths and hashes of the inputs and outputs, the script, the notes and
+      the unique id
+    * since, until - datetime bounds (inclusive) on the date of the run
+    """
+    FILTERS = ('hash', 'path', 'path_regex', 'unique_id', 'unique_id_prefix',
+               'script', 'text', 'since', 'until')
+
+    def __init__(self, path):
+        self.path = path
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    # Runs
+
+    def insert_run(self, run):
+        """Store a new run and return its run_id."""
+        raise NotImplementedError
+
+    def update_run(self, run_id, fields):
+        """Set (or replace) the given fields of a run."""
+        raise NotImplementedError
+
+    def append_events(self, run_id, field, values):
+        """Append values to a list field of a run, skipping duplicates."""
+        raise NotImplementedError
+
+    def get_run(self, run_id):
+        """Return the run with the given run_id, or None."""
+        raise NotImplementedError
+
+    def iter_runs(self, **filters):
+        """Iterate over the runs that match all filters, in insertion order."""
+        raise NotImplementedError
+
+    def latest_run(self):
+        """Return the run with the most recent date, or None."""
+        latest = None
+        for run in self.iter_runs():
+            if latest is None or run['date'] >= latest['date']:
+                latest = run
+        return latest
+
+    def get_run_by_unique_id(self, unique_id):
+        for run in self.iter_runs(unique_id=unique_id):
+            return run
+        return None
+
+    def all_runs(self):
+        return list(self.iter_runs())
+
+    def find_by_hash(self, value):
+        """Find runs with an input or output with this hash (or any of these
+        hashes, if a list is given)."""
+        return list(self.iter_runs(hash=value))
+
+    def find_by_path(self, path):
+        return list(self.iter_runs(path=path))
+
+    def find_by_path_regex(self, pattern):
+        return list(self.iter_runs(path_regex=pattern))
+
+    def find_by_id_prefix(self, prefix):
+        return list(self.iter_runs(unique_id_prefix=prefix))
+
+    def search_text(self, query):
+        return list(self.iter_runs(text=query))
+
+    # File diffs
+
+    def add_file_diffs(self, file_diffs):
+        """Store file diffs (dicts with run_id, filename, tempfilename and
+        diff)."""
+        raise NotImplementedError
+
+    def get_file_diffs(self, run_id):
+        """Return the list of file diffs for a run."""
+        raise NotImplementedError
+
+    def iter_file_diffs(self):
+        """Iterate over the file diffs of all runs."""
+        for run in self.iter_runs():
+            for file_diff in self.get_file_diffs(run.run_id):
+                yield file_diff
+
+    # Patches registry
+
+    def get_patches(self):
+        """Return the list of patched modules (dicts with modulename,
+        input_functions and output_functions)."""
+        raise NotImplementedError
+
+    def add_patch(self, modulename, input_functions, output_functions):
+        raise NotImplementedError
+
+    def reset_patches(self):
+        raise NotImplementedError
+
+    def set_patches(self, patches):
+        """Replace the patches registry with `patches` (dicts like the ones
+        returned by `get_patches`)."""
+        self.reset_patches()
+        for p in patches:
+            self.add_patch(p['modulename'], p['input_functions'],
+                           p['output_functions'])
+
+
+def match_run(run, filters):
+    """Return True if a run (dict) matches all filters (see
+    `StorageBackend.iter_runs`).
+
+    This is the reference semantics of the filters, used by backends that
+    don't have a query language of their own.
+    """
+    files = list(run.get('inputs') or []) + list(run.get('outputs') or [])
+    for name, value in filters.items():
+        if name == 'hash':
+            ok = any(file_hash(f) in _as_list(value) for f in files)
+        elif name == 'path':
+            ok = any(file_path(f) in _as_list(value) for f in files)
+        elif name == 'path_regex':
+            ok = any(re.match(value, file_path(f)) for f in files)
+        elif name == 'unique_id':
+            ok = run.get('unique_id') == value
+        elif name == 'unique_id_prefix':
+            ok = re.match(value, run.get('unique_id', '')) is not None
+        elif name == 'script':
+            ok = run.get('script') == value
+        elif name == 'text':
+            ok = _match_text(run, files, value)
+        elif name == 'since':
+            ok = run.get('date') is not None and run['date'] >= value
+        elif name == 'until':
+            ok = run.get('date') is not None and run['date'] <= value
+        else:
+            raise ValueError('Unknown filter: {}'.format(name))
+        if not ok:
+            return False
+    return True
+
+
+def _as_list(value):
+    if isinstance(value, (list, tuple)):
+        return value
+    return [value]
+
+
+def _match_text(run, files, query):
+    for f in files:
+        if re.search(query, file_path(f) or '') or \
+           re.search(query, file_hash(f) or ''):
+            return True
+    for field in ('script', 'notes', 'unique_id'):
+        value = run.get(field)
+        if isinstance(value, six.string_types) and re.search(query, value):
+            return True
+    return False
+
+
+def _load_entry_point(spec):
+    module_name, class_name = spec.split(':')
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+def _entry_points():
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:
+        return []
+    eps = entry_points()
+    if hasattr(eps, 'select'):
+        return list(eps.select(group=ENTRY_POINT_GROUP))
+    return list(eps.get(ENTRY_POINT_GROUP, []))
+
+
+def get_backend(name):
+    """Return the storage backend class registered under `name`."""
+    if name in BUILTIN_BACKENDS:
+        return _load_entry_point(BUILTIN_BACKENDS[name])
+    for ep in _entry_points():
+        if ep.name == name:
+            return ep.load()
+    raise ValueError('Unknown database backend: {}'.format(name))
+
+
+def open_storage(path=None, backend=None):
+    """Open (or create) the recipy database and return a storage backend."""
+    if path is None:
+        path = get_db_path()
+    if backend is None:
+        backend = get_db_backend()
+
+    return get_backend(backend)(path)
@@ -1,7 +1,9 @@
-from recipyCommon.config import find_editor
+from recipyCommon.config import find_editor, parse_size, apply_environment, \
+    Settings
 
 import unittest
 import mock
+from six.moves.configparser import RawConfigParser
 
 
 class TestConfig(unittest.TestCase):
@@ -25,3 +27,70 @@ class TestConfig(unittest.TestCase):
                 editor = find_editor()
 
         self.assertEquals(editor, 'vi')
+
+    def test_parse_size(self):
+        self.assertEqual(parse_size('1000'), 1000)
+        self.assertEqual(parse_size('4K'), 4096)
+        self.assertEqual(parse_size('1.5G'), 3 * 2 ** 29)
+        self.assertEqual(parse_size('2tb'), 2 * 2 ** 40)
+
+    def test_apply_environment(self):
+        config = RawConfigParser(allow_no_value=True)
+        config.add_section('general')
+        config.set('general', 'debug', None)
+        environ = {'RECIPY_GENERAL_DEBUG': 'off',
+                   'RECIPY_IGNORED_METADATA_DIFF': '1',
+                   'RECIPY_DATABASE_PATH': '/tmp/db.json',
+                   'RECIPY_DATA_HASH_ALGORITHM': 'blake2b',
+                   'RECIPY_UNKNOWN_OPTION': '1',
+                   'HOME': '/home/user'}
+
+        apply_environment(config, environ)
+
+        self.assertFalse(config.has_option('general', 'debug'))
+        self.assertTrue(config.has_option('ignored metadata', 'diff'))
+        self.assertEqual(config.get('database', 'path'), '/tmp/db.json')
+        self.assertEqual(config.get('data', 'hash_algorithm'), 'blake2b')
+        self.assertFalse(config.has_section('unknown'))
+
+    def test_settings(self):
+        config = RawConfigParser(allow_no_value=True)
+        config.read_string(u'[general]\ndebug\n'
+                           u'[ignored metadata]\ninput_hashes\n'
+                           u'[ignored outputs]\nnetCDF4\n')
+
+        settings = Settings(config)
+
+        self.assertTrue(settings.debug)
+        self.assertFalse(settings.quiet)
+        self.assertFalse(settings.hash_inputs)
+        self.assertTrue(settings.hash_outputs)
+        self.assertTrue(settings.is_set('ignored outputs', 'netCDF4'))
+        self.assertTrue(settings.ignore_outputs('netCDF4'))
+        self.assertFalse(settings.ignore_inputs('netCDF4'))
+        with self.assertRaises(AttributeError):
+            settings.debug = False
+
+    def test_settings_sampling(self):
+        config = RawConfigParser(allow_no_value=True)
+        config.read_string(u'[data]\nhash_sample_threshold = 10G\n'
+                           u'hash_sample_blocks = x\n')
+
+        settings = Settings(config)
+
+        self.assertEqual(settings.hash_sample_threshold, 10 * 2 ** 30)
+        self.assertEqual(settings.hash_sample_blocks, 16)
+        self.assertEqual(Settings(RawConfigParser()).hash_sample_threshold, 0)
+
+    def test_settings_tree_hashing(self):
+        config = RawConfigParser(allow_no_value=True)
+        config.read_string(u'[data]\nhash_tree_threshold = 1G\n'
+                           u'hash_tree_leaf_size = 1k\n')
+
+        settings = Settings(config)
+
+        self.assertEqual(settings.hash_tree_threshold, 2 ** 30)
+        # Leaves are at least 64K
+        self.assertEqual(settings.hash_tree_leaf_size, 64 * 1024)
+        self.assertEqual(Settings(RawConfigParser()).hash_tree_leaf_size,
+                         4 * 1024 * 1024)
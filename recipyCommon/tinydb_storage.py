@@ -0,0 +1,113 @@
+"""
+TinyDB storage backend for the recipy database.
+
+This is the default backend and the reference implementation of
+`recipyCommon.storage.StorageBackend`: the whole database is a single JSON
+file, and every query is a full scan of the runs in it.
+"""
+from datetime import datetime
+
+from tinydb import Query
+
+from .storage import StorageBackend, Run, match_run
+from .tinydb_utils import DateTimeSerializer
+from .utils import open_or_create_db, UniqueList
+
+DATE_FIELDS = ('date', 'exit_date')
+TINYDATE_TAG = '{TinyDate}:'
+
+
+def _normalize_date(value):
+    # Dates are normally decoded by the serialization middleware, but
+    # databases written by old versions of recipy may contain raw strings
+    if isinstance(value, datetime) or value is None:
+        return value
+    value = str(value).replace(TINYDATE_TAG, '')
+    try:
+        return datetime.strptime(value[:19], DateTimeSerializer.FORMAT)
+    except ValueError:
+        return value
+
+
+def _to_run(doc):
+    if doc is None:
+        return None
+    run = Run(doc, doc.doc_id)
+    for field in DATE_FIELDS:
+        if field in run:
+            run[field] = _normalize_date(run[field])
+    return run
+
+
+class TinyDBStorage(StorageBackend):
+    """Storage backed by a TinyDB JSON file."""
+    def __init__(self, path):
+        super(TinyDBStorage, self).__init__(path)
+        self.db = open_or_create_db(path=path)
+
+    def close(self):
+        self.db.close()
+
+    # Runs
+
+    def insert_run(self, run):
+        return self.db.insert(run)
+
+    def update_run(self, run_id, fields):
+        self.db.update(fields, doc_ids=[run_id])
+
+    def append_events(self, run_id, field, values):
+        def transform(element):
+            existing = UniqueList(element.get(field) or [])
+            for value in values:
+                # Tuples are stored as lists in the JSON file
+                if isinstance(value, tuple):
+                    value = list(value)
+                existing.add(value)
+            element[field] = list(existing)
+
+        self.db.update(transform, doc_ids=[run_id])
+
+    def get_run(self, run_id):
+        return _to_run(self.db.get(doc_id=run_id))
+
+    def iter_runs(self, **filters):
+        for doc in self.db.all():
+            run = _to_run(doc)
+            if match_run(run, filters):
+                yield run
+
+    # File diffs
+
+    def add_file_diffs(self, file_diffs):
+        self.db.table('filediffs').insert_multiple(file_diffs)
+
+    def get_file_diffs(self, run_id):
+        return [dict(d) for d in
+                self.db.table('filediffs').search(Query().run_id == run_id)]
+
+    def iter_file_diffs(self):
+        return (dict(d) for d in self.db.table('filediffs').all())
+
+    # Patches registry
+
+    def get_patches(self):
+        return [dict(p) for p in self.db.table('patches').all()]
+
+    def add_patch(self, modulename, input_functions, output_functions):
+        self.db.table('patches').insert({'modulename': modulename,
+                                         'input_functions': input_functions,
+                                         'output_functions': output_functions})
+
+    def reset_patches(self):
+        self.db.table('patches').truncate()
+
+    def set_patches(self, patches):
+        # truncate + insert_multiple writes the file twice instead of once per
+        # patch
+        table = self.db.table('patches')
+        table.truncate()
+        table.insert_multiple({'modulename': p['modulename'],
+                               'input_functions': p['input_functions'],
+                               'output_functions': p['output_functions']}
+                              for p in patches)
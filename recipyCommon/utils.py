@@ -1,12 +1,8 @@
 import wrapt
-import imp
 import os
 import warnings
 from datetime import datetime
 
-from tinydb import TinyDB
-from .tinydb_utils import serializer
-
 from .config import get_db_path
 
 
@@ -15,6 +11,9 @@ def open_or_create_db(path=get_db_path()):
 
     This opens the DB, creating it if it doesn't exist.
     """
+    from tinydb import TinyDB
+    from .tinydb_utils import serializer
+
     if not os.path.exists(os.path.dirname(path)):
         os.mkdir(os.path.dirname(path))
 
@@ -24,9 +23,9 @@ def open_or_create_db(path=get_db_path()):
 
 
 def reset_patches_table(db_path=get_db_path()):
-    db = open_or_create_db(path=db_path)
-    patches = db.table('patches')
-    patches.truncate()
+    from .storage import open_storage
+    db = open_storage(path=db_path)
+    db.reset_patches()
     db.close()
 
 
@@ -36,6 +35,84 @@ def multiple_insert(lst, items):
         lst.insert(0, item)
 
 
+def _unique_key(value):
+    """Hashable key of a value in a `UniqueList`. Tuples and lists are equal
+    (tuples are stored as lists in the database)."""
+    if isinstance(value, (tuple, list)):
+        return tuple(_unique_key(v) for v in value)
+    if isinstance(value, dict):
+        return ('__dict__',) + tuple(sorted((k, _unique_key(v))
+                                            for k, v in value.items()))
+    try:
+        hash(value)
+    except TypeError:
+        return ('__repr__', repr(value))
+    return value
+
+
+class UniqueList(list):
+    """List without duplicates, in insertion order.
+
+    `append` ignores values that are already in the list, and membership tests
+    and `index` are dict lookups instead of scans, so collecting n values costs
+    O(n) instead of O(n^2). It is a list, so it is stored like one. Only
+    `append`, `extend` and `replace` keep the index up to date; don't use
+    other methods that modify the list.
+    """
+    def __init__(self, values=()):
+        super(UniqueList, self).__init__()
+        self._index = {}
+        self.extend(values)
+
+    def __reduce__(self):
+        return (self.__class__, (list(self),))
+
+    def __contains__(self, value):
+        return _unique_key(value) in self._index
+
+    def add(self, value):
+        """Append `value` unless it is in the list already. Returns True if it
+        was added."""
+        key = _unique_key(value)
+        if key in self._index:
+            return False
+        self._index[key] = len(self)
+        super(UniqueList, self).append(value)
+        return True
+
+    def append(self, value):
+        self.add(value)
+
+    def extend(self, values):
+        for value in values:
+            self.add(value)
+
+    def index(self, value):
+        try:
+            return self._index[_unique_key(value)]
+        except KeyError:
+            raise ValueError('{!r} is not in list'.format(value))
+
+    def replace(self, old, new):
+        """Replace `old` with `new`, or remove `old` if `new` is in the list
+        already. Returns False if `old` is not in the list."""
+        old_key = _unique_key(old)
+        i = self._index.pop(old_key, None)
+        if i is None:
+            return False
+        new_key = _unique_key(new)
+        if new_key in self._index:
+            super(UniqueList, self).__delitem__(i)
+            # Rare: positions after i have to be renumbered
+            for key, j in self._index.items():
+                if j > i:
+                    self._index[key] = j - 1
+        else:
+            super(UniqueList, self).__setitem__(i, new)
+            self._index[new_key] = i
+        return True
+
+
 def recursive_getattr(obj, attr):
     """Does the same as the builtin getattr function, but works with multiple sub-attributes.
 
@@ -147,24 +224,6 @@ def create_argument_wrapper(log_input_function, log_output_function, arg_loc,
     return f
 
 
-def recursive_find_module(name, path):
-    subnames = name.split(".")
-    #print subnames
-    #print path
-    for subname in subnames[:-1]:
-        #print subname
-        file_obj, pathname, desc = imp.find_module(subname, path)
-        #print subname, file_obj, pathname, desc
-        try:
-            mod = imp.load_module(subname, file_obj, pathname, desc)
-            path = mod.__path__
-        finally:
-            if file_obj:
-                file_obj.close()
-
-    return imp.find_module(subnames[-1], path)
-
-
 def json_serializer(obj):
     """JSON serializer for objects not serializable by default json code"""
 
@@ -0,0 +1,117 @@
+"""
+Persistent cache of version control diffs.
+
+Computing the diff of a large working copy (``git diff`` or ``svn diff``)
+can take seconds, and scripts are typically run many times against the same
+working copy. The VCS cache stores the diff of a working copy keyed on its
+state: the commit (git HEAD or svn revision), the modification time of the
+index (or of the svn working copy database) and the stat signatures of the
+modified files. As long as none of these change, the stored diff is reused.
+
+Every entry is a small JSON file in a directory (``~/.recipy/vcscache`` by
+default); at most `MAX_ENTRIES` are kept, the least recently used are
+removed first. Enable the cache by adding ``vcs_cache`` to the ``[general]``
+section of recipyrc.
+"""
+import os
+import json
+import hashlib
+import tempfile
+
+from .config import option_set, get_vcs_cache_path
+
+MAX_ENTRIES = 64
+
+
+def state_key(*parts):
+    """Return the cache key of a working copy state made of `parts`."""
+    key = hashlib.sha1()
+    for part in parts:
+        key.update(str(part).encode('utf-8', 'surrogateescape'))
+        key.update(b'\0')
+    return key.hexdigest()
+
+
+def dirty_signature(root, paths):
+    """Return a signature of the stat of the modified files `paths` (relative
+    to `root`) of a working copy."""
+    lines = []
+    for path in sorted(paths):
+        try:
+            st = os.stat(os.path.join(root, path))
+            mtime_ns = getattr(st, 'st_mtime_ns', int(st.st_mtime * 1e9))
+            lines.append('{} {} {}'.format(path, st.st_size, mtime_ns))
+        except OSError:
+            lines.append('{} -'.format(path))
+    return state_key(*lines)
+
+
+def mtime_ns(path):
+    """Return the modification time of a file in ns (0 if it is missing)."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return 0
+    return getattr(st, 'st_mtime_ns', int(st.st_mtime * 1e9))
+
+
+class VcsCache(object):
+    """Diffs of working copies, stored in a directory."""
+    def __init__(self, path, max_entries=MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+
+    def _entry(self, key):
+        return os.path.join(self.path, key + '.json')
+
+    def get(self, key):
+        """Return the diff stored for `key`, or None."""
+        entry = self._entry(key)
+        try:
+            with open(entry) as f:
+                diff = json.load(f)['diff']
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            return None
+        try:
+            # Mark it as recently used
+            os.utime(entry, None)
+        except OSError:
+            pass
+        return diff
+
+    def put(self, key, diff):
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        # Write to a temporary file first, so concurrent runs never read a
+        # partial entry
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'diff': diff}, f)
+            os.replace(tmp, self._entry(key))
+        except Exception:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries beyond max_entries."""
+        entries = []
+        for name in os.listdir(self.path):
+            if name.endswith('.json'):
+                entry = os.path.join(self.path, name)
+                entries.append((mtime_ns(entry), entry))
+        entries.sort()
+        for _, entry in entries[:max(0, len(entries) - self.max_entries)]:
+            try:
+                os.remove(entry)
+            except OSError:
+                pass
+
+
+def get_vcs_cache():
+    """Return the VCS cache, or None if it is disabled."""
+    if not option_set('general', 'vcs_cache'):
+        return None
+    return VcsCache(get_vcs_cache_path())
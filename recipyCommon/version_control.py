@@ -1,22 +1,33 @@
-from git import Repo, InvalidGitRepositoryError
-import svn.local
+"""
+Information about the git or svn working copy that holds a script.
+
+Getting the diff of a large working copy is slow, so `collect_vcs_info`
+collects it on background threads (git and svn at the same time) while the
+script runs; the run is completed with the result when the script exits.
+With a `recipyCommon.vcscache.VcsCache`, the diff of a working copy whose
+state did not change since an earlier run is not computed again.
+"""
+import os
+import threading
 import subprocess
-import hashlib
 from recipyCommon.config import option_set
+from recipyCommon.vcscache import state_key, dirty_signature, mtime_ns
+# hash_file used to live here
+from recipyCommon.hashing import hash_file  # noqa: F401
 
 
-def hash_file(path):
-    try:
-        BLOCKSIZE = 65536
-        hasher = hashlib.sha1()
-        with open(path, 'rb') as afile:
-            buf = afile.read(BLOCKSIZE)
-            while len(buf) > 0:
-                hasher.update(buf)
-                buf = afile.read(BLOCKSIZE)
-        return hasher.hexdigest()
-    except Exception:
-        return None
+def _in_working_copy(path, dirname):
+    """Return True if `path` or one of its parents contains `dirname` (e.g.,
+    .git), so GitPython and svn are only imported (and run) when they can
+    find something."""
+    path = os.path.abspath(path)
+    while True:
+        if os.path.exists(os.path.join(path, dirname)):
+            return True
+        parent = os.path.dirname(path)
+        if parent == path:
+            return False
+        path = parent
 
 
 def get_origin(repo):
@@ -26,25 +37,67 @@ def get_origin(repo):
         return None
 
 
-def add_git_info(run, scriptpath):
-    """Add information about the git repository holding the source file to the database"""
+def _cached_diff(cache, key, compute):
+    """Return the diff stored in `cache` for `key`, or compute (and store)
+    it."""
+    if cache is not None:
+        diff = cache.get(key)
+        if diff is not None:
+            return diff
+    diff = compute()
+    if cache is not None:
+        try:
+            cache.put(key, diff)
+        except (IOError, OSError):
+            pass
+    return diff
+
+
+def git_diff(repo):
+    """Return the diff between the index and the working tree."""
+    whole_diff = ''
+    diffs = repo.index.diff(None, create_patch=True)
+    for diff in diffs:
+        whole_diff += "\n\n\n" + "--- {}\n+++ {}\n".format(
+            diff.a_path, diff.b_path) + diff.diff.decode("utf-8")
+    return whole_diff
+
+
+def git_state(repo):
+    """Return the cache key of the state of a git working copy: HEAD, the
+    modification time of the index and the stat of the modified files."""
+    dirty = repo.git.diff('--name-only', '-z').split('\0')
+    return state_key('git', repo.working_dir, repo.head.commit.hexsha,
+                     mtime_ns(repo.index.path),
+                     dirty_signature(repo.working_dir, filter(None, dirty)))
+
+
+def git_info(scriptpath, diff=True, cache=None):
+    """Return information about the git repository holding the source file
+    (an empty dict if it is not in a git repository)."""
+    if not _in_working_copy(scriptpath, '.git'):
+        return {}
+    from git import Repo, InvalidGitRepositoryError, GitCommandError
+    info = {}
     try:
         repo = Repo(scriptpath, search_parent_directories=True)
-        run["gitrepo"] = repo.working_dir
-        run["gitcommit"] = repo.head.commit.hexsha
-        run["gitorigin"] = get_origin(repo)
-
-        if not option_set('ignored metadata', 'diff'):
-            whole_diff = ''
-            diffs = repo.index.diff(None, create_patch=True)
-            for diff in diffs:
-                whole_diff += "\n\n\n" + "--- {}\n+++ {}\n".format(
-                    diff.a_path, diff.b_path) + diff.diff.decode("utf-8")
-
-            run['diff'] = whole_diff
-    except (InvalidGitRepositoryError, ValueError):
+        info["gitrepo"] = repo.working_dir
+        info["gitcommit"] = repo.head.commit.hexsha
+        info["gitorigin"] = get_origin(repo)
+
+        if diff:
+            key = git_state(repo) if cache is not None else None
+            info['diff'] = _cached_diff(cache, key, lambda: git_diff(repo))
+    except (InvalidGitRepositoryError, GitCommandError, ValueError):
         # We can't store git info for some reason, so just skip it
         pass
+    return info
+
+
+def add_git_info(run, scriptpath):
+    """Add information about the git repository holding the source file to the database"""
+    run.update(git_info(scriptpath,
+                        not option_set('ignored metadata', 'diff')))
 
 
 # The released version of PySvn doesn't do local diffs yet, so we have to do
@@ -68,18 +121,114 @@ def svn_diff(path):
     return stdout.decode()
 
 
-def add_svn_info(run, scriptpath):
+def svn_state(wcroot, revision):
+    """Return the cache key of the state of an svn working copy: the
+    revision, the modification time of the working copy database and the
+    stat of the modified files."""
+    cmd = ["svn", "status", "-q", wcroot]
+    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                         env={"LANG": "en_US.UTF-8"})
+    stdout = p.stdout.read()
+    if p.wait() != 0:
+        raise SvnException("SVN Command exited with status code {0}".format(
+            p.returncode))
+    # The path starts in column 9 of every status line
+    dirty = [os.path.relpath(line[8:], wcroot)
+             for line in stdout.decode().splitlines() if len(line) > 8]
+    return state_key('svn', wcroot, revision,
+                     mtime_ns(os.path.join(wcroot, '.svn', 'wc.db')),
+                     dirty_signature(wcroot, dirty))
+
+
+def svn_info(scriptpath, diff=True, cache=None):
     """
-    Add information about the svn repository holding the source file to the
-    database.
+    Return information about the svn repository holding the source file (an
+    empty dict if it is not in an svn working copy).
     """
+    if not _in_working_copy(scriptpath, '.svn'):
+        return {}
+    import svn.local
+    import svn.exception
+    info = {}
     try:
         svn_client = svn.local.LocalClient(scriptpath)
-        svn_info = svn_client.info()
-        run["svnrepo"] = svn_info["repository_root"]
-        run["svncommit"] = svn_info["commit_revision"]
-        if not option_set('ignored metadata', 'diff'):
-            run['diff'] = svn_diff(svn_info["wc-info/wcroot-abspath"])
-    except (svn.exception.SvnException, ValueError, OSError):
+        wc_info = svn_client.info()
+        info["svnrepo"] = wc_info["repository_root"]
+        info["svncommit"] = wc_info["commit_revision"]
+        if diff:
+            wcroot = wc_info["wc-info/wcroot-abspath"]
+            key = None
+            if cache is not None:
+                key = svn_state(wcroot, info["svncommit"])
+            info['diff'] = _cached_diff(cache, key, lambda: svn_diff(wcroot))
+    except (svn.exception.SvnException, SvnException, ValueError, OSError):
         # We can't access svn info for some reason, so just skip it
         pass
+    return info
+
+
+def add_svn_info(run, scriptpath):
+    """
+    Add information about the svn repository holding the source file to the
+    database.
+    """
+    run.update(svn_info(scriptpath,
+                        not option_set('ignored metadata', 'diff')))
+
+
+class VcsCollector(object):
+    """Collects git and svn information on background threads.
+
+    The collectors run at the same time, and while the script runs; `result`
+    waits for them and returns the information as one dict. The threads are
+    daemon threads: a script that exits without waiting for them does not
+    hang.
+    """
+    def __init__(self, collectors):
+        self._results = [None] * len(collectors)
+        self._threads = []
+        self._pid = os.getpid()
+        for i, collect in enumerate(collectors):
+            t = threading.Thread(target=self._work, args=(i, collect),
+                                 name='recipy-vcs')
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def _work(self, i, collect):
+        try:
+            self._results[i] = collect()
+        except Exception:
+            # Like the collectors themselves, skip what can't be collected
+            self._results[i] = {}
+
+    def alive(self):
+        """Return False in a forked child, where the threads don't exist."""
+        return self._pid == os.getpid()
+
+    def done(self):
+        return not any(t.is_alive() for t in self._threads)
+
+    def result(self, timeout=None):
+        """Wait for the collectors and return their information (later
+        collectors win, e.g., the svn diff replaces the git diff)."""
+        for t in self._threads:
+            t.join(timeout)
+        info = {}
+        for result in self._results:
+            info.update(result or {})
+        return info
+
+
+def collect_vcs_info(scriptpath, git=True, svn=True, diff=True, cache=None):
+    """Start collecting git and/or svn information about the working copy
+    holding `scriptpath` in the background; returns a `VcsCollector`, or
+    None if there is nothing to collect."""
+    collectors = []
+    if git and _in_working_copy(scriptpath, '.git'):
+        collectors.append(lambda: git_info(scriptpath, diff, cache))
+    if svn and _in_working_copy(scriptpath, '.svn'):
+        collectors.append(lambda: svn_info(scriptpath, diff, cache))
+    if not collectors:
+        return None
+    return VcsCollector(collectors)
@@ -1,17 +1,20 @@
-from tinydb import where
-from recipyCommon.tinydb_utils import listsearch
+from recipyCommon.hashing import digest_variants
 
 
 def search_database(db, query=None):
     """ Use this to perform a search of runs in the database """
     if not query:
-        runs = db.all()
+        runs = db.all_runs()
     else:
-        # Search run outputs using the query string
-        runs = db.search(
-            where('outputs').any(lambda x: listsearch(query, x)) |
-            where('inputs').any(lambda x: listsearch(query, x)) |
-            where('script').search(query) |
-            where('notes').search(query) |
-            where('unique_id').search(query))
+        # Search run inputs, outputs, script, notes and id using the query
+        # string
+        runs = db.search_text(query)
+        # Digests are stored with the name of the hash algorithm as prefix
+        # (except for SHA-1); also find runs with the same digest in another
+        # notation (e.g., sha1:<hex>, or <hex> without prefix)
+        digests = digest_variants(query)
+        if digests:
+            found = set(run.run_id for run in runs)
+            runs.extend(run for run in db.find_by_hash(digests)
+                        if run.run_id not in found)
     return runs
@@ -1,6 +1,5 @@
 from flask import Blueprint, request, render_template, redirect, url_for, \
     escape, make_response, flash
-from tinydb import Query
 import os
 import re
 from ast import literal_eval
@@ -11,7 +10,9 @@ from .forms import SearchForm, AnnotateRunForm
 from .controller import search_database
 
 from recipyCommon import utils
-from recipyCmd.recipycmd import get_latest_run, _change_date
+from recipyCommon.storage import open_storage
+from recipyCommon.blobstore import resolve_run, resolve_file_diffs
+from recipyCmd.recipycmd import get_latest_run
 
 
 routes = Blueprint('routes', __name__, template_folder='templates')
@@ -30,10 +31,9 @@ def index():
     # search
     escaped_query = re.escape(query) if query else query
 
-    db = utils.open_or_create_db()
+    db = open_storage()
 
     runs = search_database(db, query=escaped_query)
-    runs = [_change_date(r) for r in runs]
 
     runs = sorted(runs, key=lambda x: x['date'], reverse=True)
 
@@ -41,7 +41,7 @@ def index():
     for run in runs:
         if 'notes' in run.keys():
             run['notes'] = str(escape(run['notes']))
-        run_ids.append(run.doc_id)
+        run_ids.append(run.run_id)
 
     db.close()
 
@@ -58,17 +58,17 @@ def run_details():
     query = request.args.get('query', '')
     run_id = int(request.args.get('id'))
 
-    db = utils.open_or_create_db()
-    r = db.get(doc_id=run_id)
+    db = open_storage()
+    r = db.get_run(run_id)
 
     if r is not None:
-        diffs = db.table('filediffs').search(Query().run_id == run_id)
+        # Only the details page needs the diffs and traceback
+        resolve_run(r)
+        diffs = resolve_file_diffs(db.get_file_diffs(run_id))
     else:
         flash('Run not found.', 'danger')
         diffs = []
 
-    r = _change_date(r)
-
     db.close()
 
     return render_template('details.html', query=query, form=form,
@@ -81,17 +81,16 @@ def latest_run():
     form = SearchForm()
     annotateRunForm = AnnotateRunForm()
 
-    db = utils.open_or_create_db()
+    db = open_storage()
     r = get_latest_run()
 
     if r is not None:
-        diffs = db.table('filediffs').search(Query().run_id == r.doc_id)
+        resolve_run(r)
+        diffs = resolve_file_diffs(db.get_file_diffs(r.run_id))
     else:
         flash('No latest run (database is empty).', 'danger')
         diffs = []
 
-    r = _change_date(r)
-
     db.close()
 
     return render_template('details.html', query='', form=form, run=r,
@@ -107,8 +106,8 @@ def annotate():
 
     query = request.args.get('query', '')
 
-    db = utils.open_or_create_db()
-    db.update({'notes': notes}, doc_ids=[run_id])
+    db = open_storage()
+    db.update_run(run_id, {'notes': notes})
     db.close()
 
     return redirect(url_for('run_details', id=run_id, query=query))
@@ -117,12 +116,12 @@ def annotate():
 @recipyGui.route('/runs2json', methods=['POST'])
 def runs2json():
     run_ids = literal_eval(request.form['run_ids'])
-    db = db = utils.open_or_create_db()
-    runs = [db.get(doc_id=run_id) for run_id in run_ids]
+    db = open_storage()
+    runs = [resolve_run(db.get_run(run_id)) for run_id in run_ids]
     db.close()
 
     response = make_response(dumps(runs, indent=2, sort_keys=True,
-                                   default=unicode))
+                                   default=utils.json_serializer))
     response.headers['content-type'] = 'application/json'
     response.headers['Content-Disposition'] = 'attachment; filename=runs.json'
     return response
@@ -130,8 +129,8 @@ def runs2json():
 
 @recipyGui.route('/patched_modules')
 def patched_modules():
-    db = utils.open_or_create_db()
-    modules = db.table('patches').all()
+    db = open_storage()
+    modules = db.get_patches()
     db.close()
 
     form = SearchForm()
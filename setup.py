@@ -48,13 +48,11 @@ Please see https://github.com/recipy/recipy for further information.
 
         # Specify the Python versions you support here. In particular, ensure
         # that you indicate whether you support Python 2, Python 3 or both.
-        'Programming Language :: Python :: 2',
-        'Programming Language :: Python :: 2.6',
-        'Programming Language :: Python :: 2.7',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.2',
-        'Programming Language :: Python :: 3.3',
-        'Programming Language :: Python :: 3.4',
+        'Programming Language :: Python :: 3 :: Only',
+        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
     ],
 
     # What does your project relate to?
@@ -64,6 +62,10 @@ Please see https://github.com/recipy/recipy for further information.
     # simple. Or you can use find_packages().
     packages=find_packages(),
 
+    # Library versions are looked up with importlib.metadata (see
+    # recipyCommon/libraryversions.py)
+    python_requires='>=3.8',
+
     # List run-time dependencies here.  These will be installed by pip when
     # your project is installed. For an analysis of "install_requires" vs pip's
     # requirements files see:
@@ -84,6 +86,12 @@ Please see https://github.com/recipy/recipy for further information.
     entry_points={
         'console_scripts': [
             'recipy=recipyCmd.recipycmd:main',
-        ]
+        ],
+        # Storage backends for the recipy database (see
+        # recipyCommon/storage.py)
+        'recipy.storage': [
+            'tinydb=recipyCommon.tinydb_storage:TinyDBStorage',
+            'sqlite=recipyCommon.sqlite_storage:SQLiteStorage',
+        ],
     }
 )
@@ -0,0 +1,50 @@
+import os
+import time
+import datetime
+
+import pytest
+
+from recipyCommon.storage import open_storage
+
+
+@pytest.fixture(params=['tinydb', 'sqlite'])
+def db(request, tmpdir):
+    """A database of each backend."""
+    backend = open_storage(str(tmpdir.join('recipyDB')),
+                           backend=request.param)
+    yield backend
+    backend.close()
+
+
+@pytest.fixture
+def make_run():
+    """Return a function that builds a run with the fields that recipy
+    logs; keyword arguments replace fields."""
+    def make(unique_id, date=datetime.datetime(2020, 1, 1), **fields):
+        run = {'unique_id': unique_id,
+               'author': 'me',
+               'script': '/home/me/script.py',
+               'date': date,
+               'inputs': [],
+               'outputs': [],
+               'libraries': ['recipy v0.3.0'],
+               'warnings': [{'type': 'UserWarning', 'message': 'careful',
+                             'script': 'script.py', 'lineno': 3}],
+               'custom_values': {'a': 1}}
+        run.update(fields)
+        return run
+    return make
+
+
+@pytest.fixture
+def make_file(tmpdir):
+    """Return a function that writes a (UTF-8) file in tmpdir and returns
+    its path; with `age`, the file was last modified `age` seconds ago."""
+    def make(name, contents, age=None):
+        path = tmpdir.join(name)
+        path.write_binary(contents.encode('utf-8'))
+        if age is not None:
+            t = time.time() - age
+            os.utime(str(path), (t, t))
+        return str(path)
+    return make
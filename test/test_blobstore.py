@@ -0,0 +1,86 @@
+import pytest
+
+from recipyCommon.blobstore import BlobStore, get_blob_dir, is_blob_ref, \
+    externalize_run, externalize_file_diffs, resolve_run, \
+    resolve_file_diffs, gc_blobs
+
+DIFF = '--- a.py\n+++ a.py\n' + '+print(1)\n' * 200
+EXCEPTION = {'type': 'ValueError', 'message': 'oops',
+             'traceback': 'Traceback'}
+
+
+@pytest.fixture
+def store(tmpdir):
+    return BlobStore(str(tmpdir.join('blobs')), threshold=100)
+
+
+def test_put_get(store):
+    ref = store.put(DIFF)
+
+    assert is_blob_ref(ref)
+    assert ref['size'] == len(DIFF)
+    assert store.get(ref) == DIFF
+    # The same text is stored once
+    assert BlobStore(store.path).put(DIFF) == ref
+    assert len(list(store.digests())) == 1
+
+
+def test_small_values_are_kept(store):
+    assert store.externalize('short') == 'short'
+    assert store.externalize(None) is None
+    assert is_blob_ref(store.externalize(DIFF))
+
+
+def test_externalize_and_resolve_run(store, make_run):
+    run = make_run('abc', diff=DIFF,
+                   exception=dict(EXCEPTION, traceback=DIFF + 'x'))
+
+    fields = externalize_run(run, store)
+
+    assert is_blob_ref(fields['diff'])
+    assert is_blob_ref(fields['exception']['traceback'])
+    assert fields['exception']['message'] == 'oops'
+    # The run itself is not changed
+    assert run['diff'] == DIFF
+    assert resolve_run(fields, store) == run
+
+
+def test_missing_blob(store):
+    ref = {'blob': 'sha256:' + '0' * 64, 'size': 10}
+    assert store.resolve(ref).startswith('(missing blob')
+
+
+def test_references_in_database(db, store, make_run):
+    run = make_run('abc', diff=DIFF, exception=EXCEPTION)
+    run_id = db.insert_run(externalize_run(run, store))
+    db.add_file_diffs(externalize_file_diffs(
+        [{'run_id': run_id, 'filename': 'out.txt', 'tempfilename': 't',
+          'diff': DIFF + 'file'}], store))
+
+    run = db.get_run(run_id)
+    assert is_blob_ref(run['diff'])
+    assert resolve_run(run, store)['diff'] == DIFF
+    diffs = db.get_file_diffs(run_id)
+    assert is_blob_ref(diffs[0]['diff'])
+    assert resolve_file_diffs(diffs, store)[0]['diff'] == DIFF + 'file'
+
+
+def test_gc_blobs(db, store, make_run):
+    run = make_run('abc', diff=DIFF, exception=EXCEPTION)
+    db.insert_run(externalize_run(run, store))
+    db.add_file_diffs(externalize_file_diffs(
+        [{'run_id': 1, 'filename': 'out.txt', 'tempfilename': 't',
+          'diff': DIFF + 'file'}], store))
+    unreferenced = store.put(DIFF + 'old')
+
+    # Recent blobs are kept
+    assert gc_blobs(db, store) == 0
+    assert gc_blobs(db, store, min_age=0) == 1
+
+    assert store.get(unreferenced) is None
+    assert len(list(store.digests())) == 2
+
+
+def test_get_blob_dir(tmpdir):
+    path = str(tmpdir.join('recipyDB.json'))
+    assert get_blob_dir(path) == str(tmpdir.join('blobs', 'recipyDB.json'))
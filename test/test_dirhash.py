@@ -0,0 +1,89 @@
+import os
+import time
+
+import mock
+
+from recipyCommon import hashing
+from recipyCommon.dirhash import hash_directory
+from recipyCommon.hashcache import HashCache
+
+
+def make_store(tmpdir, age=60):
+    """Make a directory that looks like a (small) Zarr store."""
+    store = tmpdir.mkdir('data.zarr')
+    store.join('.zgroup').write('{"zarr_format": 2}')
+    for var in ('temperature', 'pressure'):
+        array = store.mkdir(var)
+        array.join('.zarray').write('{"chunks": [2]}')
+        for i in range(3):
+            array.join('{}'.format(i)).write('{} chunk {}'.format(var, i))
+    # Make the files old enough to be cached
+    t = time.time() - age
+    for root, _, files in os.walk(str(store)):
+        for name in files:
+            os.utime(os.path.join(root, name), (t, t))
+    return store
+
+
+def test_hash_directory(tmpdir):
+    store = make_store(tmpdir)
+
+    digest = hash_directory(str(store), 'sha256')
+
+    assert digest.startswith('dir:sha256:')
+    assert hashing.split_digest(digest)[0] == 'sha256'
+    assert hash_directory(str(store), 'sha256') == digest
+    assert hashing.hash_file(str(store), 'sha256') == digest
+
+
+def test_changed_file_changes_digest(tmpdir):
+    store = make_store(tmpdir)
+    digest = hash_directory(str(store))
+
+    store.join('pressure', '1').write('changed')
+
+    assert hash_directory(str(store)) != digest
+
+
+def test_renamed_file_changes_digest(tmpdir):
+    store = make_store(tmpdir)
+    digest = hash_directory(str(store))
+
+    store.join('pressure', '1').rename(store.join('pressure', '4'))
+
+    assert hash_directory(str(store)) != digest
+
+
+def test_hash_files_with_directories(tmpdir):
+    store = make_store(tmpdir)
+    path = tmpdir.join('a.txt')
+    path.write('aaa')
+
+    hashes = hashing.hash_files([str(store), str(path)], threads=2)
+
+    assert hashes == {str(store): hash_directory(str(store)),
+                      str(path): hashing.hash_file(str(path))}
+
+
+def test_only_changed_file_is_read_again(tmpdir):
+    cache = HashCache(str(tmpdir.join('cache.sqlite')))
+    store = make_store(tmpdir)
+    hash_directory(str(store), cache=cache)
+
+    # Nothing changed: not even the directory listings are hashed again
+    with mock.patch('recipyCommon.hashing.hash_file') as hash_file:
+        digest = hash_directory(str(store), cache=cache)
+    assert not hash_file.called
+
+    changed = store.join('temperature', '2')
+    changed.write('new chunk')
+    t = time.time() - 30
+    os.utime(str(changed), (t, t))
+
+    with mock.patch('recipyCommon.hashing.hash_file',
+                    side_effect=hashing.hash_file) as hash_file:
+        new_digest = hash_directory(str(store), cache=cache)
+    assert [c[0][0] for c in hash_file.call_args_list] == [str(changed)]
+    assert new_digest != digest
+    assert new_digest == hash_directory(str(store))
+    assert cache.info()['directories'] == 3
@@ -0,0 +1,138 @@
+import re
+import time
+import random
+import difflib
+import multiprocessing
+
+import mock
+import pytest
+
+from recipyCommon.filediff import diff_file, diff_files, unified_diff, \
+    TIMED_OUT
+
+needs_fork = pytest.mark.skipif(
+    'fork' not in multiprocessing.get_all_start_methods(),
+    reason='processes are not forked on this platform')
+
+
+def slow_diff_file(before, after, limit=None):
+    time.sleep(10)
+
+
+def test_same_format_as_difflib():
+    a = ['line {}\n'.format(i) for i in range(100)]
+    b = a[:10] + ['new\n'] + a[12:50] + a[51:] + ['last']
+
+    assert list(unified_diff(a, b)) == list(difflib.unified_diff(
+        a, b, fromfile='before this run', tofile='after this run'))
+
+
+def apply_diff(a, diff):
+    """Apply the lines of a unified diff to the lines `a`."""
+    result = []
+    i = 0
+    for line in diff[2:]:
+        m = re.match(r'@@ -(\d+)(?:,(\d+))? ', line)
+        if m:
+            start = int(m.group(1))
+            if m.group(2) != '0':
+                start -= 1
+            result.extend(a[i:start])
+            i = start
+        elif line[0] == '+':
+            result.append(line[1:])
+        else:
+            assert a[i] == line[1:]
+            if line[0] == ' ':
+                result.append(a[i])
+            i += 1
+    return result + a[i:]
+
+
+def test_diff_reconstructs_file():
+    rnd = random.Random(0)
+    for _ in range(500):
+        # Few distinct lines, so there are many ways to align a change
+        a = ['{}\n'.format(rnd.randint(0, 4))
+             for _ in range(rnd.randint(0, 30))]
+        b = list(a)
+        for _ in range(rnd.randint(1, 4)):
+            i = rnd.randint(0, len(b))
+            if rnd.random() < 0.5 and i < len(b):
+                del b[i:i + rnd.randint(1, 3)]
+            else:
+                b[i:i] = ['{}\n'.format(rnd.randint(0, 4))
+                          for _ in range(rnd.randint(1, 3))]
+        diff = list(unified_diff(a, b))
+
+        assert apply_diff(a, diff) == b if diff else a == b
+
+
+def test_identical_files(tmpdir, make_file):
+    before = make_file('before', 'a\nb\n')
+    after = make_file('after', 'a\nb\n')
+
+    assert diff_file(before, after) == ''
+
+
+def test_appended_file(tmpdir, make_file):
+    lines = ''.join('line {}\n'.format(i) for i in range(10000))
+    before = make_file('before', lines)
+    after = make_file('after', lines + 'new line\n')
+
+    assert diff_file(before, after) == (
+        '--- before this run\n+++ after this run\n'
+        '@@ -9998,3 +9998,4 @@\n'
+        ' line 9997\n line 9998\n line 9999\n+new line\n')
+
+
+def test_encodings(tmpdir, make_file):
+    before = make_file('before', u'caf\xe9\n')
+    after = tmpdir.join('after')
+    after.write_binary(b'caf\xe9!\n')
+
+    assert diff_file(before, str(after)).endswith(
+        u'-caf\xe9\n+caf\xe9!\n')
+
+
+def test_truncated(tmpdir, make_file):
+    before = make_file('before', 'a\n' * 1000)
+    after = make_file('after', 'b\n' * 1000)
+
+    diff = diff_file(before, after, limit=100)
+
+    assert len(diff) < 200
+    assert diff.endswith('(diff truncated after 100 characters)\n')
+
+
+def test_diff_files(tmpdir, make_file):
+    pairs = [(make_file('b{}'.format(i), 'x\n'),
+              make_file('a{}'.format(i), 'x\n' + 'y\n' * i))
+             for i in range(4)]
+
+    diffs = diff_files(pairs, processes=2, timeout=60)
+
+    assert diffs[0] == ''
+    for i, diff in enumerate(diffs[1:], 1):
+        assert diff.count('+y\n') == i
+
+
+def test_missing_file(tmpdir, make_file):
+    before = make_file('before', 'a\n')
+
+    with pytest.warns(UserWarning, match='could not store the file diff'):
+        diffs = diff_files([(before, str(tmpdir.join('gone')))])
+    assert diffs == [None]
+
+
+@needs_fork
+def test_timeout(tmpdir, make_file):
+    before = make_file('before', 'a\n')
+    after = make_file('after', 'b\n')
+
+    with mock.patch('recipyCommon.filediff.diff_file', slow_diff_file):
+        start = time.time()
+        diffs = diff_files([(before, after)], timeout=0.5)
+
+    assert diffs == [TIMED_OUT.format(0.5)]
+    assert time.time() - start < 5
@@ -0,0 +1,73 @@
+import time
+
+import mock
+
+from recipyCommon import hashing
+from recipyCommon.hashcache import HashCache, stat_signature
+
+# Files are only cached once they are this old (in seconds)
+OLD = 60
+
+
+def test_cached_hash_is_reused(tmpdir, make_file):
+    cache = HashCache(str(tmpdir.join('cache.sqlite')))
+    path = make_file('a.txt', 'aaa', age=OLD)
+    expected = hashing.hash_file(path)
+
+    assert hashing.hash_files([path], cache=cache) == {path: expected}
+    assert len(cache) == 1
+
+    with mock.patch('recipyCommon.hashing.hash_file') as hash_file:
+        assert hashing.hash_files([path], cache=cache) == {path: expected}
+    assert not hash_file.called
+
+
+def test_changed_file_is_hashed_again(tmpdir, make_file):
+    cache = HashCache(str(tmpdir.join('cache.sqlite')))
+    path = make_file('a.txt', 'aaa', age=OLD)
+    hashing.hash_files([path], cache=cache)
+
+    make_file('a.txt', 'bbbb', age=30)
+
+    hashes = hashing.hash_files([path], cache=cache)
+    assert hashes[path] == hashing.hash_file(path)
+
+
+def test_recently_modified_file_is_not_cached(tmpdir, make_file):
+    cache = HashCache(str(tmpdir.join('cache.sqlite')))
+    path = make_file('a.txt', 'aaa', age=0)
+
+    hashing.hash_files([path], cache=cache)
+
+    assert len(cache) == 0
+
+
+def test_least_recently_used_entries_are_evicted(tmpdir, make_file):
+    cache = HashCache(str(tmpdir.join('cache.sqlite')), max_entries=2)
+    paths = [make_file(name, name, age=OLD) for name in 'abc']
+
+    for path in paths[:2]:
+        hashing.hash_files([path], cache=cache)
+        time.sleep(0.01)
+    # Using a makes b the least recently used file
+    cache.lookup([paths[0]], 'sha1')
+    hashing.hash_files([paths[2]], cache=cache)
+
+    assert len(cache) == 2
+    hashes, _ = cache.lookup(paths, 'sha1')
+    assert sorted(hashes) == [paths[0], paths[2]]
+
+
+def test_clear(tmpdir, make_file):
+    cache = HashCache(str(tmpdir.join('cache.sqlite')))
+    path = make_file('a.txt', 'aaa', age=OLD)
+    hashing.hash_files([path], cache=cache)
+
+    cache.clear()
+
+    assert len(cache) == 0
+    assert cache.info()['entries'] == 0
+
+
+def test_stat_signature_missing_file(tmpdir):
+    assert stat_signature(str(tmpdir.join('missing'))) is None
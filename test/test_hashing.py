@@ -0,0 +1,284 @@
+import os
+import hashlib
+import threading
+
+import mock
+import pytest
+from six.moves.configparser import RawConfigParser
+
+from recipyCommon import hashing
+from recipyCommon.config import Settings
+
+
+def make_files(tmpdir, n):
+    paths = []
+    for i in range(n):
+        f = tmpdir.join('file{}.txt'.format(i))
+        f.write('contents {}'.format(i))
+        paths.append(str(f))
+    return paths
+
+
+def data_settings(**options):
+    """Patch the settings used by recipyCommon.hashing with options in the
+    [data] section."""
+    config = RawConfigParser()
+    config.add_section('data')
+    for name, value in options.items():
+        config.set('data', name, str(value))
+    return mock.patch('recipyCommon.hashing.SETTINGS', Settings(config))
+
+
+def sha1(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def test_hash_file(tmpdir):
+    path = make_files(tmpdir, 1)[0]
+    assert hashing.hash_file(path) == sha1(path)
+
+
+def test_hash_file_missing(tmpdir):
+    assert hashing.hash_file(str(tmpdir.join('missing'))) is None
+
+
+def test_hash_files_parallel(tmpdir):
+    paths = make_files(tmpdir, 20)
+    missing = str(tmpdir.join('missing'))
+
+    hashes = hashing.hash_files(paths + [missing, paths[0]], threads=4)
+
+    assert len(hashes) == 21
+    assert hashes[missing] is None
+    for path in paths:
+        assert hashes[path] == sha1(path)
+
+
+def test_hash_files_per_device_limit(tmpdir):
+    paths = make_files(tmpdir, 12)
+    lock = threading.Lock()
+    state = {'running': 0, 'max': 0}
+
+    def slow_hash(path, algorithm):
+        with lock:
+            state['running'] += 1
+            state['max'] = max(state['max'], state['running'])
+        threading.Event().wait(0.01)
+        with lock:
+            state['running'] -= 1
+        return 'x'
+
+    with mock.patch('recipyCommon.hashing.hash_file', side_effect=slow_hash):
+        hashing.hash_files(paths, threads=6, threads_per_device=2)
+
+    # All files are on the same device
+    assert state['max'] <= 2
+
+
+def test_interleave_devices():
+    devices = {'a1': 1, 'a2': 1, 'a3': 1, 'b1': 2}
+    with mock.patch('recipyCommon.hashing._device', side_effect=devices.get):
+        jobs = hashing._interleave_devices(['a1', 'a2', 'a3', 'b1'])
+
+    assert [path for _, path in jobs] == ['a1', 'b1', 'a2', 'a3']
+
+
+def test_hash_file_algorithm(tmpdir):
+    path = make_files(tmpdir, 1)[0]
+    with open(path, 'rb') as f:
+        expected = hashlib.blake2b(f.read()).hexdigest()
+
+    assert hashing.hash_file(path, 'blake2b') == 'blake2b:' + expected
+    # SHA-1 digests don't have a prefix
+    assert hashing.hash_file(path, 'sha1') == sha1(path)
+
+
+def test_unavailable_algorithm_falls_back_to_sha1(tmpdir):
+    path = make_files(tmpdir, 1)[0]
+    with mock.patch('recipyCommon.hashing.available_algorithms',
+                    return_value=['sha1']):
+        assert hashing.hash_file(path, 'xxhash') == sha1(path)
+
+
+def test_blake2b_is_unavailable_without_hashlib_support():
+    with mock.patch.object(hashing, '_available', None), \
+            mock.patch.object(hashing, 'hashlib', mock.Mock(spec=['sha1'])):
+        with pytest.raises(ImportError):
+            hashing.new_hasher('blake2b')
+        assert 'blake2b' not in hashing.available_algorithms()
+
+
+def test_hash_file_all(tmpdir):
+    path = make_files(tmpdir, 1)[0]
+
+    digests = hashing.hash_file_all(path, ['sha1', 'sha256', 'blake2b'])
+
+    assert digests == dict((a, hashing.hash_file(path, a))
+                           for a in ['sha1', 'sha256', 'blake2b'])
+
+
+def test_split_digest():
+    assert hashing.split_digest('blake2b:abc') == ('blake2b', 'abc')
+    assert hashing.split_digest('sampled:abc') == ('sha1', 'abc')
+    assert hashing.split_digest('abc') == ('sha1', 'abc')
+
+
+def test_digest_variants():
+    assert hashing.digest_variants('sha1:ABC') == \
+        ['abc', 'sampled:abc', 'dir:abc', 'tree-4m:abc']
+    assert hashing.digest_variants('sampled:sha256:abc') == \
+        ['sampled:sha256:abc']
+    assert 'blake2b:abc' in hashing.digest_variants('abc')
+    assert 'sampled:blake2b:abc' in hashing.digest_variants('abc')
+    assert 'abc' in hashing.digest_variants('abc')
+    assert 'dir:sha256:abc' in hashing.digest_variants('abc')
+    assert hashing.digest_variants('dir:sha256:abc') == ['dir:sha256:abc']
+    assert hashing.digest_variants('md5:abc') == []
+    assert hashing.digest_variants('/not/a/hash') == []
+
+
+def test_block_size():
+    assert hashing.block_size(100) == hashing.BLOCKSIZE
+    assert hashing.block_size(10 ** 12) == hashing.MAX_BLOCKSIZE
+    # Rounded up to a multiple of the filesystem's preferred I/O size
+    assert hashing.block_size(3 * 10 ** 6, 1 << 20) == 1 << 20
+
+
+@pytest.mark.parametrize('use_mmap', [False, True])
+def test_read_into(tmpdir, use_mmap):
+    path = str(tmpdir.join('big.bin'))
+    data = os.urandom(3 * hashing.BLOCKSIZE + 17)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+    hashers = [hashlib.sha1(), hashlib.sha256()]
+    with mock.patch('recipyCommon.hashing.MMAP_THRESHOLD', 1):
+        hashing._read_into(path, hashers, use_mmap=use_mmap)
+
+    assert hashers[0].hexdigest() == hashlib.sha1(data).hexdigest()
+    assert hashers[1].hexdigest() == hashlib.sha256(data).hexdigest()
+
+
+def test_sample_offsets():
+    block = hashing.SAMPLE_BLOCKSIZE
+    assert hashing.sample_offsets(100, 4) == [(0, 100)]
+
+    offsets = hashing.sample_offsets(100 * block, 3)
+    assert offsets[0] == (0, block)
+    assert offsets[-1] == (99 * block, block)
+    assert len(offsets) == 5
+    assert [o for o, _ in offsets] == sorted(o for o, _ in offsets)
+
+
+def test_fingerprint(tmpdir):
+    path = str(tmpdir.join('big.bin'))
+    block = hashing.SAMPLE_BLOCKSIZE
+    with open(path, 'wb') as f:
+        f.write(b'x' * (20 * block))
+
+    with data_settings(hash_sample_threshold=block):
+        fingerprint = hashing.hash_file(path, 'blake2b')
+    assert fingerprint.startswith('sampled:blake2b:')
+    assert hashing.hash_file(path, 'blake2b', sampled=True) == fingerprint
+    assert hashing.hash_file(path, 'blake2b', sampled=False) != fingerprint
+
+    # A change in a sampled block changes the fingerprint
+    with open(path, 'r+b') as f:
+        f.seek(10)
+        f.write(b'y')
+    assert hashing.hash_file(path, 'blake2b', sampled=True) != fingerprint
+
+
+def test_tree_prefix():
+    assert hashing.tree_prefix(4 * 1024 * 1024) == 'tree-4m:'
+    assert hashing.tree_prefix(1 << 30) == 'tree-1g:'
+    assert hashing.tree_prefix(1000) == 'tree-1000:'
+    assert hashing.split_digest('tree-4m:sha256:abc') == ('sha256', 'abc')
+    assert hashing.digest_variants('tree-64k:blake2b:abc') == \
+        ['tree-64k:blake2b:abc']
+    assert 'tree-4m:blake2b:abc' in hashing.digest_variants('abc')
+
+
+@pytest.mark.parametrize('size', [0, 1000, 64 * 1024, 5 * 64 * 1024 + 3])
+def test_tree_hash(tmpdir, size):
+    path = str(tmpdir.join('big.bin'))
+    with open(path, 'wb') as f:
+        f.write(os.urandom(size))
+    leaf = 64 * 1024
+
+    # The digest doesn't depend on the number of threads
+    roots = hashing._tree_into(path, ['sha256', 'sha1'], leaf, 1)
+    assert hashing._tree_into(path, ['sha256', 'sha1'], leaf, 4) == roots
+
+    # It is the hash of the size, leaf size and leaf digests
+    with open(path, 'rb') as f:
+        data = f.read()
+    root = hashlib.sha256(
+        'recipy-tree-v1 {} {}\n'.format(size, leaf).encode('ascii'))
+    for start in range(0, max(size, 1), leaf):
+        root.update(hashlib.sha256(data[start:start + leaf]).digest())
+    assert roots['sha256'] == root.hexdigest()
+
+
+def test_hash_file_tree(tmpdir):
+    path = str(tmpdir.join('big.bin'))
+    with open(path, 'wb') as f:
+        f.write(b'x' * (10 * 64 * 1024))
+
+    with data_settings(hash_tree_threshold='64k',
+                       hash_tree_leaf_size='64k'):
+        digest = hashing.hash_file(path, 'blake2b')
+        assert hashing.search_digests(path)[
+            hashing.available_algorithms().index('blake2b')] == digest
+        assert not hashing.use_plain_hash(path)
+    assert digest.startswith('tree-64k:blake2b:')
+    assert hashing.hash_file(path, 'blake2b') != digest
+
+    # Fingerprints take precedence
+    with data_settings(hash_tree_threshold='64k', hash_tree_leaf_size='64k',
+                       hash_sample_threshold='64k'):
+        assert hashing.is_sampled(hashing.hash_file(path, 'blake2b'))
+
+
+def test_hash_files_tree_per_device_limit(tmpdir):
+    paths = []
+    for i in range(3):
+        paths.append(str(tmpdir.join('big{}.bin'.format(i))))
+        with open(paths[-1], 'wb') as f:
+            f.write(os.urandom(8 * 64 * 1024))
+    lock = threading.Lock()
+    state = {'running': 0, 'max': 0}
+    pread_into = hashing._pread_into
+
+    def slow_pread_into(fd, view, offset):
+        with lock:
+            state['running'] += 1
+            state['max'] = max(state['max'], state['running'])
+        threading.Event().wait(0.005)
+        with lock:
+            state['running'] -= 1
+        return pread_into(fd, view, offset)
+
+    with data_settings(hash_tree_threshold='64k',
+                       hash_tree_leaf_size='64k'):
+        expected = dict((path, hashing.hash_file(path)) for path in paths)
+        with mock.patch('recipyCommon.hashing._pread_into',
+                        side_effect=slow_pread_into), \
+                mock.patch('recipyCommon.hashing.get_hash_threads',
+                           return_value=6):
+            hashes = hashing.hash_files(paths, threads=6,
+                                        threads_per_device=2)
+
+    assert hashes == expected
+    # The leaves of all files are read on one pool, within the device limit
+    assert state['max'] <= 2
+
+
+def test_search_digests_sampled(tmpdir):
+    path = make_files(tmpdir, 1)[0]
+
+    digests = hashing.search_digests(path, sampled=True)
+
+    assert hashing.hash_file(path, 'sha1', sampled=True) in digests
+    assert all(hashing.is_sampled(d) for d in digests)
@@ -0,0 +1,53 @@
+import os
+import re
+import sys
+import json
+import subprocess
+
+# Modules that should only be imported when they are needed
+HEAVY_MODULES = ['git', 'svn', 'binaryornot', 'tinydb', 'tinydb_serialization',
+                 'pkg_resources']
+
+# Cumulative time of `import recipy` (in microseconds) that is not exceeded
+# on a reasonably fast machine; set RECIPY_IMPORT_BUDGET to change it
+IMPORT_BUDGET = int(os.environ.get('RECIPY_IMPORT_BUDGET', 500000))
+
+
+def run_python(tmpdir, *args):
+    env = dict(os.environ, HOME=str(tmpdir))
+    return subprocess.run([sys.executable] + list(args), env=env,
+                          cwd=str(tmpdir), stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE, check=True)
+
+
+def test_import_does_not_load_heavy_modules(tmpdir):
+    code = ('import sys, json, recipy; '
+            'print(json.dumps([m for m in {!r} if m in sys.modules]))'
+            .format(HEAVY_MODULES))
+    out = run_python(tmpdir, '-c', code).stdout
+
+    assert json.loads(out.decode()) == []
+
+
+def test_import_does_not_write_database(tmpdir):
+    # With -c there is no script, so recipy wouldn't start a run at all
+    db_path = tmpdir.join('.recipy', 'recipyDB.json')
+    script = tmpdir.join('script.py')
+    script.write('import os, json, recipy\n'
+                 'print(json.dumps(os.path.exists({!r})))\n'
+                 .format(str(db_path)))
+    out = run_python(tmpdir, str(script)).stdout
+
+    assert json.loads(out.decode().splitlines()[-1]) is False
+    assert db_path.exists()
+
+
+def test_import_time(tmpdir):
+    times = []
+    for _ in range(3):
+        err = run_python(tmpdir, '-X', 'importtime', '-c',
+                         'import recipy').stderr
+        m = re.search(r'\|\s*(\d+) \| recipy$', err.decode(), re.MULTILINE)
+        times.append(int(m.group(1)))
+
+    assert min(times) < IMPORT_BUDGET
@@ -0,0 +1,175 @@
+import os
+import datetime
+
+import mock
+
+from recipyCommon import journal
+from recipyCommon.blobstore import is_blob_ref, open_blob_store, resolve_run
+from recipyCommon.storage import open_storage
+from recipyCommon.utils import open_or_create_db
+
+
+def write_journal(path):
+    j = journal.RunJournal(path)
+    j.write('start', pid=None, host=None,
+            run={'unique_id': 'abc', 'inputs': [], 'outputs': [],
+                 'custom_values': {},
+                 'date': datetime.datetime(2020, 1, 2, 3, 4, 5)})
+    j.write('append', field='inputs', value=['in.csv', 'hash'])
+    j.write('append', field='inputs', value=['in.csv', 'hash'])
+    j.write('append', field='outputs', value='out.csv')
+    j.write('update', field='custom_values', value={'a': 1})
+    j.close()
+
+
+def test_fold_events(tmpdir):
+    path = str(tmpdir.join('abc.jsonl'))
+    write_journal(path)
+
+    run, file_diffs, _ = journal.fold_events(journal.read_journal(path))
+
+    assert run['inputs'] == [['in.csv', 'hash']]
+    assert run['outputs'] == ['out.csv']
+    assert run['custom_values'] == {'a': 1}
+    assert run['date'] == datetime.datetime(2020, 1, 2, 3, 4, 5)
+    assert file_diffs == []
+
+
+def test_fold_events_keeps_microseconds(tmpdir):
+    path = str(tmpdir.join('abc.jsonl'))
+    write_journal(path)
+    exit_date = datetime.datetime(2020, 1, 2, 3, 4, 6, 789)
+    j = journal.RunJournal(path)
+    j.write('set', field='exit_date', value=exit_date)
+    j.close()
+
+    run, _, _ = journal.fold_events(journal.read_journal(path))
+
+    assert run['exit_date'] == exit_date
+
+
+def test_read_journal_ignores_truncated_line(tmpdir):
+    path = str(tmpdir.join('abc.jsonl'))
+    write_journal(path)
+    with open(path, 'ab') as f:
+        f.write(b'{"event": "append", "fie')
+
+    assert len(journal.read_journal(path)) == 5
+
+
+def test_compact_journals_inserts_run(tmpdir):
+    db_path = str(tmpdir.join('recipyDB.json'))
+    write_journal(journal.get_journal_path('abc', db_path))
+
+    assert journal.compact_journals(db_path) == ['abc']
+
+    db = open_or_create_db(db_path)
+    runs = db.all()
+    db.close()
+    assert len(runs) == 1
+    assert runs[0]['outputs'] == ['out.csv']
+    assert not os.listdir(journal.get_journal_dir(db_path))
+
+
+def test_compact_journals_with_child_journals(tmpdir):
+    db_path = str(tmpdir.join('recipyDB.json'))
+    write_journal(journal.get_journal_path('abc', db_path))
+    child = journal.RunJournal(
+        journal.get_child_journal_path('abc', 123, db_path))
+    child.write('append', field='outputs', value='child.csv')
+    # Only the run's own process sets fields
+    child.write('set', field='exit_date', value='2020-01-02T03:04:05')
+    child.close()
+
+    journal.compact_journals(db_path)
+
+    db = open_or_create_db(db_path)
+    runs = db.all()
+    db.close()
+    assert runs[0]['outputs'] == ['out.csv', 'child.csv']
+    assert 'exit_date' not in runs[0]
+    assert not os.listdir(journal.get_journal_dir(db_path))
+
+
+def test_compact_journals_skips_claimed_journal(tmpdir):
+    db_path = str(tmpdir.join('recipyDB.json'))
+    path = journal.get_journal_path('abc', db_path)
+    write_journal(path)
+    # The script is gone, but its (detached) finalizer is still running
+    j = journal.RunJournal(path)
+    j.claim()
+    j.close()
+
+    assert journal.compact_journals(db_path) == []
+    assert os.path.exists(path)
+    _, _, owner = journal.fold_events(journal.read_journal(path))
+    assert owner['pid'] == os.getpid()
+
+
+def test_compact_journals_with_blob_store(tmpdir):
+    db_path = str(tmpdir.join('recipyDB.json'))
+    path = journal.get_journal_path('abc', db_path)
+    write_journal(path)
+    diff = '+print(1)\n' * 200
+    j = journal.RunJournal(path)
+    j.write('set', field='diff', value=diff)
+    j.write('filediff', value={'filename': 'out.csv', 'tempfilename': 'x',
+                               'diff': diff})
+    j.close()
+
+    with mock.patch('recipyCommon.blobstore.option_set', return_value=True):
+        journal.compact_journals(db_path)
+
+    # The run is stored like the runs saved by the script itself
+    db = open_storage(db_path)
+    run = db.get_run_by_unique_id('abc')
+    file_diffs = db.get_file_diffs(run.run_id)
+    db.close()
+    assert is_blob_ref(run['diff'])
+    assert is_blob_ref(file_diffs[0]['diff'])
+    store = open_blob_store(db_path)
+    assert resolve_run(dict(run), store)['diff'] == diff
+
+
+def test_compact_journals_updates_existing_run(tmpdir):
+    db_path = str(tmpdir.join('recipyDB.json'))
+    db = open_or_create_db(db_path)
+    db.insert({'unique_id': 'abc', 'inputs': [], 'outputs': []})
+    db.close()
+    write_journal(journal.get_journal_path('abc', db_path))
+
+    journal.compact_journals(db_path)
+
+    db = open_or_create_db(db_path)
+    runs = db.all()
+    db.close()
+    assert len(runs) == 1
+    assert runs[0]['inputs'] == [['in.csv', 'hash']]
+
+
+def test_fold_replace_event(tmpdir):
+    path = str(tmpdir.join('abc.jsonl'))
+    write_journal(path)
+    j = journal.RunJournal(path)
+    j.write('append', field='inputs', value='pending.csv')
+    j.write('replace', field='inputs', old='pending.csv',
+            value=['pending.csv', 'hash2'])
+    j.close()
+
+    run, _, _ = journal.fold_events(journal.read_journal(path))
+
+    assert run['inputs'] == [['in.csv', 'hash'], ['pending.csv', 'hash2']]
+
+
+def test_fold_extend_event(tmpdir):
+    path = str(tmpdir.join('abc.jsonl'))
+    write_journal(path)
+    j = journal.RunJournal(path)
+    j.write('extend', field='inputs',
+            values=[['in.csv', 'hash'], ['b.csv', 'h'], ['c.csv', 'h']])
+    j.close()
+
+    run, _, _ = journal.fold_events(journal.read_journal(path))
+
+    assert run['inputs'] == [['in.csv', 'hash'], ['b.csv', 'h'],
+                             ['c.csv', 'h']]
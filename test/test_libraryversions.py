@@ -1,3 +1,7 @@
+import sys
+import types
+import subprocess
+
 from nose.tools import assert_equal
 
 from recipyCommon import libraryversions
@@ -10,3 +14,64 @@ def test_get_version_recipy():
 
 def test_get_version_unknown_library():
     assert_equal(libraryversions.get_version('unknown'), 'unknown v?')
+
+
+def test_get_version_distribution_name(monkeypatch):
+    # The distribution that provides a module can have another name
+    monkeypatch.setitem(sys.modules, 'recipyfake', types.ModuleType('x'))
+    monkeypatch.setattr(libraryversions, '_versions', {})
+    monkeypatch.setattr(libraryversions, '_distributions',
+                        {'recipyfake': ['recipy']})
+    assert_equal(libraryversions.get_version('recipyfake.views'),
+                 'recipyfake v{}'.format(__version__))
+
+
+def test_get_version_is_cached(monkeypatch):
+    monkeypatch.setattr(libraryversions, '_versions', {})
+    libraryversions.get_version('recipy')
+
+    monkeypatch.setattr(libraryversions, '_get_version_from_metadata',
+                        lambda modulename: 'changed')
+    assert_equal(libraryversions.get_version('recipy.open'),
+                 'recipy v{}'.format(__version__))
+
+
+def test_get_version_does_not_import_pkg_resources():
+    code = ('import sys; import recipy; '
+            'from recipyCommon.libraryversions import get_version; '
+            'get_version("recipy"); '
+            'print("pkg_resources" in sys.modules)')
+    out = subprocess.check_output([sys.executable, '-c', code])
+    assert_equal(out.strip(), b'False')
+
+
+def test_get_versions_reads_distributions_once(monkeypatch):
+    for name in ['recipyfake', 'recipyfake2']:
+        monkeypatch.setitem(sys.modules, name, types.ModuleType(name))
+    monkeypatch.setattr(libraryversions, '_versions', {})
+    monkeypatch.setattr(libraryversions, '_distributions',
+                        {'recipyfake': ['recipy'], 'recipyfake2': ['recipy']})
+    calls = []
+    installed_versions = libraryversions._installed_versions
+
+    def count_calls(metadata):
+        calls.append(metadata)
+        return installed_versions(metadata)
+    monkeypatch.setattr(libraryversions, '_installed_versions', count_calls)
+
+    versions = libraryversions.get_versions(['recipyfake', 'recipyfake2.a'])
+
+    assert_equal(versions, ['recipyfake v{}'.format(__version__),
+                            'recipyfake2 v{}'.format(__version__)])
+    assert_equal(len(calls), 1)
+
+
+def test_metadata_backport(monkeypatch):
+    # Before Python 3.8, the importlib_metadata backport is used
+    import importlib
+    from importlib import metadata
+    monkeypatch.delattr(importlib, 'metadata')
+    monkeypatch.setitem(sys.modules, 'importlib.metadata', None)
+    monkeypatch.setitem(sys.modules, 'importlib_metadata', metadata)
+
+    assert libraryversions._metadata() is metadata
@@ -0,0 +1,135 @@
+import os
+import json
+
+import mock
+import pytest
+
+from recipyCommon import snapshots
+from recipyCommon.snapshots import RunSnapshots, cleanup_snapshots, \
+    get_snapshot_dir
+
+
+@pytest.fixture
+def db_path(tmpdir):
+    return str(tmpdir.join('recipyDB.json'))
+
+
+@pytest.fixture
+def no_reflinks():
+    error = OSError(95, 'Operation not supported')
+    with mock.patch('recipyCommon.snapshots.reflink', side_effect=error):
+        yield
+
+
+def test_copy(tmpdir, db_path, no_reflinks, make_file):
+    path = make_file('out.txt', 'x' * 100)
+    run = RunSnapshots('abc', db_path, max_copy_size=1000, budget=1000)
+
+    snapshot = run.take(path)
+
+    assert snapshot.startswith(get_snapshot_dir(db_path))
+    with open(snapshot) as f:
+        assert f.read() == 'x' * 100
+    assert run.used == 100
+
+
+def test_file_is_kept_once(tmpdir, db_path, no_reflinks, make_file):
+    path = make_file('out.txt', 'x' * 100)
+    run = RunSnapshots('abc', db_path, max_copy_size=1000, budget=1000)
+    snapshot = run.take(path)
+
+    with open(path, 'w') as f:
+        f.write('new')
+
+    assert run.take(path) is None
+    assert run.files == {path: snapshot}
+    with open(snapshot) as f:
+        assert f.read() == 'x' * 100
+
+
+def test_file_created_by_run_is_not_kept(tmpdir, db_path, no_reflinks,
+                                         make_file):
+    path = str(tmpdir.join('new.txt'))
+    run = RunSnapshots('abc', db_path)
+
+    assert run.take(path) is None
+    make_file('new.txt', 'x' * 100)
+    # The run rewrites the file it created
+    assert run.take(path) is None
+    assert run.used == 0
+
+
+def test_large_file_is_not_copied(tmpdir, db_path, no_reflinks, make_file):
+    path = make_file('out.txt', 'x' * 2000)
+    run = RunSnapshots('abc', db_path, max_copy_size=1000, budget=10000)
+
+    with pytest.warns(UserWarning, match='file_diff_max_size'):
+        assert run.take(path) is None
+    assert run.used == 0
+
+
+def test_large_file_is_cloned(tmpdir, db_path, make_file):
+    path = make_file('out.txt', 'x' * 2000)
+    run = RunSnapshots('abc', db_path, max_copy_size=1000, budget=10000)
+
+    with mock.patch('recipyCommon.snapshots.reflink') as reflink:
+        snapshot = run.take(path)
+
+    reflink.assert_called_once_with(path, snapshot)
+    assert run.used == 2000
+
+
+def test_binary_file_is_not_copied(tmpdir, db_path, no_reflinks, make_file):
+    path = make_file('out.bin', 'x' * 100)
+    run = RunSnapshots('abc', db_path, max_copy_size=1000, budget=1000)
+
+    assert run.take(path, is_binary=lambda f: True) is None
+
+
+def test_budget(tmpdir, db_path, no_reflinks, make_file):
+    run = RunSnapshots('abc', db_path, max_copy_size=1000, budget=1000)
+
+    assert run.take(make_file('a.txt', 'x' * 600)) is not None
+    with pytest.warns(UserWarning, match='file_diff_budget'):
+        assert run.take(make_file('b.txt', 'x' * 600)) is None
+    assert run.take(make_file('c.txt', 'x' * 400)) is not None
+    assert run.used == 1000
+
+
+def test_remove(tmpdir, db_path, no_reflinks, make_file):
+    run = RunSnapshots('abc', db_path)
+    run.take(make_file('out.txt', 'x' * 100))
+
+    run.remove()
+
+    assert not os.path.exists(run.path)
+
+
+def test_cleanup_snapshots(tmpdir, db_path, no_reflinks, make_file):
+    path = make_file('out.txt', 'x' * 100)
+    alive = RunSnapshots('alive', db_path)
+    alive.take(path)
+    dead = RunSnapshots('dead', db_path)
+    dead.take(path)
+    with open(os.path.join(dead.path, snapshots.OWNER_FILE), 'w') as f:
+        json.dump({'pid': os.getpid(), 'host': 'elsewhere'}, f)
+    os.utime(dead.path, (0, 0))
+
+    assert cleanup_snapshots(db_path) == 1
+
+    assert os.path.exists(alive.path)
+    assert not os.path.exists(dead.path)
+
+
+def test_cleanup_snapshots_skips_new_directory(tmpdir, db_path):
+    # A run made the directory, but didn't record its owner yet
+    new = os.path.join(get_snapshot_dir(db_path), 'new')
+    os.makedirs(new)
+    old = os.path.join(get_snapshot_dir(db_path), 'old')
+    os.makedirs(old)
+    os.utime(old, (0, 0))
+
+    assert cleanup_snapshots(db_path) == 1
+
+    assert os.path.exists(new)
+    assert not os.path.exists(old)
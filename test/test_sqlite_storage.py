@@ -0,0 +1,108 @@
+import datetime
+
+import pytest
+
+from recipyCommon.tinydb_storage import TinyDBStorage
+from recipyCommon.sqlite_storage import SQLiteStorage, migrate_tinydb
+
+
+@pytest.fixture
+def db(tmpdir):
+    storage = SQLiteStorage(str(tmpdir.join('recipyDB.sqlite')))
+    yield storage
+    storage.close()
+
+
+def test_insert_and_get_run(db, make_run):
+    run = make_run('abc', datetime.datetime(2020, 1, 1, 12, 0, 0),
+                   inputs=[('/data/in.csv', 'hash1'), '/data/unhashed.csv'],
+                   outputs=['/data/out.csv'])
+    run_id = db.insert_run(run)
+
+    stored = db.get_run(run_id)
+
+    assert stored.run_id == run_id
+    assert stored['date'] == run['date']
+    assert stored['inputs'] == [['/data/in.csv', 'hash1'],
+                                '/data/unhashed.csv']
+    assert stored['outputs'] == ['/data/out.csv']
+    assert stored['warnings'] == run['warnings']
+    assert stored['custom_values'] == {'a': 1}
+    assert 'notes' not in stored
+
+
+def test_update_run(db, make_run):
+    run_id = db.insert_run(make_run('abc', datetime.datetime(2020, 1, 1)))
+
+    db.update_run(run_id, {'outputs': [('/data/out.csv', 'hash2')],
+                           'notes': 'a note',
+                           'exit_date': datetime.datetime(2020, 1, 2)})
+
+    stored = db.get_run_by_unique_id('abc')
+    assert stored['outputs'] == [['/data/out.csv', 'hash2']]
+    assert stored['notes'] == 'a note'
+    assert stored['exit_date'] == datetime.datetime(2020, 1, 2)
+    assert stored['libraries'] == ['recipy v0.3.0']
+
+
+def test_find_runs(db, make_run):
+    db.insert_run(make_run('abc', datetime.datetime(2020, 1, 1),
+                           inputs=[('/data/in.csv', 'hash1')]))
+    db.insert_run(make_run('abd', datetime.datetime(2020, 1, 3),
+                           outputs=[('/data/out.csv', 'hash2')]))
+    db.insert_run(make_run('xyz', datetime.datetime(2020, 1, 2),
+                           inputs=[('/data/in.csv', 'hash1')],
+                           outputs=[('/data/in.csv', 'hash1')]))
+
+    assert [r['unique_id'] for r in db.find_by_hash('hash1')] == \
+        ['abc', 'xyz']
+    assert [r['unique_id'] for r in db.find_by_path('/data/out.csv')] == \
+        ['abd']
+    assert [r['unique_id'] for r in db.find_by_path_regex('.+out.+')] == \
+        ['abd']
+    assert [r['unique_id'] for r in db.find_by_id_prefix('ab')] == \
+        ['abc', 'abd']
+    assert [r['unique_id'] for r in db.search_text('out')] == ['abd']
+    assert db.latest_run()['unique_id'] == 'abd'
+
+
+def test_file_diffs_and_patches(db, make_run):
+    run_id = db.insert_run(make_run('abc', datetime.datetime(2020, 1, 1)))
+    db.add_file_diffs([{'run_id': run_id, 'filename': 'out.csv',
+                        'tempfilename': '/tmp/x', 'diff': ''}])
+    db.add_patch('numpy', ['load'], ['save'])
+
+    assert db.get_file_diffs(run_id)[0]['filename'] == 'out.csv'
+    assert db.get_patches() == [{'modulename': 'numpy',
+                                 'input_functions': ['load'],
+                                 'output_functions': ['save']}]
+
+    db.reset_patches()
+    assert db.get_patches() == []
+
+
+def test_wal_mode(db):
+    mode = db.conn.execute('PRAGMA journal_mode').fetchone()[0]
+    assert mode == 'wal'
+
+
+def test_migrate_tinydb(tmpdir, make_run):
+    tinydb_path = str(tmpdir.join('recipyDB.json'))
+    sqlite_path = str(tmpdir.join('recipyDB.sqlite'))
+    source = TinyDBStorage(tinydb_path)
+    run_id = source.insert_run(make_run('abc', datetime.datetime(2020, 1, 1),
+                                        inputs=[('/data/in.csv', 'hash1')]))
+    source.add_file_diffs([{'run_id': run_id, 'filename': 'out.csv',
+                            'tempfilename': '/tmp/x', 'diff': ''}])
+    source.close()
+
+    assert migrate_tinydb(tinydb_path, sqlite_path) == 1
+
+    target = SQLiteStorage(sqlite_path)
+    stored = target.get_run(run_id)
+    assert stored['inputs'] == [['/data/in.csv', 'hash1']]
+    assert len(target.get_file_diffs(run_id)) == 1
+    target.close()
+
+    with pytest.raises(ValueError):
+        migrate_tinydb(tinydb_path, sqlite_path)
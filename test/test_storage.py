@@ -0,0 +1,86 @@
+import datetime
+
+import pytest
+
+from recipyCommon import storage
+from recipyCommon.storage import get_backend
+
+
+@pytest.fixture
+def runs(db, make_run):
+    ids = [db.insert_run(make_run('abc', datetime.datetime(2020, 1, 1),
+                                  inputs=[('/data/in.csv', 'hash1')])),
+           db.insert_run(make_run('abd', datetime.datetime(2020, 1, 3),
+                                  outputs=[('/data/out.csv', 'hash2')],
+                                  script='other.py')),
+           db.insert_run(make_run('xyz', datetime.datetime(2020, 1, 2),
+                                  inputs=['/data/in.csv']))]
+    return ids
+
+
+def unique_ids(runs):
+    return [r['unique_id'] for r in runs]
+
+
+def test_get_run(db, runs):
+    run = db.get_run(runs[0])
+
+    assert isinstance(run, storage.Run)
+    assert run.run_id == runs[0]
+    assert run['date'] == datetime.datetime(2020, 1, 1)
+    assert db.get_run_by_unique_id('abd').run_id == runs[1]
+    assert db.get_run_by_unique_id('nope') is None
+
+
+def test_latest_run(db, runs):
+    assert db.latest_run()['unique_id'] == 'abd'
+
+
+@pytest.mark.parametrize('filters,expected', [
+    ({}, ['abc', 'abd', 'xyz']),
+    ({'hash': 'hash1'}, ['abc']),
+    ({'hash': ['blake2b:hash1', 'hash2']}, ['abd']),
+    ({'path': ['/data/out.csv', '/nope']}, ['abd']),
+    ({'path': '/data/in.csv'}, ['abc', 'xyz']),
+    ({'path_regex': '.+out.+'}, ['abd']),
+    ({'unique_id_prefix': 'ab'}, ['abc', 'abd']),
+    ({'script': 'other.py'}, ['abd']),
+    ({'text': 'hash2'}, ['abd']),
+    ({'since': datetime.datetime(2020, 1, 2)}, ['abd', 'xyz']),
+    ({'path': '/data/in.csv', 'until': datetime.datetime(2020, 1, 1)},
+     ['abc']),
+])
+def test_iter_runs(db, runs, filters, expected):
+    assert unique_ids(db.iter_runs(**filters)) == expected
+
+
+def test_iter_runs_unknown_filter(db, runs):
+    with pytest.raises(ValueError):
+        list(db.iter_runs(colour='blue'))
+
+
+def test_append_events(db, runs):
+    db.append_events(runs[1], 'inputs', [('/data/a.csv', 'h'),
+                                         ('/data/a.csv', 'h'),
+                                         '/data/b.csv'])
+    db.append_events(runs[1], 'inputs', [('/data/a.csv', 'h')])
+
+    assert db.get_run(runs[1])['inputs'] == [['/data/a.csv', 'h'],
+                                             '/data/b.csv']
+
+
+def test_set_patches(db):
+    db.add_patch('old', ['load'], ['save'])
+    patches = [{'modulename': 'numpy', 'input_functions': ['load'],
+                'output_functions': ['save']},
+               {'modulename': 'pandas', 'input_functions': ['read_csv'],
+                'output_functions': []}]
+
+    db.set_patches(patches)
+
+    assert sorted(db.get_patches(), key=lambda p: p['modulename']) == patches
+
+
+def test_get_backend_unknown():
+    with pytest.raises(ValueError):
+        get_backend('unknown')
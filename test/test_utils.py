@@ -28,3 +28,37 @@ class TestMultipleInsert(unittest.TestCase):
 		self.assertSequenceEqual(l,
 								 ['first', 'second', 'a', 'b', 'c'])
 
+
+class TestUniqueList(unittest.TestCase):
+
+	def test_append_ignores_duplicates(self):
+		l = utils.UniqueList(['b', 'a'])
+		l.append('a')
+		l.append(('c.csv', 'hash'))
+		l.append(['c.csv', 'hash'])
+		l.append({'type': 'UserWarning', 'lineno': 1})
+		l.append({'lineno': 1, 'type': 'UserWarning'})
+
+		self.assertSequenceEqual(l, ['b', 'a', ('c.csv', 'hash'),
+									 {'type': 'UserWarning', 'lineno': 1}])
+		self.assertIn(['c.csv', 'hash'], l)
+		self.assertEqual(l.index('a'), 1)
+
+	def test_replace(self):
+		l = utils.UniqueList(['a', 'b', ('c', 'h'), 'd'])
+
+		self.assertTrue(l.replace('b', ('b', 'h')))
+		self.assertFalse(l.replace('x', 'y'))
+		# The new value is in the list already
+		self.assertTrue(l.replace('a', ('c', 'h')))
+
+		self.assertSequenceEqual(l, [('b', 'h'), ('c', 'h'), 'd'])
+		self.assertEqual(l.index('d'), 2)
+		self.assertNotIn('a', l)
+
+	def test_copy(self):
+		import copy
+		l = copy.deepcopy(utils.UniqueList(['a', 'b']))
+		l.append('a')
+
+		self.assertSequenceEqual(l, ['a', 'b'])
@@ -0,0 +1,91 @@
+import os
+import time
+import subprocess
+
+import mock
+import pytest
+
+from recipyCommon import version_control
+from recipyCommon.vcscache import VcsCache
+
+pytest.importorskip('git')
+
+
+def git(cwd, *args):
+    subprocess.check_call(['git', '-c', 'user.name=recipy',
+                           '-c', 'user.email=recipy@example.com'] +
+                          list(args), cwd=cwd, stdout=subprocess.DEVNULL)
+
+
+@pytest.fixture
+def repo(tmpdir):
+    path = str(tmpdir.mkdir('repo'))
+    git(path, 'init', '-q')
+    for name in ('a.txt', 'b.txt', 'script.py'):
+        with open(os.path.join(path, name), 'w') as f:
+            f.write(name + '\n')
+    git(path, 'add', '.')
+    git(path, 'commit', '-q', '-m', 'Initial commit')
+    with open(os.path.join(path, 'a.txt'), 'a') as f:
+        f.write('changed\n')
+    return path
+
+
+def test_git_info(repo):
+    info = version_control.git_info(os.path.join(repo, 'script.py'))
+
+    assert info['gitrepo'] == repo
+    assert len(info['gitcommit']) == 40
+    assert '+changed' in info['diff']
+    assert 'diff' not in version_control.git_info(
+        os.path.join(repo, 'script.py'), diff=False)
+
+
+def test_cached_diff_is_reused(repo, tmpdir):
+    cache = VcsCache(str(tmpdir.join('cache')))
+    script = os.path.join(repo, 'script.py')
+    diff = version_control.git_info(script, cache=cache)['diff']
+
+    with mock.patch('recipyCommon.version_control.git_diff') as git_diff:
+        assert version_control.git_info(script, cache=cache)['diff'] == diff
+    assert not git_diff.called
+
+
+def test_changed_working_copy_is_diffed_again(repo, tmpdir):
+    cache = VcsCache(str(tmpdir.join('cache')))
+    script = os.path.join(repo, 'script.py')
+    version_control.git_info(script, cache=cache)
+
+    path = os.path.join(repo, 'b.txt')
+    with open(path, 'a') as f:
+        f.write('changed too\n')
+    t = time.time() + 10
+    os.utime(path, (t, t))
+
+    assert '+changed too' in \
+        version_control.git_info(script, cache=cache)['diff']
+
+
+def test_cache_evicts_least_recently_used(tmpdir):
+    cache = VcsCache(str(tmpdir.join('cache')), max_entries=2)
+    cache.put('a', 'diff a')
+    cache.put('b', 'diff b')
+    t = time.time() - 60
+    os.utime(cache._entry('b'), (t, t))
+    cache.put('c', 'diff c')
+
+    assert cache.get('b') is None
+    assert cache.get('a') == 'diff a'
+    assert cache.get('c') == 'diff c'
+
+
+def test_collect_vcs_info(repo):
+    collector = version_control.collect_vcs_info(
+        os.path.join(repo, 'script.py'), svn=False)
+
+    assert collector.result()['gitrepo'] == repo
+    assert collector.done()
+
+
+def test_collect_vcs_info_outside_working_copy(tmpdir):
+    assert version_control.collect_vcs_info(str(tmpdir.join('s.py'))) is None